@@ -1,6 +1,14 @@
-from quart import Quart, request, g, current_app
+from quart import Quart, request, g, current_app, jsonify
 from .config import load_config
-from .db import init_db
+from .db import DB_REQUEST_CONN, init_db, pin_read_your_writes, release_request_conn, start_pool_monitor, stop_pool_monitor, use_request_conn
+from .certificate_renderer import init_renderer, shutdown_renderer
+from .schema import ensure_schema
+from .jobs import start_job_workers, stop_job_workers
+from .supabase_client import close_storage_client
+from .validity_rules import start_validity_rules, stop_validity_rules
+from .warmup import start_warmup, stop_warmup
+from .admission import AdmissionRejected
+from .timing import request_spans, server_timing_header, start_request_timing
 from .routes import register_routes
 from quart_cors import cors
 import os
@@ -13,6 +21,47 @@ def create_app():
     @app.before_serving
     async def startup():
         await init_db()
+        start_pool_monitor()
+        await ensure_schema()
+        await init_renderer()
+        await start_validity_rules()
+        start_job_workers()
+        await start_warmup()
+
+    @app.after_serving
+    async def shutdown():
+        await stop_warmup()
+        await stop_job_workers()
+        await stop_pool_monitor()
+        await stop_validity_rules()
+        shutdown_renderer()
+        await close_storage_client()
+
+    @app.before_request
+    async def start_timing():
+        start_request_timing()
+        if DB_REQUEST_CONN:
+            use_request_conn()
+
+    @app.teardown_request
+    async def release_db_conn(exc):
+        await release_request_conn()
+
+    @app.after_request
+    async def add_server_timing(response):
+        spans = request_spans()
+        if spans:
+            response.headers["Server-Timing"] = server_timing_header(spans)
+        return response
+
+    @app.after_request
+    async def read_your_writes(response):
+        # Con réplica configurada: tras una escritura, las lecturas del cliente van al primario
+        return pin_read_your_writes(response)
+
+    @app.errorhandler(AdmissionRejected)
+    async def admission_rejected(e):
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
 
     @app.before_request
     async def load_user():
@@ -36,6 +85,7 @@ def create_app():
             "http://localhost:3000",
             "https://svt-frontend.vercel.app"
         ],
-        allow_credentials=True
+        allow_credentials=True,
+        expose_headers=["Server-Timing", "X-Job-Id", "Retry-After"],
     )
     return app
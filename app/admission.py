@@ -0,0 +1,132 @@
+# app/admission.py
+"""
+Control de admisión para la generación de certificados.
+
+Cada etapa cara tiene su propio AdmissionGate: un semáforo con `limit` lugares y una cola de
+espera acotada. Si la cola está llena, o la espera supera `max_wait_seconds`, se rechaza con
+AdmissionRejected (la app responde 503 + Retry-After) en vez de seguir apilando trabajo.
+
+- CERT_GATE:    certificados en curso por proceso (carga de datos, foto y render). Cada uno
+                usa como mucho una conexión a la vez, así que el límite por defecto deja la
+                mitad del pool de la base libre para login, listados, etc.
+- RENDER_GATE:  renders simultáneos (pool de procesos o to_thread).
+- STORAGE_GATE: subidas y descargas contra Supabase Storage.
+- EMAIL_GATE:   envíos de mail.
+
+Los jobs en segundo plano usan wait=True: esperan su turno sin rechazo (si fallan, el job se
+reintenta igual). El tiempo en cola de cada etapa se registra como "queue_<nombre>" en
+app.timing (Server-Timing e histogramas) y los contadores se ven en /internal/metrics/stages.
+
+Configuración por variables de entorno, <NOMBRE> = CERT, RENDER, STORAGE o EMAIL:
+  ADMISSION_<NOMBRE>_LIMIT         lugares simultáneos
+  ADMISSION_<NOMBRE>_QUEUE         cuántos pueden esperar además de los que corren
+  ADMISSION_<NOMBRE>_MAX_WAIT      segundos máximos de espera antes de rechazar
+  ADMISSION_RETRY_AFTER_SECONDS    valor del header Retry-After
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+from app.timing import record
+
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "5"))
+
+_DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+
+
+class AdmissionRejected(RuntimeError):
+    """La etapa está saturada, el llamador debería reintentar más tarde."""
+
+    def __init__(self, gate: str, retry_after: int = ADMISSION_RETRY_AFTER_SECONDS):
+        super().__init__(f"Hay demasiados certificados en proceso ({gate}), reintentá en unos segundos")
+        self.gate = gate
+        self.retry_after = retry_after
+
+
+class AdmissionGate:
+    def __init__(self, name: str, limit: int, queue_depth: int, max_wait_seconds: float):
+        self.name = name
+        self.limit = max(1, limit)
+        self.queue_depth = max(0, queue_depth)
+        self.max_wait_seconds = max_wait_seconds
+        self._sem: asyncio.Semaphore | None = None
+        self._waiting = 0
+        self._active = 0
+        self._admitted = 0
+        self._rejected = 0
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, limit: int, queue_depth: int, max_wait_seconds: float) -> "AdmissionGate":
+        return cls(
+            name,
+            limit=int(os.getenv(f"ADMISSION_{prefix}_LIMIT", str(limit))),
+            queue_depth=int(os.getenv(f"ADMISSION_{prefix}_QUEUE", str(queue_depth))),
+            max_wait_seconds=float(os.getenv(f"ADMISSION_{prefix}_MAX_WAIT", str(max_wait_seconds))),
+        )
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Se crea dentro del loop que lo usa
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        return self._sem
+
+    def _reject(self):
+        self._rejected += 1
+        return AdmissionRejected(self.name)
+
+    @asynccontextmanager
+    async def slot(self, wait: bool = False):
+        """
+        Ocupa un lugar durante el bloque. Con wait=False rechaza si la cola está llena o la
+        espera excede max_wait_seconds; con wait=True espera lo que haga falta.
+        """
+        sem = self._semaphore()
+        if not wait and sem.locked() and self._waiting >= self.queue_depth:
+            raise self._reject()
+
+        t0 = time.perf_counter()
+        self._waiting += 1
+        try:
+            if wait or self.max_wait_seconds <= 0:
+                await sem.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(sem.acquire(), timeout=self.max_wait_seconds)
+                except asyncio.TimeoutError:
+                    raise self._reject() from None
+        finally:
+            self._waiting -= 1
+        record(f"queue_{self.name}", time.perf_counter() - t0)
+
+        self._active += 1
+        self._admitted += 1
+        try:
+            yield
+        finally:
+            self._active -= 1
+            sem.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "queue_depth": self.queue_depth,
+            "active": self._active,
+            "waiting": self._waiting,
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+        }
+
+
+CERT_GATE = AdmissionGate.from_env("cert", "CERT", max(1, _DB_POOL_MAX_SIZE // 2), 16, 10.0)
+RENDER_GATE = AdmissionGate.from_env(
+    "render", "RENDER", max(1, int(os.getenv("CERT_RENDER_PROCESSES", "2"))), int(os.getenv("CERT_RENDER_QUEUE_DEPTH", "16")), 15.0
+)
+STORAGE_GATE = AdmissionGate.from_env("storage", "STORAGE", 8, 32, 15.0)
+EMAIL_GATE = AdmissionGate.from_env("email", "EMAIL", 2, 32, 30.0)
+
+GATES = (CERT_GATE, RENDER_GATE, STORAGE_GATE, EMAIL_GATE)
+
+
+def admission_stats() -> dict:
+    return {gate.name: gate.stats() for gate in GATES}
@@ -0,0 +1,158 @@
+# app/bytes_cache.py
+"""
+Cache LRU de bytes acotado por tamaño total, con un nivel opcional en disco.
+
+El nivel en memoria es por proceso y se usa desde el event loop (sin locks). El nivel en
+disco se comparte entre workers si apuntan al mismo directorio; sus lecturas y escrituras
+van por asyncio.to_thread usando aget/aput.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class BytesLRUCache:
+    def __init__(self, name: str, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        self.name = name
+        self.max_bytes = max(0, max_bytes)
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = max(0, disk_max_bytes)
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._disk_written = 0
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+            except OSError as e:
+                log.warning("Cache %s: no se pudo crear %s, se desactiva el disco: %s", name, self.disk_dir, e)
+                self.disk_dir = None
+
+    # ---------- memoria ----------
+    def get(self, key: str) -> bytes | None:
+        value = self._entries.get(key)
+        if value is None:
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = value
+        self._size += size
+        while self._size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def invalidate(self, key: str) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        path = self._disk_path(key)
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning("Cache %s: no se pudo borrar %s: %s", self.name, path, e)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk": bool(self.disk_dir),
+        }
+
+    # ---------- disco ----------
+    def _disk_path(self, key: str) -> str | None:
+        if not self.disk_dir:
+            return None
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _disk_read(self, path: str) -> bytes | None:
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)  # mtime como marca de uso para el prune
+            return data
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warning("Cache %s: error leyendo %s: %s", self.name, path, e)
+            return None
+
+    def _disk_write(self, path: str, value: bytes) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as fh:
+                fh.write(value)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("Cache %s: error escribiendo %s: %s", self.name, path, e)
+            return
+        self._disk_written += len(value)
+        if self.disk_max_bytes and self._disk_written >= self.disk_max_bytes // 10:
+            self._disk_written = 0
+            self._disk_prune()
+
+    def _disk_prune(self) -> None:
+        # Borra los archivos menos usados hasta quedar debajo del límite
+        try:
+            files = []
+            total = 0
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        st = entry.stat()
+                        files.append((st.st_mtime, st.st_size, entry.path))
+                        total += st.st_size
+            files.sort()
+            for _, size, path in files:
+                if total <= self.disk_max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        except OSError as e:
+            log.warning("Cache %s: error limpiando %s: %s", self.name, self.disk_dir, e)
+
+    # ---------- API async (memoria + disco) ----------
+    async def aget(self, key: str) -> bytes | None:
+        value = self.get(key)
+        if value is None:
+            path = self._disk_path(key)
+            if path:
+                value = await asyncio.to_thread(self._disk_read, path)
+                if value is not None:
+                    self.put(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def aput(self, key: str, value: bytes) -> None:
+        self.put(key, value)
+        path = self._disk_path(key)
+        if path:
+            await asyncio.to_thread(self._disk_write, path, value)
@@ -0,0 +1,1180 @@
+# app/certificate_engine.py
+"""
+Motor de generación de certificados, usado por el endpoint individual y por el lote.
+
+Etapas (cada una se puede llamar y medir por separado):
+
+  load_data       datos de uno o varios trámites en una sola consulta (+ regla de vigencia)
+  select_template template según condición y tipo de uso
+  load_assets     template y foto de frente en paralelo (con sus caches)
+  build_mapping   placeholders, QR y metadata para el post-proceso, sin tocar PyMuPDF
+  render          reutiliza la emisión anterior si la clave de render coincide, si no renderiza
+  persist         estado "Completado" y job durable de subida, sticker, inspección y mail
+
+Lo que depende de PyMuPDF y de los templates (render, carga de template y foto, digest del
+template) vive en app/routes/certificates.py y se inyecta al construir el motor, así este
+módulo no importa fitz.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import textwrap
+from calendar import monthrange
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+import pytz
+from dateutil import tz
+
+from app import validity_rules
+from app.admission import AdmissionRejected, EMAIL_GATE, STORAGE_GATE
+from app.bytes_cache import BytesLRUCache
+from app.db import get_conn_ctx
+from app.email import send_certificate_email
+from app.jobs import completed_steps, enqueue, mark_step, register_handler
+from app.localidades import find_localidad_codes, normalize_name
+from app.supabase_client import storage_download, storage_upload
+from app.timing import stage, timed
+
+log = logging.getLogger(__name__)
+
+BUCKET_CERTS = os.getenv("SUPABASE_BUCKET_CERTS", "certificados")
+
+TEMPLATES_POR_COND = {
+    "apto": "certificado_base_apto.pdf",
+    "condicional": "certificado_base_condicional.pdf",
+    "rechazado": "certificado_base_rechazado.pdf",
+}
+TEMPLATES_POR_COND_WITH_PHOTO = {
+    "apto": "photos/certificado_base_apto_photo.pdf",
+    "condicional": "photos/certificado_base_condicional_photo.pdf",
+    "rechazado": "certificado_base_rechazado.pdf",
+}
+_COND_MAP = {"apto": "Apto", "condicional": "Condicional", "rechazado": "Rechazado"}
+
+# ---------- CARGA DE DATOS (POR LOTE) ----------
+_CERT_DATA_QUERY = """
+    SELECT
+    a.id AS application_id,
+    a.date AS app_date,
+    a.status AS app_status,
+    a.result AS app_result,
+    a.workshop_id AS workshop_id,
+
+    o.first_name AS owner_first_name,
+    o.last_name  AS owner_last_name,
+    o.dni        AS owner_dni,
+    o.cuit       AS owner_cuit,
+    o.passport_number AS owner_passport_number,
+    o.razon_social AS owner_razon_social,
+    o.street     AS owner_street,
+    o.city       AS owner_city,
+    o.province   AS owner_province,
+    o.email      AS owner_email,
+    d.first_name AS driver_first_name,
+    d.last_name  AS driver_last_name,
+    d.dni        AS driver_dni,
+    d.cuit       AS driver_cuit,
+    d.passport_number AS driver_passport_number,
+
+    c.license_plate    AS car_plate,
+    c.brand            AS car_brand,
+    c.model            AS car_model,
+    c.manufacture_year AS car_year,
+    c.registration_year AS car_registration_year,
+    c.engine_brand     AS engine_brand,
+    c.engine_number    AS engine_number,
+    c.chassis_brand    AS chassis_brand,
+    c.chassis_number   AS chassis_number,
+    c.fuel_type        AS fuel_type,
+    c.insurance        AS insurance,
+    c.vehicle_type     AS vehicle_type,
+    c.usage_type       AS usage_type,
+    c.type_ced         AS car_type_ced,
+
+    ws.razon_social AS workshop_name,
+    ws.plant_number AS workshop_plant_number,
+    ws.province      AS workshop_province,
+    ws.city          AS workshop_city,
+
+    s.id AS sticker_id,
+    s.sticker_number AS sticker_number,
+
+    li.id                  AS insp_id,
+    li.global_observations AS insp_global_observations,
+    li.created_at          AS insp_created_at,
+    li.is_second           AS insp_is_second,
+    obs.items              AS step_obs_json,
+    ph.file_url            AS photo_file_url,
+    ph.thumb_url           AS photo_thumb_url,
+    rk.render_hash         AS last_render_hash,
+    rk.storage_path        AS last_render_path,
+    rk.job_id::text        AS last_render_job_id
+    FROM applications a
+    LEFT JOIN persons   o  ON o.id  = a.owner_id
+    LEFT JOIN persons   d  ON d.id  = a.driver_id
+    LEFT JOIN cars      c  ON c.id  = a.car_id
+    LEFT JOIN workshop  ws ON ws.id = a.workshop_id
+    LEFT JOIN stickers  s  ON s.id  = c.sticker_id
+    -- última inspección del trámite
+    LEFT JOIN LATERAL (
+        SELECT i.id, i.global_observations, i.created_at, COALESCE(i.is_second, FALSE) AS is_second
+        FROM inspections i
+        WHERE i.application_id = a.id
+        ORDER BY i.id DESC
+        LIMIT 1
+    ) li ON true
+    -- observaciones por paso, ya ordenadas
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object(
+                   'step_name', x.step_name, 'obs_desc', x.obs_desc,
+                   'step_order', x.step_order, 'obs_id', x.obs_id
+               ) ORDER BY x.step_order, x.obs_id) AS items
+        FROM (
+            SELECT COALESCE(st.name, '')   AS step_name,
+                   ob.description          AS obs_desc,
+                   COALESCE(so.number,999) AS step_order,
+                   ob.id                   AS obs_id
+            FROM observation_details od
+            JOIN inspection_details idet ON idet.id = od.inspection_detail_id
+            JOIN observations ob         ON ob.id   = od.observation_id
+            LEFT JOIN steps st           ON st.id   = ob.step_id
+            LEFT JOIN steps_order so     ON so.step_id = st.id
+                                         AND so.workshop_id = a.workshop_id
+            WHERE idet.inspection_id = li.id
+        ) x
+    ) obs ON true
+    -- foto de frente
+    LEFT JOIN LATERAL (
+        SELECT file_url, thumb_url
+        FROM inspection_documents
+        WHERE inspection_id = li.id
+          AND is_front = true
+        LIMIT 1
+    ) ph ON true
+    -- última emisión (idempotencia, ver _certificate_render_key)
+    LEFT JOIN LATERAL (
+        SELECT render_hash, storage_path, job_id
+        FROM certificate_render_keys
+        WHERE application_id = a.id
+          AND is_second = COALESCE(li.is_second, FALSE)
+    ) rk ON true
+    WHERE a.id = ANY($1::bigint[])
+"""
+
+_VALIDITY_RULES_QUERY = """
+    SELECT k.localidad_key AS lookup_key, k.usage_code AS lookup_usage,
+           r.localidad_key, r.usage_code, r.up_to_36_months, r.from_3_to_7_years, r.over_7_years
+    FROM unnest($1::text[], $2::text[]) AS k(localidad_key, usage_code)
+    LEFT JOIN LATERAL (
+        SELECT localidad_key, usage_code, up_to_36_months, from_3_to_7_years, over_7_years
+        FROM inspection_validity_rules
+        WHERE (localidad_key = k.localidad_key OR localidad_key LIKE (k.localidad_key || '%'))
+        ORDER BY
+          CASE WHEN usage_code = k.usage_code THEN 0
+               WHEN usage_code = 'C' THEN 1
+               ELSE 2 END,
+          CASE WHEN localidad_key = k.localidad_key THEN 0 ELSE 1 END,
+          localidad_key
+        LIMIT 1
+    ) r ON true
+"""
+
+def _validity_rule_key(row) -> tuple[str, str] | None:
+    """(localidad_key, usage) con el que _calc_vencimiento_from_rules busca la regla del trámite."""
+    _, loc_key = find_localidad_codes(row["workshop_province"], row["workshop_city"])
+    usage = (row["usage_type"] or "").strip().upper()
+    if not loc_key or not usage:
+        return None
+    return str(loc_key), usage
+
+async def _prefetch_certificate_data(app_ids: list[int]) -> dict[int, dict]:
+    """
+    Trae todo lo que necesita el certificado de cada trámite con una sola conexión del pool:
+    una consulta compuesta (trámite con sus joins, última inspección, observaciones por paso
+    y foto de frente vía LATERAL). Las reglas de vigencia salen del índice en memoria
+    (app/validity_rules.py); si no está cargado o quedó viejo, una consulta más para todo el lote.
+    Sirve igual para un solo trámite que para un lote.
+    Retorna: {app_id: {"row", "insp", "step_obs_rows", "photo_doc", "validity_rule"}}
+    """
+    ids = sorted({int(x) for x in app_ids})
+    if not ids:
+        return {}
+
+    async with get_conn_ctx() as conn:
+        rows = await conn.fetch(_CERT_DATA_QUERY, ids)
+
+        rule_keys = sorted({k for k in (_validity_rule_key(r) for r in rows) if k})
+        rules = {}
+        if rule_keys and await validity_rules.index_is_current(conn):
+            # Índice en memoria y al día: sin la consulta de reglas
+            rules = {k: validity_rules.lookup_validity_rule(*k) for k in rule_keys}
+        elif rule_keys:
+            rule_rows = await conn.fetch(
+                _VALIDITY_RULES_QUERY,
+                [k[0] for k in rule_keys],
+                [k[1] for k in rule_keys],
+            )
+            rules = {
+                (r["lookup_key"], r["lookup_usage"]): (r if r["localidad_key"] is not None else None)
+                for r in rule_rows
+            }
+
+    out = {}
+    for row in rows:
+        insp = None
+        if row["insp_id"] is not None:
+            insp = {
+                "application_id": row["application_id"],
+                "id": row["insp_id"],
+                "global_observations": row["insp_global_observations"],
+                "created_at": row["insp_created_at"],
+                "is_second": row["insp_is_second"],
+            }
+        obs_json = row["step_obs_json"]
+        step_obs_rows = (json.loads(obs_json) if isinstance(obs_json, str) else obs_json) or []
+        photo_doc = None
+        if row["photo_file_url"]:
+            photo_doc = {"file_url": row["photo_file_url"], "thumb_url": row["photo_thumb_url"]}
+        rule_key = _validity_rule_key(row)
+        out[row["application_id"]] = {
+            "row": row,
+            "insp": insp,
+            "step_obs_rows": step_obs_rows,
+            "photo_doc": photo_doc,
+            "validity_rule": rules.get(rule_key) if rule_key else None,
+        }
+    return out
+
+# ---------- MAPPING ----------
+def _valid_doc_value(v) -> bool:
+    """True si el valor es un documento válido (excluye None, '', 'None', 'null')."""
+    if v is None:
+        return False
+    s = str(v).strip()
+    return bool(s) and s.lower() not in ("none", "null")
+
+def _fmt_date(dt) -> str | None:
+    if not dt:
+        return None
+    try:
+        z = tz.gettz("America/Argentina/Cordoba")
+        d = dt.astimezone(z) if hasattr(dt, "astimezone") else dt
+    except Exception:
+        d = dt
+    return f"{d:%d-%m-%Y}"
+
+def _years_delta(base_dt: datetime, years: int) -> datetime:
+    try:
+        return base_dt.replace(year=base_dt.year + years)
+    except ValueError:
+        return base_dt + timedelta(days=365 * years)
+
+def _add_months(base_dt: datetime, months: int) -> datetime:
+    if months is None:
+        return base_dt
+    y = base_dt.year + (base_dt.month - 1 + months) // 12
+    m = (base_dt.month - 1 + months) % 12 + 1
+    last_day = monthrange(y, m)[1]
+    d = min(base_dt.day, last_day)
+    try:
+        return base_dt.replace(year=y, month=m, day=d)
+    except ValueError:
+        return base_dt + timedelta(days=30 * months)
+
+def _months_since_registration_year(base_dt: datetime, registration_year: int) -> int:
+    """Calcula la cantidad de meses desde enero del año de patentamiento hasta la fecha base."""
+    try:
+        # Crear fecha de referencia: 1 de enero del año de patentamiento
+        if hasattr(base_dt, 'tzinfo') and base_dt.tzinfo is not None:
+            registration_start = datetime(registration_year, 1, 1, tzinfo=base_dt.tzinfo)
+        else:
+            registration_start = datetime(registration_year, 1, 1)
+        
+        # Calcular diferencia en años y meses
+        years_diff = base_dt.year - registration_start.year
+        months_diff = base_dt.month - registration_start.month
+        
+        # Total de meses transcurridos
+        total_months = years_diff * 12 + months_diff
+        
+        return max(0, total_months)
+    except Exception:
+        return 0
+
+def _parse_spanish_month(value) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, int):
+        if 1 <= value <= 12:
+            return value
+        return None
+    s = normalize_name(str(value))
+    mapping = {
+        "enero": 1,
+        "febrero": 2,
+        "marzo": 3,
+        "abril": 4,
+        "mayo": 5,
+        "junio": 6,
+        "julio": 7,
+        "agosto": 8,
+        "septiembre": 9,
+        "octubre": 10,
+        "noviembre": 11,
+        "diciembre": 12
+        }
+    return mapping.get(s, None)
+
+_RULE_NOT_LOADED = object()
+
+async def _calc_vencimiento_from_rules(
+    fecha_emision_dt: datetime | None,
+    province_name: str | None,
+    city_name: str | None,
+    usage_code: str | None,
+    registration_year: int | None,
+    now_tz: pytz.BaseTzInfo,
+    rule=_RULE_NOT_LOADED,
+) -> datetime | None:
+    """
+    `rule` permite pasar la regla ya traída por _prefetch_certificate_data (None si no hay
+    regla para la localidad) y evitar otra conexión del pool.
+    """
+    if not fecha_emision_dt:
+        return None
+
+    base = fecha_emision_dt.astimezone(now_tz) if hasattr(fecha_emision_dt, "astimezone") else fecha_emision_dt
+    prov_code, loc_key = find_localidad_codes(province_name, city_name)
+    usage = (usage_code or "").strip().upper() or None
+
+    if not usage or not registration_year:
+        return None
+
+    if rule is _RULE_NOT_LOADED and prov_code and loc_key and await validity_rules.index_is_current():
+        rule = validity_rules.lookup_validity_rule(str(loc_key), usage)
+    if rule is _RULE_NOT_LOADED:
+        rule = None
+        try:
+            if prov_code and loc_key:
+                async with get_conn_ctx() as conn:
+                    rule = await conn.fetchrow(
+                        """
+                        SELECT localidad_key, usage_code, up_to_36_months, from_3_to_7_years, over_7_years
+                        FROM inspection_validity_rules
+                        WHERE (localidad_key = $1 OR localidad_key LIKE ($1 || '%'))
+                        ORDER BY 
+                          CASE WHEN usage_code = $2 THEN 0
+                               WHEN usage_code = 'C' THEN 1
+                               ELSE 2 END,
+                          CASE WHEN localidad_key = $1 THEN 0 ELSE 1 END,
+                          localidad_key
+                        LIMIT 1
+                        """,
+                        str(loc_key),
+                        usage,
+                    )
+        except Exception as e:
+            rule = None
+
+    try:
+        elapsed_months = _months_since_registration_year(base, int(registration_year))
+    except Exception:
+        return None
+    elapsed_years = elapsed_months // 12
+
+    default_up_to_36 = 36  
+    default_from_3_to_7 = 24 
+    default_over_7 = 12
+
+    if rule:
+        up_to_36 = rule["up_to_36_months"]
+        from_3_to_7 = rule["from_3_to_7_years"]
+        over_7 = rule["over_7_years"]
+    else:
+        up_to_36 = default_up_to_36
+        from_3_to_7 = default_from_3_to_7
+        over_7 = default_over_7
+
+    if elapsed_months <= 35 and up_to_36:
+        vto_dt = _add_months(base, int(up_to_36))
+        return vto_dt
+
+    if 3 <= elapsed_years <= 7 and from_3_to_7:
+        vto_dt = _add_months(base, int(from_3_to_7))
+        return vto_dt
+
+    if elapsed_years > 7 and over_7:
+        vto_dt = _add_months(base, int(over_7))
+        return vto_dt
+
+    return None
+
+def _calc_vencimiento_fallback_dt(fecha_emision_dt: datetime | None, car_year: int | None, now_tz: pytz.BaseTzInfo) -> datetime | None:
+    if not fecha_emision_dt:
+        return None
+    base = fecha_emision_dt.astimezone(now_tz) if hasattr(fecha_emision_dt, "astimezone") else fecha_emision_dt
+    try:
+        cy = datetime.now(now_tz).year
+        age = None if not car_year else max(0, cy - int(car_year))
+    except Exception:
+        age = None
+    if age is None:
+        delta_years = 1
+    elif age == 0:
+        delta_years = 3
+    elif 3 <= age <= 7:
+        delta_years = 2
+    elif age > 7:
+        delta_years = 1
+    else:
+        delta_years = 1
+    return _years_delta(base, delta_years)
+
+VEHICLE_TYPE_LABELS = {
+    "L":  "Vehículo automotor con menos de CUATRO (4) ruedas",
+    "L1": "2 Ruedas, Menos de 50 CM3, Menos de 40 KM/H",
+    "L2": "3 Ruedas, Menos de 50 CM3, Menos de 40 KM/H",
+    "L3": "2 Ruedas, Más de 50 CM3, Más de 40 KM/H",
+    "L4": "3 Ruedas, Más de 50 CM3, Más de 40 KM/H",
+    "L5": "3 Ruedas, Más de 50 CM3, Más de 40 KM/H",
+    "M":  "Vehículo automotor con por lo menos 4 ruedas, o 3 de más de 1.000 KG",
+    "M1": "Hasta 8 plazas más conductor y menos de 3.500 KG",
+    "M2": "Más de 8 plazas excluido conductor y hasta 5.000 KG",
+    "M3": "Más de 8 plazas excluido conductor y más de 5.000 KG",
+    "N":  "Vehículo automotor con por lo menos 4 ruedas, o 3 de más de 1.000 KG",
+    "N1": "Hasta 3.500 KG",
+    "N2": "Desde 3.500 KG hasta 12.000 KG",
+    "N3": "Más de 12.000 KG",
+    "O":  "Acoplados y semirremolques",
+    "O1": "Acoplados, semirremolques hasta 750 KG",
+    "O2": "Acoplados, semirremolques desde 750 KG hasta 3.500 KG",
+    "O3": "Acoplados, semirremolques de más de 3.500 KG y hasta 10.000 KG",
+    "O4": "Acoplados, semirremolques de más de 10.000 KG",
+}
+
+USAGE_TYPE_LABELS = {
+    "A":  "Oficial",
+    "B":  "Diplomático, Consular u Org. Internacional",
+    "C":  "Particular",
+    "D":  "De alquiler, alquiler con chofer, Taxi, Remis",
+    "E":  "Transporte público de pasajeros",
+    "E1": "Servicio internacional, regular y turismo, larga distancia y urbanos cat. M1, M2, M3",
+    "E2": "Interjurisdiccional y jurisdiccional, regulares, turismo cat. M1, M2, M3",
+    "F":  "Transporte escolar",
+    "G":  "Cargas, generales, peligrosas, recolección, carretones, servicios industriales y trabajos sobre la vía pública",
+    "H":  "Emergencia, seguridad, fúnebres, remolque, maquinaria especial o agrícola y trabajos sobre la vía pública",
+}
+
+def _vehicle_type_display(code: str | None) -> str:
+    c = (code or "").strip().upper()
+    if not c:
+        return ""
+    label = VEHICLE_TYPE_LABELS.get(c, "")
+    return f"{c} - {label}" if label else c
+
+def _usage_type_display(code: str | None) -> str:
+    c = (code or "").strip().upper()
+    if not c:
+        return ""
+    label = USAGE_TYPE_LABELS.get(c, "")
+    return f"{c} - {label}" if label else c
+
+def _wrap_to_width(text: str, width: int = 35) -> str:
+    lines = []
+    for part in (text or "").splitlines():
+        if not part:
+            lines.append("")
+            continue
+        wrapped = textwrap.wrap(part, width=width, break_long_words=False, break_on_hyphens=False)
+        lines.extend(wrapped if wrapped else [""])
+    return "\n".join(lines)
+
+# ---------- IDEMPOTENCIA DE EMISIÓN ----------
+# Subir si cambia la forma de renderizar: invalida todas las claves guardadas
+CERT_RENDER_VERSION = "2"
+# Placeholders que cambian con cada emisión aunque los datos sean los mismos: la fecha de
+# emisión sale de inspections.created_at, que el post-proceso pisa con NOW(). No entran en
+# la clave, así reimprimir devuelve la emisión anterior tal cual (con su fecha).
+_ISSUANCE_PLACEHOLDERS = frozenset({"${fecha_emision}"})
+# PDFs ya emitidos por clave de render. CERT_PDF_CACHE_DIR activa el nivel en disco (datos
+# personales: usar un directorio privado del servicio).
+_CERT_PDF_CACHE = BytesLRUCache(
+    "cert_pdf",
+    max_bytes=int(os.getenv("CERT_PDF_CACHE_MB", "64")) * 1024 * 1024,
+    disk_dir=os.getenv("CERT_PDF_CACHE_DIR") or None,
+    disk_max_bytes=int(os.getenv("CERT_PDF_CACHE_DISK_MB", "512")) * 1024 * 1024,
+)
+
+def _certificate_render_key(template_digest: str, mapping: dict[str, str], qr_link: str, photo_png: bytes | None, usage_type: str | None, render_flavor: str) -> str:
+    """
+    Hash de los datos estables del PDF: template, mapping (sin los placeholders de la
+    emisión), QR, foto y forma de dibujar.
+    """
+    stable = {k: v for k, v in mapping.items() if k not in _ISSUANCE_PLACEHOLDERS}
+    h = hashlib.sha256()
+    parts = (
+        CERT_RENDER_VERSION,
+        template_digest,
+        json.dumps(stable, sort_keys=True, ensure_ascii=False),
+        qr_link,
+        hashlib.sha256(photo_png).hexdigest() if photo_png else "",
+        usage_type or "",
+        render_flavor,
+    )
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+async def _pending_render_pdf(job_id: str) -> tuple[bool, bytes | None]:
+    """
+    (subido, pdf) de una emisión cuyo post-proceso quedó encolado: mientras el job no
+    termina el PDF está en su adjunto; si falló definitivamente no hay nada que reutilizar.
+    """
+    async with get_conn_ctx() as conn:
+        job = await conn.fetchrow(
+            "SELECT status, attachment FROM background_jobs WHERE id = $1::uuid",
+            job_id,
+        )
+    if job is None or job["status"] == "error":
+        return False, None
+    if job["status"] == "done":
+        return True, None
+    return False, job["attachment"]
+
+async def _load_reusable_certificate(render_hash: str, data: dict) -> bytes | None:
+    """PDF de la última emisión si se generó con los mismos datos estables."""
+    row = data["row"]
+    if row.get("last_render_hash") != render_hash or not row.get("last_render_path"):
+        return None
+    pdf_bytes = await _CERT_PDF_CACHE.aget(render_hash)
+    if pdf_bytes is not None:
+        return pdf_bytes
+    if row.get("last_render_job_id"):
+        # Todavía no se subió: en storage puede estar la emisión anterior
+        uploaded, pdf_bytes = await _pending_render_pdf(row["last_render_job_id"])
+        if pdf_bytes is not None:
+            await _CERT_PDF_CACHE.aput(render_hash, pdf_bytes)
+            return pdf_bytes
+        if not uploaded:
+            return None
+    try:
+        pdf_bytes = await storage_download(BUCKET_CERTS, row["last_render_path"])
+    except Exception as e:
+        log.warning("No se pudo recuperar el certificado emitido %s, se vuelve a generar: %s", row["last_render_path"], e)
+        return None
+    await _CERT_PDF_CACHE.aput(render_hash, pdf_bytes)
+    return pdf_bytes
+
+async def _save_pending_render_key(conn, app_id: int, is_second: bool, render_hash: str, storage_path: str, job_id: str) -> None:
+    """Se escribe en la misma transacción que encola el job: un segundo pedido ya la ve."""
+    await conn.execute(
+        """
+        INSERT INTO certificate_render_keys (application_id, is_second, render_hash, storage_path, public_url, job_id)
+        VALUES ($1, $2, $3, $4, NULL, $5::uuid)
+        ON CONFLICT (application_id, is_second) DO UPDATE
+           SET render_hash = EXCLUDED.render_hash,
+               storage_path = EXCLUDED.storage_path,
+               public_url = NULL,
+               job_id = EXCLUDED.job_id,
+               updated_at = NOW()
+        """,
+        app_id, is_second, render_hash, storage_path, job_id,
+    )
+
+async def _complete_render_key(app_id: int, is_second: bool, render_hash: str, public_url: str) -> None:
+    # Solo si nadie encoló otra emisión del mismo certificado mientras tanto
+    async with get_conn_ctx() as conn:
+        await conn.execute(
+            """
+            UPDATE certificate_render_keys
+               SET public_url = $4, job_id = NULL, updated_at = NOW()
+             WHERE application_id = $1 AND is_second = $2 AND render_hash = $3
+            """,
+            app_id, is_second, render_hash, public_url,
+        )
+
+# ---------- PERSISTENCIA ----------
+async def _update_application_status_to_completed(app_id: int, resultado: str, is_second_inspection: bool, max_retries: int = 3) -> None:
+    """
+    Actualiza el estado de la aplicación a "Completado" con un UPDATE atómico,
+    verificación y reintentos para asegurar que siempre se actualice correctamente.
+    
+    Args:
+        app_id: ID de la aplicación
+        resultado: Resultado de la inspección
+        is_second_inspection: Si es segunda inspección
+        max_retries: Número máximo de reintentos (default: 3)
+    
+    Raises:
+        RuntimeError: Si no se pudo actualizar después de todos los reintentos
+    """
+    update_success = False
+    last_error = None
+    
+    for attempt in range(max_retries):
+        try:
+            async with get_conn_ctx() as conn:
+                # Un UPDATE ... RETURNING ya es atómico: sin BEGIN/COMMIT es un solo round trip
+                result_column = "result_2" if is_second_inspection else "result"
+                updated_row = await conn.fetchrow(
+                    f"""
+                    UPDATE applications
+                    SET status = $1,
+                        {result_column} = $2
+                    WHERE id = $3
+                    RETURNING id, status, {result_column}
+                    """,
+                    "Completado",
+                    resultado,
+                    app_id,
+                )
+
+                # Verificar que la actualización se completó correctamente
+                if updated_row and updated_row["status"] == "Completado":
+                    update_success = True
+                    log.info("Estado actualizado a 'Completado' para aplicación %s (intento %d/%d)", app_id, attempt + 1, max_retries)
+                    break
+                else:
+                    last_error = RuntimeError(f"Actualización no confirmada: estado={updated_row['status'] if updated_row else 'None'}")
+                    log.warning("Actualización no confirmada para aplicación %s (intento %d/%d)", app_id, attempt + 1, max_retries)
+        except Exception as e:
+            last_error = e
+            log.warning("Error actualizando estado de aplicación %s (intento %d/%d): %s", app_id, attempt + 1, max_retries, e)
+            if attempt < max_retries - 1:
+                # Esperar un poco antes de reintentar (backoff exponencial)
+                await asyncio.sleep(0.5 * (2 ** attempt))
+                continue
+    
+    # Si después de todos los reintentos no se pudo actualizar, lanzar error
+    if not update_success:
+        log.error("No se pudo actualizar el estado a 'Completado' para aplicación %s después de %d intentos", app_id, max_retries)
+        raise RuntimeError(f"PDF generado, no se pudo actualizar el estado del trámite después de {max_retries} intentos: {last_error}")
+
+async def _upload_pdf_and_get_public_url_async(data: bytes, path: str) -> str:
+    """
+    Sube un PDF a Supabase Storage (reintentos de errores transitorios incluidos)
+    y devuelve su URL pública.
+    """
+    try:
+        async with STORAGE_GATE.slot(wait=True):
+            return await storage_upload(BUCKET_CERTS, path, data, "application/pdf")
+    except Exception as e:
+        error_msg = str(e)
+        raise RuntimeError(f"Error al subir PDF a Supabase Storage: {error_msg}")
+
+# ---------- FUNCIÓN PARA ACTUALIZAR EN SEGUNDO PLANO (PDF ya subido) ----------
+async def _update_application_background(app_id: int, pdf_bytes: bytes, file_name: str, metadata: dict, payload: dict, public_url: str):
+    """
+    Actualiza la aplicación en segundo plano (el PDF ya fue subido).
+    """
+
+    # Actualizar sticker si es rechazado (solo si es la primera revisión del vehículo)
+    # Casos cubiertos:
+    # 1. Primera revisión da Rechazado → marca sticker como No Disponible
+    # 2. Primera revisión Condicional, segunda Rechazado → marca sticker como No Disponible
+    # 3. Si ya tiene revisiones previas completadas (Apto, Condicional, etc.) y luego da Rechazado → NO marca (se queda en uso)
+    # 4. Si ya había dado Rechazado antes → no modifica el sticker (ya debería estar No Disponible)
+    condicion = metadata["condicion"]
+    row = metadata["row"]
+    try:
+        async with get_conn_ctx() as conn: 
+            # Verificar si es la primera revisión del vehículo cuando da rechazado
+            if condicion == "Rechazado" and row.get("sticker_id"):
+                # Obtener el car_id de la aplicación actual
+                car_id_result = await conn.fetchval(
+                    "SELECT car_id FROM applications WHERE id = $1",
+                    app_id
+                )
+                
+                if car_id_result:
+                    # Verificar si hay aplicaciones previas completadas para el mismo vehículo
+                    # Si hay aplicaciones previas completadas, el sticker ya estaba en uso, no se marca como No Disponible
+                    prev_completed_count = await conn.fetchval(
+                        """
+                        SELECT COUNT(*) 
+                        FROM applications 
+                        WHERE car_id = $1 
+                          AND status = 'Completado'
+                          AND id < $2
+                        """,
+                        car_id_result,
+                        app_id
+                    )
+                    
+                    # Solo actualizar sticker si es la primera revisión del vehículo (no hay aplicaciones previas completadas)
+                    # Esto cubre: primera revisión rechazado, o primera condicional + segunda rechazado
+                    # Si ya tiene revisiones previas (Apto, Condicional, etc.), el sticker se queda en uso
+                    if prev_completed_count == 0:
+                        await conn.execute(
+                            "UPDATE stickers SET status = 'No Disponible' WHERE id = $1",
+                            row["sticker_id"]
+                        )
+    except Exception as e:
+        log.exception("Error actualizando sticker para aplicación %s: %s", app_id, e)
+
+    # Actualizar inspección (created_at y expiration_date)
+    insp = metadata["insp"]
+    vto_dt_for_db = metadata.get("vto_dt_for_db")
+    try:
+        if insp and insp.get("id"):
+            async with get_conn_ctx() as conn:
+                await conn.execute(
+                    """
+                    UPDATE inspections
+                    SET created_at = NOW() AT TIME ZONE 'America/Argentina/Buenos_Aires',
+                        expiration_date = $2
+                    WHERE id = $1
+                    """,
+                    insp["id"],
+                    vto_dt_for_db.date() if vto_dt_for_db else None,
+                )
+    except Exception as e:
+        log.exception("Error actualizando inspección para aplicación %s: %s", app_id, e)
+
+    # El estado de la aplicación ya se actualizó cuando se creó el PDF
+    # Aquí solo se actualizan otros datos (sticker, inspección); el email va aparte
+
+async def _send_owner_email(app_id: int, pdf_bytes: bytes, file_name: str, metadata: dict) -> None:
+    """Envía el certificado al email del owner, si tiene."""
+    row = metadata["row"]
+    email_owner = metadata.get("email_owner")
+    if email_owner and email_owner.strip():
+        try:
+            async with EMAIL_GATE.slot(wait=True):
+                await send_certificate_email(
+                    to_email=email_owner.strip(),
+                    pdf_bytes=pdf_bytes,
+                    pdf_filename=file_name,
+                    owner_name=metadata["owner_fullname"],
+                    sticker_number=metadata["oblea"],
+                    car_plate=row["car_plate"],
+                    fecha_emision=metadata["fecha_emision"],
+                    fecha_vencimiento=metadata["fecha_vencimiento"],
+                    resultado=metadata["resultado_final"],
+                    certificate_number=metadata["crt_numero"],
+                    workshop_name=row["workshop_name"],
+                )
+            log.info("Certificado enviado por email a %s para aplicación %s", email_owner, app_id)
+        except Exception as e:
+            # No fallar la generación del certificado si falla el envío del email
+            log.exception("Error enviando certificado por email a %s para aplicación %s: %s", email_owner, app_id, e)
+
+CERT_POST_PROCESS_JOB = "certificate_upload_and_update"
+
+def _post_process_metadata_to_json(metadata: dict) -> dict:
+    """Deja en la metadata solo lo que usa el job de post-proceso, en forma serializable."""
+    row = metadata["row"]
+    insp = metadata.get("insp")
+    vto_dt_for_db = metadata.get("vto_dt_for_db")
+    return {
+        "condicion": metadata["condicion"],
+        "row": {
+            "sticker_id": row.get("sticker_id"),
+            "car_plate": row.get("car_plate"),
+            "workshop_name": row.get("workshop_name"),
+        },
+        "insp": {"id": insp.get("id")} if insp else None,
+        "vto_dt_for_db": vto_dt_for_db.isoformat() if vto_dt_for_db else None,
+        "fecha_emision": metadata.get("fecha_emision"),
+        "fecha_vencimiento": metadata.get("fecha_vencimiento"),
+        "owner_fullname": metadata.get("owner_fullname"),
+        "oblea": metadata.get("oblea"),
+        "crt_numero": metadata.get("crt_numero"),
+        "resultado_final": metadata.get("resultado_final"),
+        "email_owner": metadata.get("email_owner"),
+        "render_hash": metadata.get("render_hash"),
+        "is_second_inspection": bool(metadata.get("is_second_inspection")),
+    }
+
+async def _schedule_upload_and_update(app_id: int, pdf_bytes: bytes, file_name: str, metadata: dict, payload: dict) -> None:
+    """
+    Encola la subida a Supabase y las actualizaciones posteriores como job durable,
+    así sobreviven a un deploy y se reintentan si falla la subida. La clave de la
+    emisión queda guardada (pendiente) en la misma transacción.
+    """
+    render_hash = metadata.get("render_hash")
+    async with get_conn_ctx() as conn:
+        async with conn.transaction():
+            jid = await enqueue(
+                CERT_POST_PROCESS_JOB,
+                payload={
+                    "app_id": app_id,
+                    "file_name": file_name,
+                    "metadata": _post_process_metadata_to_json(metadata),
+                    "payload": payload,
+                },
+                attachment=pdf_bytes,
+                conn=conn,
+            )
+            if render_hash:
+                await _save_pending_render_key(
+                    conn, app_id, bool(metadata.get("is_second_inspection")), render_hash,
+                    f"certificados/{app_id}/{file_name}", jid,
+                )
+
+@register_handler(CERT_POST_PROCESS_JOB)
+async def _upload_and_update_job(job_payload: dict, pdf_bytes: bytes | None) -> dict:
+    if not pdf_bytes:
+        raise RuntimeError("El job no tiene el PDF adjunto")
+    app_id = int(job_payload["app_id"])
+    file_name = job_payload["file_name"]
+    metadata = job_payload["metadata"]
+    if metadata.get("vto_dt_for_db"):
+        metadata["vto_dt_for_db"] = datetime.fromisoformat(metadata["vto_dt_for_db"])
+
+    storage_path = f"certificados/{app_id}/{file_name}"
+    render_hash = metadata.get("render_hash")
+    is_second = bool(metadata.get("is_second_inspection"))
+    # Un reintento saltea los pasos que ya completó un intento anterior (no se re-sube ni
+    # se reenvía el email)
+    done = completed_steps()
+    public_url = done.get("uploaded")
+    if not public_url:
+        with stage("cert_upload"):
+            public_url = await _upload_pdf_and_get_public_url_async(pdf_bytes, storage_path)
+        await mark_step("uploaded", public_url)
+    if not done.get("db_updated"):
+        with stage("cert_db_background"):
+            await _update_application_background(app_id, pdf_bytes, file_name, metadata, job_payload.get("payload") or {}, public_url)
+        await mark_step("db_updated")
+    if not done.get("email_sent"):
+        await _send_owner_email(app_id, pdf_bytes, file_name, metadata)
+        await mark_step("email_sent")
+    if render_hash:
+        await _complete_render_key(app_id, is_second, render_hash, public_url)
+    return {"application_id": app_id, "storage_path": storage_path, "public_url": public_url}
+
+# ---------- MOTOR ----------
+class CertificateEngine:
+    def __init__(
+        self,
+        *,
+        load_template: Callable[[str], Awaitable[bytes]],
+        load_photo: Callable[[dict], Awaitable[bytes | None]],
+        render: Callable[..., Awaitable[tuple[bytes, dict]]],
+        template_digest: Callable[[bytes], str],
+        render_flavor: str = "",
+    ):
+        """
+        load_template(template_url) -> bytes
+        load_photo(photo_doc) -> PNG listo para el recuadro, o None
+        render(template_bytes, mapping, qr_link, photo_png, usage_type, template_url) -> (pdf, counts)
+        template_digest(template_bytes) -> str estable del template
+        render_flavor: cualquier opción de render que cambie el PDF (p. ej. QR vectorial)
+        """
+        self._load_template = load_template
+        self._load_photo = load_photo
+        self._render = render
+        self._template_digest = template_digest
+        self._render_flavor = render_flavor
+
+    async def load_data(self, app_ids: list[int]) -> dict[int, dict]:
+        with stage("cert_db_load"):
+            return await _prefetch_certificate_data(app_ids)
+
+    @staticmethod
+    def select_template(row, condicion_raw: str) -> tuple[str, bool]:
+        """(template_url, lleva foto)"""
+        usage_type = (row.get("usage_type") or "").strip().upper()
+        needs_photo_template = (usage_type == "D" and condicion_raw in ("apto", "condicional"))
+        if needs_photo_template:
+            template_url = TEMPLATES_POR_COND_WITH_PHOTO.get(condicion_raw, TEMPLATES_POR_COND_WITH_PHOTO["apto"])
+        else:
+            template_url = TEMPLATES_POR_COND.get(condicion_raw, TEMPLATES_POR_COND["apto"])
+        return template_url, needs_photo_template
+
+    async def load_assets(self, template_url: str, photo_doc: dict | None) -> tuple[bytes, bytes | None]:
+        """Template y foto en paralelo. Sin foto el certificado sale igual, sin template no."""
+        tasks = [timed("cert_template", self._load_template(template_url))]
+        if photo_doc and photo_doc.get("file_url"):
+            tasks.append(timed("cert_photo", self._load_photo(photo_doc)))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        template_bytes = results[0]
+        if isinstance(template_bytes, Exception):
+            raise RuntimeError(f"No se pudo cargar el template, {template_bytes}")
+        photo_png = results[1] if len(results) > 1 and not isinstance(results[1], Exception) else None
+        return template_bytes, photo_png
+
+    async def build_mapping(self, app_id: int, condicion: str, data: dict, needs_photo_template: bool) -> dict:
+        """
+        Arma el mapping de placeholders y todo lo que el post-proceso necesita.
+        Devuelve la metadata del certificado con "mapping", "qr_link" y "file_name".
+        """
+        row = data["row"]
+        insp = data["insp"]
+        step_obs_rows = data["step_obs_rows"]
+        usage_type = (row.get("usage_type") or "").strip().upper()
+
+        is_second_inspection = bool(insp and insp.get("is_second"))
+
+        base_owner_fullname = " ".join([x for x in [row["owner_first_name"], row["owner_last_name"]] if x])
+
+        documento = None
+        documento_label = "D.N.I."
+        using_cuit = False
+        if _valid_doc_value(row.get("owner_cuit")):
+            documento = str(row["owner_cuit"]).strip()
+            documento_label = "CUIT"
+            using_cuit = True
+        elif _valid_doc_value(row.get("owner_dni")) or _valid_doc_value(row.get("owner_passport_number")):
+            if _valid_doc_value(row.get("owner_dni")):
+                documento = str(row["owner_dni"]).strip()
+                documento_label = "D.N.I."
+            else:
+                documento = str(row["owner_passport_number"]).strip()
+                documento_label = "PAS"
+            using_cuit = False
+        elif _valid_doc_value(row.get("driver_dni")) or _valid_doc_value(row.get("driver_passport_number")):
+            if _valid_doc_value(row.get("driver_dni")):
+                documento = str(row["driver_dni"]).strip()
+                documento_label = "D.N.I."
+            else:
+                documento = str(row["driver_passport_number"]).strip()
+                documento_label = "PAS"
+            using_cuit = False
+        elif _valid_doc_value(row.get("driver_cuit")):
+            documento = str(row["driver_cuit"]).strip()
+            documento_label = "CUIT"
+            using_cuit = True
+
+        if os.getenv("CRT_DEBUG") == "1":
+            log.info(
+                "[CRT][documento] app_id=%s owner_dni=%r owner_cuit=%r owner_passport=%r driver_dni=%r driver_cuit=%r driver_passport=%r -> documento=%r label=%s",
+                app_id,
+                row.get("owner_dni"),
+                row.get("owner_cuit"),
+                row.get("owner_passport_number"),
+                row.get("driver_dni"),
+                row.get("driver_cuit"),
+                row.get("driver_passport_number"),
+                documento,
+                documento_label,
+            )
+
+        if using_cuit and (row.get("owner_razon_social")):
+            owner_fullname = row["owner_razon_social"]
+        else:
+            owner_fullname = base_owner_fullname
+
+        domicilio = row["owner_street"]
+        localidad = row["owner_city"]
+        provincia = row["owner_province"]
+
+        argentina_tz = pytz.timezone("America/Argentina/Buenos_Aires")
+        insp_created_at = insp.get("created_at") if insp else None
+        if is_second_inspection and insp_created_at:
+            fecha_emision_dt = insp_created_at
+        else:
+            fecha_emision_dt = insp_created_at or row["app_date"]
+        fecha_emision = _fmt_date(fecha_emision_dt) if fecha_emision_dt else ""
+    
+        fecha_base_vencimiento_dt = row["app_date"]
+        fecha_vencimiento = None
+        vto_dt_for_db = None
+        if fecha_base_vencimiento_dt:
+            if condicion == "Condicional":
+                vto_dt_for_db = fecha_base_vencimiento_dt + timedelta(days=59)
+            elif condicion == "Rechazado":
+                vto_dt_for_db = None
+            else:
+                with stage("cert_vto_rules"):
+                    vto_dt_for_db = await _calc_vencimiento_from_rules(
+                        fecha_emision_dt=fecha_base_vencimiento_dt,
+                        province_name=row["workshop_province"],
+                        city_name=row["workshop_city"],
+                        usage_code=row["usage_type"],
+                        registration_year=row["car_registration_year"],
+                        now_tz=argentina_tz,
+                        rule=data.get("validity_rule", _RULE_NOT_LOADED),
+                    )
+                if not vto_dt_for_db:
+                    vto_dt_for_db = _calc_vencimiento_fallback_dt(fecha_base_vencimiento_dt, row["car_year"], argentina_tz)
+            fecha_vencimiento = _fmt_date(vto_dt_for_db) if vto_dt_for_db else None
+    
+        resultado = condicion or (row["app_result"] or row["app_status"] or "Apto")
+        resultado_primera_inspeccion = (row["app_result"] or row["app_status"] or "").strip()
+        resultado_mapeo_principal = resultado if not is_second_inspection else (resultado_primera_inspeccion or resultado)
+        resultado_segunda_inspeccion = resultado if is_second_inspection else ""
+        tipo_puro = (row["vehicle_type"] or "").strip().upper()
+        tipo_display = _vehicle_type_display((row["vehicle_type"] or "").strip())
+        uso_display = _usage_type_display((row["usage_type"] or "").strip())
+        clasificacion_base = "\n".join([t for t in [tipo_display, uso_display] if t])
+        clasificacion = _wrap_to_width(clasificacion_base, width=40)
+
+        resultado_final = resultado_mapeo_principal if not is_second_inspection else resultado_segunda_inspeccion
+        oblea = str(row["sticker_number"] or "")
+        current_year_ar = datetime.now(argentina_tz).year
+        crt_numero = f"{row['application_id']}"
+
+        step_groups = {}
+        for r in step_obs_rows or []:
+            step_name = (r["step_name"] or "").strip()
+            desc = (r["obs_desc"] or "").strip()
+            if not step_name and not desc:
+                continue
+            step_groups.setdefault(step_name, []).append(desc) if desc else step_groups.setdefault(step_name, [])
+
+        step_lines = []
+        seen = set()
+        for r in step_obs_rows or []:
+            name = (r["step_name"] or "").strip()
+            if name in seen:
+                continue
+            seen.add(name)
+            descs = [d for d in step_groups.get(name, []) if d]
+            if not name and not descs:
+                continue
+            if descs:
+                step_lines.append(f"{name}: {', '.join(descs)}" if name else ", ".join(descs))
+            else:
+                if name:
+                    step_lines.append(f"{name}:")
+        step_obs_text = "\n".join(step_lines).strip()
+
+        global_obs_text = (insp["global_observations"] if insp and insp["global_observations"] else "").strip()
+        global_obs_wrapped = textwrap.fill(global_obs_text, width=115, break_long_words=False, break_on_hyphens=False) if global_obs_text else ""
+        obs2_width = 45 if (usage_type and usage_type.strip().upper() == "D") else 90
+        global_obs_wrapped2 = textwrap.fill(global_obs_text, width=obs2_width, break_long_words=False, break_on_hyphens=False) if global_obs_text else ""
+        observaciones_text = global_obs_wrapped
+        observaciones_text2 = global_obs_wrapped2
+
+        oblea = str(row["sticker_number"] or "").strip()
+        qr_target = oblea
+        qr_link = f"https://www.checkrto.com/qr/{qr_target}"
+        oblea_text = oblea if oblea else "Sin Asignar"
+
+        dominio_value_for_mapping = row["car_plate"] or ""
+    
+        fecha_em2 = _fmt_date(row["app_date"]) if row["app_date"] else ""
+    
+        mapping = {
+            "${fecha_emision}":         fecha_emision or "",
+            "${fecha_vencimiento}":     fecha_vencimiento or "",
+            "${fecha_em2}":              fecha_em2 or "",
+            "${fecha_vto}":             fecha_vencimiento or "",
+            "${taller}":                row["workshop_name"] or "",
+            "${num_reg}":               str(row["workshop_plant_number"] or ""),
+            "${nombre_apellido}":       owner_fullname or "",
+            "${nombre_apellido2}":      (f"{owner_fullname} ({documento_label} {documento}) - TITULAR" if documento else f"{owner_fullname} - TITULAR") or "",
+            "${documento}":             str(documento or ""),
+            "${documento2}":            str(documento or ""),
+            "${domicilio}":             domicilio or "",
+            "${f_localidad}":           localidad or "",
+            "${t_localidad}":           row["workshop_city"] or "",
+            "${localidad2}":            f"{localidad} ({provincia})" if localidad or provincia else "",
+            "${provincia}":             provincia or "",
+            "${provincia2}":            provincia or "",
+            "${patente}":               dominio_value_for_mapping,
+            "${patente2}":              dominio_value_for_mapping,
+            "${anio}":                  str(row["car_registration_year"] or ""),
+            "${marca}":                 row["car_brand"] or "",
+            "${modelo}":                row["car_model"] or "",
+            "${marca_motor}":           row["engine_brand"] or "",
+            "${numero_motor}":          str(row["engine_number"] or ""),
+            "${combustible}":           row["fuel_type"] or "",
+            "${marca_chasis}":          row["chassis_brand"] or "",
+            "${numero_chasis}":         str(row["chassis_number"] or ""),
+            "${ced_tipo}":              str(row["car_type_ced"] or ""),
+            "${ced_tipo2}":             str(row["car_type_ced"] or ""),
+            "${tipo_vehiculo}":         tipo_puro,
+            "${resultado_inspeccion}":  resultado_mapeo_principal,
+            "${observaciones}":         observaciones_text,
+            "${observaciones2}":        observaciones_text2,
+            "${clasif}":                clasificacion,
+            "${resultado2}":            resultado_segunda_inspeccion,
+            "${crt_numero}":            crt_numero,
+            "${oblea_numero}":          oblea_text,
+            "${resultado_final}":       resultado_final,
+        }
+
+        if needs_photo_template:
+            mapping["${photo}"] = ""
+
+        return {
+            "condicion": condicion,
+            "resultado": resultado,
+            "is_second_inspection": is_second_inspection,
+            "row": row,
+            "insp": insp,
+            "usage_type": usage_type,
+            "fecha_emision": fecha_emision,
+            "fecha_vencimiento": fecha_vencimiento,
+            "vto_dt_for_db": vto_dt_for_db if fecha_base_vencimiento_dt else None,
+            "owner_fullname": owner_fullname,
+            "oblea": oblea,
+            "crt_numero": crt_numero,
+            "resultado_final": resultado_final,
+            "email_owner": row["owner_email"],
+            "mapping": mapping,
+            "qr_link": qr_link,
+            "file_name": "certificado_2.pdf" if is_second_inspection else "certificado.pdf",
+        }
+
+    async def render(self, cert: dict, template_bytes: bytes, template_url: str, photo_png: bytes | None, data: dict) -> tuple[bytes, dict, str, bool]:
+        """
+        (pdf_bytes, counts, render_hash, reutilizado). Con el mismo template, datos, QR y foto
+        que la última emisión completa devuelve ese PDF sin renderizar. pdf_bytes puede ser
+        una memoryview de solo lectura (render en thread): se comparte tal cual, sin copiar.
+        """
+        render_hash = _certificate_render_key(
+            self._template_digest(template_bytes), cert["mapping"], cert["qr_link"], photo_png, cert["usage_type"], self._render_flavor,
+        )
+        with stage("cert_reuse_lookup"):
+            reused_pdf = await _load_reusable_certificate(render_hash, data)
+        if reused_pdf is not None:
+            log.info("Certificado de aplicación %s sin cambios, se reutiliza la emisión anterior", data["row"]["application_id"])
+            return reused_pdf, {}, render_hash, True
+
+        try:
+            with stage("cert_render"):
+                pdf_bytes, counts = await self._render(template_bytes, cert["mapping"], cert["qr_link"], photo_png, cert["usage_type"], template_url)
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            raise RuntimeError(f"No se pudo renderizar el PDF, {e}")
+        await _CERT_PDF_CACHE.aput(render_hash, pdf_bytes)
+        return pdf_bytes, counts, render_hash, False
+
+    async def persist(self, app_id: int, pdf_bytes: bytes, metadata: dict, payload: dict) -> None:
+        """
+        Marca el trámite como "Completado" y encola subida, sticker, inspección y mail.
+        Una emisión reutilizada ya pasó por todo esto.
+        """
+        if metadata.get("reused"):
+            return
+        # UPDATE atómico con verificación y reintentos (sin transacción explícita)
+        with stage("cert_db_status"):
+            await _update_application_status_to_completed(app_id, metadata["resultado"], metadata["is_second_inspection"])
+        with stage("cert_enqueue"):
+            await _schedule_upload_and_update(app_id, pdf_bytes, metadata["file_name"], metadata, payload)
+
+    async def generate(self, app_id: int, payload: dict, data: dict | None = None) -> tuple[bytes, str, dict]:
+        """
+        Genera el certificado de un trámite y deja encolado su post-proceso.
+        `data` permite pasar lo ya cargado por load_data (lotes).
+        Retorna: (pdf_bytes, file_name, metadata)
+        """
+        if data is None:
+            data = (await self.load_data([app_id])).get(app_id)
+            if not data:
+                raise RuntimeError("Trámite no encontrado")
+
+        condicion_raw = (payload.get("condicion") or "Apto").strip().lower()
+        condicion = _COND_MAP.get(condicion_raw, "Apto")
+        template_url, needs_photo_template = self.select_template(data["row"], condicion_raw)
+
+        template_bytes, photo_png = await self.load_assets(template_url, data["photo_doc"] if needs_photo_template else None)
+        metadata = await self.build_mapping(app_id, condicion, data, needs_photo_template)
+        pdf_bytes, counts, render_hash, reused = await self.render(metadata, template_bytes, template_url, photo_png, data)
+        metadata.update({
+            "template_url": template_url,
+            "counts": counts,
+            "render_hash": render_hash,
+            "reused": reused,
+        })
+        await self.persist(app_id, pdf_bytes, metadata, payload)
+        return pdf_bytes, metadata["file_name"], metadata
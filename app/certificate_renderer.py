@@ -0,0 +1,176 @@
+# app/certificate_renderer.py
+"""
+Pool de procesos dedicado para renderizar certificados con PyMuPDF.
+
+El render es CPU puro y con asyncio.to_thread queda serializado por el GIL, además de
+competir con las subidas y descargas por el thread pool por defecto. Acá cada worker
+precarga fitz, los bytes de los templates y sus layouts al arrancar, así a cada tarea
+solo se le envía la ruta del template, el mapping y las imágenes.
+
+Configuración por variables de entorno:
+  CERT_RENDER_PROCESSES             cantidad de procesos (0 desactiva el pool y se usa to_thread)
+  CERT_RENDER_QUEUE_DEPTH           renders que pueden esperar además de los que están corriendo
+                                    (lo aplica RENDER_GATE en app/admission.py, no este módulo)
+  CERT_RENDER_TIMEOUT_SECONDS       tiempo máximo por render
+  CERT_RENDER_MAX_TASKS_PER_WORKER  renders antes de reciclar el worker (acota la memoria de MuPDF)
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+log = logging.getLogger(__name__)
+
+RENDER_PROCESSES = int(os.getenv("CERT_RENDER_PROCESSES", "2"))
+RENDER_TIMEOUT_SECONDS = float(os.getenv("CERT_RENDER_TIMEOUT_SECONDS", "30"))
+RENDER_MAX_TASKS_PER_WORKER = int(os.getenv("CERT_RENDER_MAX_TASKS_PER_WORKER", "200"))
+
+
+_executor: ProcessPoolExecutor | None = None
+
+# ---------- lado worker ----------
+# Estado por proceso: ruta del template -> (sha256, bytes, layout)
+_WORKER_TEMPLATES: dict[str, tuple[str, bytes, list]] = {}
+
+
+def _worker_load_template(template_path: str) -> tuple[bytes, list]:
+    from app.routes import certificates as certs
+    from app.template_store import TEMPLATE_STORE
+
+    # TEMPLATE_STORE relee el archivo solo si cambió; el layout se recompila con él
+    data, digest = TEMPLATE_STORE.get(template_path)
+    cached = _WORKER_TEMPLATES.get(template_path)
+    if cached is not None and cached[0] == digest:
+        return cached[1], cached[2]
+    layout = certs._compile_template_layout(data)
+    _WORKER_TEMPLATES[template_path] = (digest, data, layout)
+    return data, layout
+
+
+def _worker_init(template_paths: tuple[str, ...]) -> None:
+    import fitz  # noqa: F401  (inicializa MuPDF una sola vez por worker)
+
+    for template_path in template_paths:
+        try:
+            _worker_load_template(template_path)
+        except Exception as e:
+            log.warning("Renderer: no se pudo precargar %s: %s", template_path, e)
+
+
+def _worker_ping() -> int:
+    return os.getpid()
+
+
+def _worker_render(
+    template_path: str,
+    mapping: dict[str, str],
+    qr_link: str,
+    photo_png: bytes | None,
+    usage_type: str | None,
+) -> tuple[bytes, dict]:
+    from app.routes import certificates as certs
+
+    data, layout = _worker_load_template(template_path)
+    pdf_view, counts = certs._render_certificate_pdf_sync(data, mapping, qr_link, photo_png, usage_type, layout)
+    # Una memoryview no se puede devolver entre procesos; la única copia queda en el worker
+    return bytes(pdf_view), counts
+
+
+# ---------- lado servidor ----------
+def _new_executor() -> ProcessPoolExecutor:
+    from app.routes.certificates import CERTIFICATE_TEMPLATES
+
+    # spawn: MuPDF no es fork-safe y max_tasks_per_child no admite fork
+    return ProcessPoolExecutor(
+        max_workers=RENDER_PROCESSES,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_worker_init,
+        initargs=(tuple(CERTIFICATE_TEMPLATES),),
+        max_tasks_per_child=RENDER_MAX_TASKS_PER_WORKER or None,
+    )
+
+
+def _discard_executor(executor: ProcessPoolExecutor) -> None:
+    # Un render colgado no se puede cancelar, hay que terminar los procesos. Sin
+    # cancel_futures: lo que estaba en cola o corriendo termina con BrokenProcessPool y
+    # render() lo reenvía al pool nuevo
+    for proc in list((getattr(executor, "_processes", None) or {}).values()):
+        try:
+            proc.terminate()
+        except Exception:
+            pass
+    executor.shutdown(wait=False)
+
+
+def _restart_executor() -> None:
+    global _executor
+    old = _executor
+    _executor = _new_executor()
+    if old is not None:
+        _discard_executor(old)
+
+
+def is_enabled() -> bool:
+    return _executor is not None
+
+
+async def init_renderer() -> None:
+    global _executor
+    if RENDER_PROCESSES <= 0 or _executor is not None:
+        return
+    _executor = _new_executor()
+    # Forzar el arranque de los workers ahora y no en el primer certificado
+    loop = asyncio.get_running_loop()
+    try:
+        pids = await asyncio.gather(*[
+            loop.run_in_executor(_executor, _worker_ping) for _ in range(RENDER_PROCESSES)
+        ])
+        log.info("Renderer de certificados listo, workers=%s", sorted(set(pids)))
+    except Exception as e:
+        log.warning("Renderer de certificados no pudo arrancar, se usa to_thread: %s", e)
+        shutdown_renderer()
+
+
+def shutdown_renderer() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+
+
+async def render(
+    template_path: str,
+    mapping: dict[str, str],
+    qr_link: str,
+    photo_png: bytes | None = None,
+    usage_type: str | None = None,
+) -> tuple[bytes, dict]:
+    """
+    Un render colgado o que rompe el pool recicla todos los workers; los renders que caen
+    como daño colateral de ese reinicio se reenvían una vez al pool nuevo.
+    """
+    # La admisión (cuántos renders corren y cuántos esperan) la hace RENDER_GATE en el llamador
+    for attempt in range(2):
+        executor = _executor
+        if executor is None:
+            raise RuntimeError("Renderer no inicializado, llamá a init_renderer() primero")
+        try:
+            fut = executor.submit(_worker_render, template_path, mapping, qr_link, photo_png, usage_type)
+            return await asyncio.wait_for(asyncio.wrap_future(fut), timeout=RENDER_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            log.error("Render de certificado excedió %.1fs (template=%s), reciclando workers", RENDER_TIMEOUT_SECONDS, template_path)
+            if executor is _executor:
+                _restart_executor()
+            raise RuntimeError(f"El render del certificado excedió {RENDER_TIMEOUT_SECONDS:.0f}s")
+        except BrokenProcessPool as e:
+            if executor is _executor:
+                log.error("Pool de render roto, reiniciando: %s", e)
+                _restart_executor()
+            if attempt == 0:
+                log.warning("Render interrumpido por el reinicio del pool (template=%s), se reintenta", template_path)
+                continue
+            raise RuntimeError("El proceso de render terminó inesperadamente")
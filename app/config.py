@@ -9,4 +9,5 @@ def load_config():
         "JWT_SECRET": os.getenv("JWT_SECRET"),
         "JWT_EXPIRATION_SECONDS": int(os.getenv("JWT_EXPIRATION_SECONDS", "3600")),
         "CRON_API_KEY": os.getenv("CRON_API_KEY"),
+        "INTERNAL_API_KEY": os.getenv("INTERNAL_API_KEY"),
     }
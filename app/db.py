@@ -1,13 +1,89 @@
+import asyncio
 import asyncpg
+import logging
+import math
 import os
 import ssl
+import time
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from app.db_metrics import DB_METRICS_ENABLED, InstrumentedConnection, current_caller, record_acquire
+
+log = logging.getLogger(__name__)
 
 db_pool: asyncpg.Pool | None = None
 
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+# Prepared statements con nombre (caché de asyncpg). Requiere PgBouncer >= 1.21 con
+# max_prepared_statements > 0, que los re-prepara en cada conexión del servidor; con un
+# PgBouncer anterior en modo transacción fallan, por eso 0 (sin caché) es el default.
+# Medido solo contra Postgres directo (benchmarks/results/): queda en 0 hasta tener números
+# detrás de PgBouncer.
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "0") == "1"
+# Por conexión; conviene que no supere el max_prepared_statements de PgBouncer
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("DB_ACQUIRE_TIMEOUT_SECONDS", "10"))
+# Cupo de conexiones para trabajo en segundo plano (jobs, arranque y los blueprints de
+# DB_BACKGROUND_BLUEPRINTS), así no dejan sin conexiones a los requests interactivos
+DB_POOL_BACKGROUND_MAX = int(os.getenv("DB_POOL_BACKGROUND_MAX", str(max(2, DB_POOL_MAX_SIZE // 2))))
+DB_BACKGROUND_BLUEPRINTS = frozenset(b.strip() for b in os.getenv("DB_BACKGROUND_BLUEPRINTS", "cron").split(",") if b.strip())
+# Monitor del pool: muestreo, avisos de saturación y (opcional) piso de conexiones adaptativo
+DB_POOL_MONITOR_SECONDS = float(os.getenv("DB_POOL_MONITOR_SECONDS", "5"))
+DB_POOL_ADAPTIVE = os.getenv("DB_POOL_ADAPTIVE", "0") == "1"
+DB_POOL_ADAPTIVE_WINDOW_SECONDS = float(os.getenv("DB_POOL_ADAPTIVE_WINDOW_SECONDS", "300"))
+DB_POOL_ADAPTIVE_MIN = int(os.getenv("DB_POOL_ADAPTIVE_MIN", "1"))
+# Conexión por request (ver use_request_conn): 1 la activa en todos los requests, no solo en
+# los handlers decorados con @request_conn
+DB_REQUEST_CONN = os.getenv("DB_REQUEST_CONN", "0") == "1"
+# Réplica de lectura opcional. get_conn_ctx(readonly=True) lee de la réplica mientras su
+# retraso no supere DB_REPLICA_MAX_LAG_SECONDS y el cliente no haya escrito en los últimos
+# DB_READ_YOUR_WRITES_SECONDS (cookie db_pin); si no, del primario
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST", "")
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", str(DB_POOL_MAX_SIZE)))
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))
+DB_REPLICA_LAG_CHECK_SECONDS = float(os.getenv("DB_REPLICA_LAG_CHECK_SECONDS", "2"))
+DB_READ_YOUR_WRITES_SECONDS = int(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "10"))
+READ_YOUR_WRITES_COOKIE = "db_pin"
+_SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+replica_pool: asyncpg.Pool | None = None
+
+_background_slots: asyncio.Semaphore | None = None
+# La tarea ya tiene un lugar del cupo (conexiones anidadas no piden otro y no se bloquean)
+_holding_background_slot: ContextVar[bool] = ContextVar("holding_background_slot", default=False)
+
+_pool_stats = {
+    "in_use": 0,
+    "in_use_background": 0,
+    "waiters": 0,
+    "acquired": 0,
+    "timeouts": 0,
+    "background_waits": 0,
+    "peak_in_use": 0,
+    "warm_floor": 0,
+    "saturation_warnings": 0,
+    "request_conn_reuses": 0,
+}
+_in_use_samples: list[tuple[float, int]] = []
+_monitor_task: asyncio.Task | None = None
+
+_replica_state = {"healthy": False, "lag_seconds": None, "checked_at": None, "error": None}
+_replica_stats = {"reads": 0, "fallback_lag": 0, "fallback_pinned": 0, "fallback_error": 0}
+_replica_task: asyncio.Task | None = None
+
+def statement_cache_options(prepared: bool = DB_PREPARED_STATEMENTS) -> dict:
+    """Opciones de asyncpg para la caché de statements (también las usa benchmarks/)."""
+    if not prepared:
+        # PgBouncer en modo transacción sin soporte de prepared statements: cada consulta
+        # usa un statement sin nombre, se parsea y planifica de nuevo
+        return {"statement_cache_size": 0}
+    return {"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+
 async def init_db() -> None:
 
-    global db_pool
+    global db_pool, _background_slots
 
     ssl_ctx = ssl.create_default_context()
     ssl_ctx.check_hostname = False
@@ -21,54 +97,418 @@ async def init_db() -> None:
         port=int(os.getenv("DB_PORT", 5432)),
         ssl=ssl_ctx,
         # PgBouncer transaction-mode settings
-        statement_cache_size=0,
+        **statement_cache_options(),
         max_inactive_connection_lifetime=300.0,
         command_timeout=60.0,
         min_size=0,
-        max_size=int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+        max_size=DB_POOL_MAX_SIZE,
     )
+    _background_slots = asyncio.Semaphore(max(1, min(DB_POOL_BACKGROUND_MAX, DB_POOL_MAX_SIZE)))
+    if DB_PREPARED_STATEMENTS:
+        log.info("Pool de la base con prepared statements (caché de %d por conexión)", DB_STATEMENT_CACHE_SIZE)
+    if DB_REPLICA_HOST:
+        await _init_replica(ssl_ctx)
 
 def _assert_pool():
     if db_pool is None:
         raise RuntimeError("DB pool no inicializado, llamá a init_db() primero")
     return db_pool
 
+async def warm_pool(connections: int) -> int:
+    """Abre `connections` conexiones del pool (min_size=0 las crea recién en el primer uso)."""
+    pool = _assert_pool()
+    connections = max(0, min(connections, pool.get_max_size()))
+
+    async def _touch():
+        async with pool.acquire(timeout=10.0) as conn:
+            await conn.fetchval("SELECT 1")
+
+    await asyncio.gather(*[_touch() for _ in range(connections)])
+    return connections
+
+def _is_background() -> bool:
+    caller = current_caller()
+    return caller == "background" or caller in DB_BACKGROUND_BLUEPRINTS
+
+@asynccontextmanager
+async def _acquire(pool: asyncpg.Pool):
+    t0 = time.perf_counter()
+    _pool_stats["waiters"] += 1
+    try:
+        conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        _pool_stats["timeouts"] += 1
+        log.warning("Timeout de %.0fs esperando conexión del pool: %s", DB_ACQUIRE_TIMEOUT_SECONDS, pool_stats())
+        raise
+    finally:
+        _pool_stats["waiters"] -= 1
+    if DB_METRICS_ENABLED:
+        record_acquire(time.perf_counter() - t0)
+    _pool_stats["acquired"] += 1
+    _pool_stats["in_use"] += 1
+    _pool_stats["peak_in_use"] = max(_pool_stats["peak_in_use"], _pool_stats["in_use"])
+    try:
+        yield conn
+    finally:
+        _pool_stats["in_use"] -= 1
+        await pool.release(conn)
+
+# ---------- Conexión por request ----------
+class _RequestConn:
+    """
+    Conexión que comparten los get_conn_ctx() de un mismo request. Se pide al pool recién en
+    el primer uso y vuelve en el teardown del request.
+    """
+
+    __slots__ = ("conn", "busy", "closed", "_cm")
+
+    def __init__(self):
+        self.conn = None
+        self.busy = False
+        self.closed = False
+        self._cm = None
+
+    @asynccontextmanager
+    async def checkout(self, pool: asyncpg.Pool):
+        # Se marca antes de esperar al pool: otra tarea del mismo request que llegue mientras
+        # tanto ve busy y usa una conexión propia en vez de pisar _cm/conn
+        self.busy = True
+        if self.conn is None:
+            self._cm = _acquire(pool)
+            try:
+                self.conn = await self._cm.__aenter__()
+            except BaseException:
+                self._cm = None
+                self.busy = False
+                raise
+        else:
+            _pool_stats["request_conn_reuses"] += 1
+        ok = False
+        try:
+            yield self.conn
+            ok = True
+        finally:
+            self.busy = False
+            # Tras un error o una transacción que quedó abierta no se reutiliza: vuelve al
+            # pool (que la resetea) y el próximo uso del request pide otra
+            if not ok or self.closed or self.conn.is_in_transaction():
+                await self._release_conn()
+
+    async def _release_conn(self) -> None:
+        cm, self._cm, self.conn = self._cm, None, None
+        if cm is not None:
+            await cm.__aexit__(None, None, None)
+
+    async def close(self) -> None:
+        self.closed = True
+        # Si todavía está en uso la libera checkout() al terminar
+        if not self.busy:
+            await self._release_conn()
+
+def _request_conn() -> _RequestConn | None:
+    # Import diferido: app.db se usa también fuera de requests (jobs, arranque)
+    from quart import g, has_request_context
+
+    if not has_request_context():
+        return None
+    return g.get("_db_request_conn")
+
+def use_request_conn() -> None:
+    """
+    Desde acá hasta el final del request, get_conn_ctx() reutiliza una misma conexión en vez
+    de pedir una al pool en cada llamada. Si la compartida está en uso (get_conn_ctx anidados
+    o tareas concurrentes del mismo request) se pide otra como siempre.
+    """
+    from quart import g
+
+    if g.get("_db_request_conn") is None:
+        g._db_request_conn = _RequestConn()
+
+def request_conn(func):
+    """Decorador de handlers: usa una sola conexión en todo el request (use_request_conn)."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        use_request_conn()
+        return await func(*args, **kwargs)
+    return wrapper
+
+async def release_request_conn() -> None:
+    """Devuelve la conexión del request al pool. Se llama en el teardown del request."""
+    rc = _request_conn()
+    if rc is not None:
+        await rc.close()
+
+# ---------- Réplica de lectura ----------
+# Segundos de retraso de la réplica; 0 si ya aplicó todo lo recibido (sin escrituras en el
+# primario, now() - pg_last_xact_replay_timestamp() crece aunque esté al día)
+_REPLICA_LAG_SQL = """
+    SELECT CASE
+             WHEN NOT pg_is_in_recovery() THEN 0
+             WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+             ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+           END::float8
+"""
+
+async def _init_replica(ssl_ctx) -> None:
+    global replica_pool
+    try:
+        replica_pool = await asyncpg.create_pool(
+            user=os.getenv("DB_REPLICA_USER") or os.getenv("DB_USER"),
+            password=os.getenv("DB_REPLICA_PASSWORD") or os.getenv("DB_PASSWORD"),
+            database=os.getenv("DB_REPLICA_NAME") or os.getenv("DB_NAME"),
+            host=DB_REPLICA_HOST,
+            port=int(os.getenv("DB_REPLICA_PORT") or os.getenv("DB_PORT", 5432)),
+            ssl=ssl_ctx,
+            **statement_cache_options(),
+            max_inactive_connection_lifetime=300.0,
+            command_timeout=60.0,
+            min_size=0,
+            max_size=DB_REPLICA_POOL_MAX_SIZE,
+        )
+    except Exception as e:
+        log.warning("No se pudo crear el pool de la réplica, las lecturas van al primario: %s", e)
+        replica_pool = None
+        return
+    await _check_replica_lag()
+    log.info("Réplica de lectura en %s: %s", DB_REPLICA_HOST, _replica_state)
+
+async def _check_replica_lag() -> None:
+    try:
+        async with replica_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS) as conn:
+            lag = await conn.fetchval(_REPLICA_LAG_SQL)
+        healthy = lag <= DB_REPLICA_MAX_LAG_SECONDS
+        if healthy != _replica_state["healthy"]:
+            log.info("Réplica %s (retraso %.1fs)", "habilitada" if healthy else "deshabilitada", lag)
+        _replica_state.update(healthy=healthy, lag_seconds=round(lag, 3), error=None)
+    except Exception as e:
+        if _replica_state["healthy"]:
+            log.warning("Réplica deshabilitada, no responde: %s", e)
+        _replica_state.update(healthy=False, lag_seconds=None, error=str(e))
+    _replica_state["checked_at"] = time.monotonic()
+
+async def _replica_lag_loop() -> None:
+    while True:
+        await asyncio.sleep(DB_REPLICA_LAG_CHECK_SECONDS)
+        await _check_replica_lag()
+
+def _pinned_to_primary() -> bool:
+    from quart import g, has_request_context, request
+
+    if not has_request_context():
+        return False
+    if g.get("_db_wrote"):
+        return True
+    raw = request.cookies.get(READ_YOUR_WRITES_COOKIE)
+    try:
+        return raw is not None and float(raw) > time.time()
+    except ValueError:
+        return False
+
+def _replica_for_read() -> asyncpg.Pool | None:
+    if replica_pool is None:
+        return None
+    if _pinned_to_primary():
+        _replica_stats["fallback_pinned"] += 1
+        return None
+    checked_at = _replica_state["checked_at"]
+    # Un chequeo viejo (el loop no corre) cuenta como réplica atrasada
+    stale = checked_at is None or time.monotonic() - checked_at > max(10.0, DB_REPLICA_LAG_CHECK_SECONDS * 3)
+    if stale or not _replica_state["healthy"]:
+        _replica_stats["fallback_lag"] += 1
+        return None
+    return replica_pool
+
+def _note_write() -> None:
+    # Cualquier conexión al primario en un request que no es GET cuenta como escritura
+    from quart import g, has_request_context, request
+
+    if has_request_context() and request.method not in _SAFE_METHODS:
+        g._db_wrote = True
+
+def pin_read_your_writes(response):
+    """
+    after_request: si el request escribió, las lecturas del mismo cliente van al primario
+    durante DB_READ_YOUR_WRITES_SECONDS (cookie con el vencimiento, la ven todos los workers).
+    """
+    from quart import g
+
+    if replica_pool is None or not g.get("_db_wrote"):
+        return response
+    production = os.getenv("ENV", "development") == "production"
+    response.set_cookie(
+        READ_YOUR_WRITES_COOKIE,
+        str(int(time.time()) + DB_READ_YOUR_WRITES_SECONDS),
+        max_age=DB_READ_YOUR_WRITES_SECONDS,
+        httponly=True,
+        samesite="None" if production else "Lax",
+        secure=production,
+    )
+    return response
+
 # Evitá exponer una conexión suelta, en transaction pooling no hay estado de sesión
 # Usá siempre context managers que abren y cierran transacciones cortas
 @asynccontextmanager
-async def get_conn_ctx():
+async def get_conn_ctx(readonly: bool = False):
     """
     Adquiere una conexión del pool.
     El manejo de transacciones queda a cargo del llamador.
+    Con DB_METRICS_ENABLED la conexión viene envuelta para medir cada consulta (app/db_metrics.py).
+    Dentro de un request con use_request_conn() se reutiliza la conexión del request.
+    readonly=True (solo lecturas) usa la réplica si está configurada y al día.
     """
     pool = _assert_pool()
-    async with pool.acquire(timeout=10.0) as conn:
-        try:
-            yield conn
-        finally:
-            pass
+    if readonly:
+        rpool = _replica_for_read()
+        if rpool is not None:
+            try:
+                conn = await rpool.acquire(timeout=DB_ACQUIRE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                # Réplica saturada: esta lectura va al primario
+                _replica_stats["fallback_error"] += 1
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                _replica_stats["fallback_error"] += 1
+                _replica_state.update(healthy=False, error=str(e))
+                log.warning("Réplica deshabilitada hasta el próximo chequeo: %s", e)
+            else:
+                _replica_stats["reads"] += 1
+                try:
+                    yield InstrumentedConnection(conn) if DB_METRICS_ENABLED else conn
+                finally:
+                    await rpool.release(conn)
+                return
+    elif replica_pool is not None:
+        _note_write()
+    rc = _request_conn()
+    if rc is not None and not rc.busy and not rc.closed and not _is_background():
+        async with rc.checkout(pool) as conn:
+            yield InstrumentedConnection(conn) if DB_METRICS_ENABLED else conn
+        return
+    background = _background_slots is not None and not _holding_background_slot.get() and _is_background()
+    if background:
+        if _background_slots.locked():
+            _pool_stats["background_waits"] += 1
+        await _background_slots.acquire()
+        token = _holding_background_slot.set(True)
+    try:
+        async with _acquire(pool) as conn:
+            if background:
+                _pool_stats["in_use_background"] += 1
+            try:
+                yield InstrumentedConnection(conn) if DB_METRICS_ENABLED else conn
+            finally:
+                if background:
+                    _pool_stats["in_use_background"] -= 1
+    finally:
+        if background:
+            _holding_background_slot.reset(token)
+            _background_slots.release()
         
 # Helpers convenientes para consultas simples
 # Cada llamada adquiere y libera conexión, útil para operaciones de una sola query
 
 async def fetch(query: str, *args):
-    pool = _assert_pool()
-    return await pool.fetch(query, *args)
+    async with get_conn_ctx() as conn:
+        return await conn.fetch(query, *args)
 
 async def fetchrow(query: str, *args):
-    pool = _assert_pool()
-    return await pool.fetchrow(query, *args)
+    async with get_conn_ctx() as conn:
+        return await conn.fetchrow(query, *args)
 
 async def fetchval(query: str, *args):
-    pool = _assert_pool()
-    return await pool.fetchval(query, *args)
+    async with get_conn_ctx() as conn:
+        return await conn.fetchval(query, *args)
 
 async def execute(query: str, *args):
-    pool = _assert_pool()
-    return await pool.execute(query, *args)
+    async with get_conn_ctx() as conn:
+        return await conn.execute(query, *args)
+
+# ---------- Telemetría y piso adaptativo del pool ----------
+def pool_stats() -> dict:
+    pool = db_pool
+    return {
+        **_pool_stats,
+        "size": pool.get_size() if pool else 0,
+        "idle": pool.get_idle_size() if pool else 0,
+        "max_size": DB_POOL_MAX_SIZE,
+        "background_max": DB_POOL_BACKGROUND_MAX,
+        "adaptive": DB_POOL_ADAPTIVE,
+        "statement_cache_size": DB_STATEMENT_CACHE_SIZE if DB_PREPARED_STATEMENTS else 0,
+        "replica": replica_stats(),
+    }
+
+def replica_stats() -> dict | None:
+    pool = replica_pool
+    if pool is None:
+        return None
+    checked_at = _replica_state["checked_at"]
+    return {
+        **_replica_stats,
+        "healthy": _replica_state["healthy"],
+        "lag_seconds": _replica_state["lag_seconds"],
+        "checked_ago_seconds": round(time.monotonic() - checked_at, 1) if checked_at is not None else None,
+        "error": _replica_state["error"],
+        "max_lag_seconds": DB_REPLICA_MAX_LAG_SECONDS,
+        "size": pool.get_size(),
+        "idle": pool.get_idle_size(),
+        "max_size": DB_REPLICA_POOL_MAX_SIZE,
+    }
+
+def _adaptive_floor(now: float) -> int:
+    # Pico de conexiones en uso en la ventana reciente, con 25% de margen
+    cutoff = now - DB_POOL_ADAPTIVE_WINDOW_SECONDS
+    while _in_use_samples and _in_use_samples[0][0] < cutoff:
+        _in_use_samples.pop(0)
+    peak = max((n for _, n in _in_use_samples), default=0)
+    return max(DB_POOL_ADAPTIVE_MIN, min(DB_POOL_MAX_SIZE, math.ceil(peak * 1.25)))
+
+async def _monitor_loop() -> None:
+    warned_at = 0.0
+    while True:
+        await asyncio.sleep(DB_POOL_MONITOR_SECONDS)
+        try:
+            now = time.monotonic()
+            in_use = _pool_stats["in_use"]
+            _in_use_samples.append((now, in_use))
+            # Aviso antes de que los requests empiecen a esperar el timeout de acquire
+            saturated = _pool_stats["waiters"] > 0 or in_use >= math.ceil(DB_POOL_MAX_SIZE * 0.9)
+            if saturated and now - warned_at >= 60:
+                warned_at = now
+                _pool_stats["saturation_warnings"] += 1
+                log.warning("Pool de la base saturado: %s", pool_stats())
+            if DB_POOL_ADAPTIVE and db_pool is not None:
+                floor = _adaptive_floor(now)
+                _pool_stats["warm_floor"] = floor
+                # Mantener abiertas `floor` conexiones (vencen tras 300 s sin uso): se usan
+                # las libres que falten para llegar al piso, sin competir si ya hay espera
+                idle_target = floor - in_use
+                if not saturated and idle_target > 0:
+                    await warm_pool(idle_target)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Monitor del pool falló: %s", e)
+
+def start_pool_monitor() -> None:
+    global _monitor_task, _replica_task
+    if DB_POOL_MONITOR_SECONDS > 0 and _monitor_task is None:
+        _monitor_task = asyncio.create_task(_monitor_loop())
+    if replica_pool is not None and _replica_task is None:
+        _replica_task = asyncio.create_task(_replica_lag_loop())
+
+async def stop_pool_monitor() -> None:
+    global _monitor_task, _replica_task
+    for task in (_monitor_task, _replica_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    _monitor_task = None
+    _replica_task = None
 
 async def close_db() -> None:
-    global db_pool
+    global db_pool, replica_pool
     if db_pool is not None:
         await db_pool.close()
         db_pool = None
+    if replica_pool is not None:
+        await replica_pool.close()
+        replica_pool = None
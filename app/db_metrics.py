@@ -0,0 +1,218 @@
+# app/db_metrics.py
+"""
+Instrumentación de las consultas que pasan por app/db.py.
+
+get_conn_ctx() entrega un InstrumentedConnection en lugar de la conexión de asyncpg: mismos
+métodos, pero fetch/fetchrow/fetchval/execute/executemany registran:
+
+- latencia y filas por (blueprint que llamó, huella de la consulta). La huella es el SQL con
+  espacios normalizados y literales/parámetros reemplazados por "?", así las variantes de
+  una misma consulta escrita a mano se agrupan.
+- espera para obtener una conexión del pool (pool_acquire).
+- muestras de consultas lentas (>= DB_SLOW_QUERY_MS) con los parámetros redactados: solo
+  tipo y largo, nunca el valor.
+
+Cada consulta suma además un span "db" (y la espera del pool "db_acquire") en app.timing,
+que van al header Server-Timing. Se consulta en /internal/metrics/queries. Es por proceso.
+
+  DB_METRICS_ENABLED    0 desactiva todo (get_conn_ctx entrega la conexión de asyncpg)
+  DB_SLOW_QUERY_MS      umbral de consulta lenta
+  DB_METRICS_MAX_KEYS   máximo de huellas distintas (las demás se agrupan en "other")
+"""
+import os
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+from app.timing import record
+
+DB_METRICS_ENABLED = os.getenv("DB_METRICS_ENABLED", "1") == "1"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+DB_METRICS_MAX_KEYS = int(os.getenv("DB_METRICS_MAX_KEYS", "500"))
+_SLOW_SAMPLES = 50
+
+_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_lock = threading.Lock()
+_queries: dict[tuple[str, str], dict] = {}
+_acquire: dict = {}
+_slow: deque = deque(maxlen=_SLOW_SAMPLES)
+
+_RE_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_RE_STRING = re.compile(r"'(?:[^']|'')*'")
+_RE_PARAM = re.compile(r"\$\d+")
+_RE_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_RE_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_RE_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(query: str) -> str:
+    q = _RE_COMMENT.sub(" ", query)
+    q = _RE_STRING.sub("?", q)
+    q = _RE_PARAM.sub("?", q)
+    q = _RE_NUMBER.sub("?", q)
+    q = _RE_IN_LIST.sub("(?)", q)
+    return _RE_SPACES.sub(" ", q).strip()
+
+
+def current_caller() -> str:
+    # Import diferido: app.db se usa también fuera de requests (jobs, arranque)
+    from quart import has_request_context, request
+
+    if has_request_context():
+        return request.blueprint or "app"
+    return "background"
+
+
+def _new_hist() -> dict:
+    return {"count": 0, "sum_ms": 0.0, "max_ms": 0.0, "rows": 0, "errors": 0, "buckets": [0] * (len(_BUCKETS_MS) + 1)}
+
+
+def _observe(h: dict, ms: float) -> None:
+    h["count"] += 1
+    h["sum_ms"] += ms
+    h["max_ms"] = max(h["max_ms"], ms)
+    idx = len(_BUCKETS_MS)
+    for i, limit in enumerate(_BUCKETS_MS):
+        if ms <= limit:
+            idx = i
+            break
+    h["buckets"][idx] += 1
+
+
+def _redact(args) -> list[str]:
+    out = []
+    for a in args:
+        if a is None:
+            out.append("null")
+        elif isinstance(a, (str, bytes, bytearray, memoryview, list, tuple)):
+            out.append(f"{type(a).__name__}[{len(a)}]")
+        else:
+            out.append(type(a).__name__)
+    return out
+
+
+def record_acquire(seconds: float) -> None:
+    ms = seconds * 1000.0
+    record("db_acquire", seconds)
+    with _lock:
+        h = _acquire.setdefault(current_caller(), _new_hist())
+        _observe(h, ms)
+
+
+def record_query(query: str, args, seconds: float, rows: int, error: bool = False) -> None:
+    ms = seconds * 1000.0
+    record("db", seconds)
+    blueprint = current_caller()
+    fp = fingerprint(query)
+    with _lock:
+        key = (blueprint, fp)
+        h = _queries.get(key)
+        if h is None:
+            if len(_queries) >= DB_METRICS_MAX_KEYS:
+                key = (blueprint, "other")
+                h = _queries.get(key)
+            if h is None:
+                h = _queries[key] = _new_hist()
+        _observe(h, ms)
+        h["rows"] += rows
+        if error:
+            h["errors"] += 1
+        if ms >= DB_SLOW_QUERY_MS:
+            _slow.append({
+                "at": time.time(),
+                "blueprint": blueprint,
+                "query": fp,
+                "ms": round(ms, 1),
+                "rows": rows,
+                "params": _redact(args),
+                "error": error,
+            })
+
+
+def _rows_from_status(status) -> int:
+    # "UPDATE 3", "INSERT 0 1", "DELETE 0"...
+    try:
+        return int(str(status).rsplit(" ", 1)[-1])
+    except (ValueError, IndexError):
+        return 0
+
+
+class InstrumentedConnection:
+    """Envuelve una conexión de asyncpg; lo que no se mide pasa directo."""
+
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _run(self, method, query, args, kwargs, rows_of):
+        t0 = time.perf_counter()
+        try:
+            result = await method(query, *args, **kwargs)
+        except Exception:
+            record_query(query, args, time.perf_counter() - t0, 0, error=True)
+            raise
+        record_query(query, args, time.perf_counter() - t0, rows_of(result))
+        return result
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._run(self._conn.fetch, query, args, kwargs, len)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._run(self._conn.fetchrow, query, args, kwargs, lambda r: 0 if r is None else 1)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._run(self._conn.fetchval, query, args, kwargs, lambda r: 0 if r is None else 1)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._run(self._conn.execute, query, args, kwargs, _rows_from_status)
+
+    async def executemany(self, query, args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            result = await self._conn.executemany(query, args, **kwargs)
+        except Exception:
+            record_query(query, (), time.perf_counter() - t0, 0, error=True)
+            raise
+        record_query(query, (), time.perf_counter() - t0, len(args) if hasattr(args, "__len__") else 0)
+        return result
+
+
+def _summary(h: dict) -> dict:
+    count = h["count"]
+    return {
+        "count": count,
+        "total_ms": round(h["sum_ms"], 1),
+        "avg_ms": round(h["sum_ms"] / count, 2) if count else None,
+        "max_ms": round(h["max_ms"], 2),
+        "rows": h["rows"],
+        "errors": h["errors"],
+        "buckets_ms": {
+            **{f"le_{limit}": n for limit, n in zip(_BUCKETS_MS, h["buckets"])},
+            "le_inf": h["buckets"][-1],
+        },
+    }
+
+
+def snapshot(top: int = 50, reset: bool = False) -> dict:
+    with _lock:
+        queries = sorted(_queries.items(), key=lambda kv: kv[1]["sum_ms"], reverse=True)[:max(0, top)]
+        out = {
+            "queries": [{"blueprint": bp, "query": fp, **_summary(h)} for (bp, fp), h in queries],
+            "distinct_queries": len(_queries),
+            "pool_acquire": {bp: _summary(h) for bp, h in sorted(_acquire.items())},
+            "slow_queries": list(_slow),
+            "slow_query_ms": DB_SLOW_QUERY_MS,
+        }
+        if reset:
+            _queries.clear()
+            _acquire.clear()
+            _slow.clear()
+        return out
@@ -0,0 +1,132 @@
+# app/image_variants.py
+"""
+Variantes de las fotos de inspección, generadas una sola vez al subirlas.
+
+- master:  el original acotado a IMAGE_MASTER_MAX_PX de lado mayor (JPEG). Si el original
+           ya entra en el límite y no necesita rotación EXIF, se guarda tal cual.
+- display: WebP liviano para mostrar en el front y en la página pública del QR.
+- thumb:   PNG exacto para el recuadro de foto del certificado (246x170), así el render
+           no descarga ni redimensiona el original.
+
+Todo es CPU (PIL), los llamadores lo corren con asyncio.to_thread. Los JPEG grandes se
+decodifican con Image.draft() a la escala más chica que alcanza para el master, así una
+foto de 15 MB no se expande completa en memoria.
+"""
+import io
+import logging
+import math
+import os
+from typing import BinaryIO
+
+from PIL import Image, ImageOps
+
+from app.bytes_cache import BytesLRUCache
+
+log = logging.getLogger(__name__)
+
+IMAGE_MASTER_MAX_PX = int(os.getenv("IMAGE_MASTER_MAX_PX", "2560"))
+IMAGE_MASTER_QUALITY = int(os.getenv("IMAGE_MASTER_QUALITY", "85"))
+IMAGE_DISPLAY_MAX_PX = int(os.getenv("IMAGE_DISPLAY_MAX_PX", "1280"))
+IMAGE_DISPLAY_QUALITY = int(os.getenv("IMAGE_DISPLAY_QUALITY", "80"))
+
+# Tamaño del recuadro de foto en los templates de certificado con foto
+CERT_THUMB_SIZE = (246, 170)
+
+# Fotos de frente ya listas para el certificado (reemisiones no vuelven a descargar ni
+# redimensionar). CERT_PHOTO_CACHE_DIR activa el nivel en disco, compartido entre workers.
+FRONT_PHOTO_CACHE = BytesLRUCache(
+    "front_photo",
+    max_bytes=int(os.getenv("CERT_PHOTO_CACHE_MB", "32")) * 1024 * 1024,
+    disk_dir=os.getenv("CERT_PHOTO_CACHE_DIR") or None,
+    disk_max_bytes=int(os.getenv("CERT_PHOTO_CACHE_DISK_MB", "256")) * 1024 * 1024,
+)
+
+
+def front_photo_cache_key(file_url: str, size: tuple[int, int] = CERT_THUMB_SIZE) -> str:
+    return f"{file_url}|{size[0]}x{size[1]}"
+
+
+def invalidate_front_photos(file_urls) -> None:
+    for file_url in file_urls:
+        if file_url:
+            FRONT_PHOTO_CACHE.invalidate(front_photo_cache_key(file_url))
+
+
+_EXIF_ORIENTATION = 0x0112
+
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+    if img.mode in ("RGBA", "LA", "P"):
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        rgb_img = Image.new("RGB", img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None)
+        return rgb_img
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def make_certificate_thumbnail(img: Image.Image, width: int, height: int) -> bytes:
+    """PNG de width x height tal como lo espera el template (sin conservar proporción)."""
+    img_resized = _to_rgb(img.resize((width, height), Image.Resampling.LANCZOS))
+    buf = io.BytesIO()
+    img_resized.save(buf, format="PNG", optimize=False)
+    return buf.getvalue()
+
+
+def resize_image_bytes(data: bytes, width: int, height: int) -> bytes:
+    """Fallback para fotos sin thumbnail pregenerado; orienta igual que build_image_variants."""
+    with Image.open(io.BytesIO(data)) as img:
+        return make_certificate_thumbnail(ImageOps.exif_transpose(img), width, height)
+
+
+def _draft_for_master(img: Image.Image) -> None:
+    # Solo JPEG: el decoder escala 1/2, 1/4 u 1/8 sin pasar por la resolución completa
+    if img.format != "JPEG" or max(img.size) <= IMAGE_MASTER_MAX_PX:
+        return
+    ratio = IMAGE_MASTER_MAX_PX / max(img.size)
+    img.draft("RGB", (math.ceil(img.width * ratio), math.ceil(img.height * ratio)))
+
+
+def build_image_variants(source: bytes | BinaryIO) -> dict | None:
+    """
+    Devuelve {"master": (bytes, mime) | None, "display": bytes | None, "thumb": bytes}
+    o None si el contenido no es una imagen que PIL pueda abrir. `source` puede ser el
+    archivo ya posicionado al inicio, para no leerlo entero a memoria.
+    """
+    try:
+        img = Image.open(source if hasattr(source, "read") else io.BytesIO(source))
+        original_size = img.size
+        _draft_for_master(img)
+        img.load()
+    except Exception:
+        return None
+
+    try:
+        orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+    except Exception:
+        orientation = 1
+    img = ImageOps.exif_transpose(img)
+
+    master = None
+    if max(original_size) > IMAGE_MASTER_MAX_PX or orientation not in (None, 1):
+        bounded = img.copy()
+        bounded.thumbnail((IMAGE_MASTER_MAX_PX, IMAGE_MASTER_MAX_PX), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        _to_rgb(bounded).save(buf, format="JPEG", quality=IMAGE_MASTER_QUALITY, optimize=True)
+        master = (buf.getvalue(), "image/jpeg")
+
+    display = None
+    try:
+        disp = img.copy()
+        disp.thumbnail((IMAGE_DISPLAY_MAX_PX, IMAGE_DISPLAY_MAX_PX), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        _to_rgb(disp).save(buf, format="WEBP", quality=IMAGE_DISPLAY_QUALITY, method=4)
+        display = buf.getvalue()
+    except Exception as e:
+        # PIL sin soporte WebP: se sigue sin variante de display
+        log.warning("No se pudo generar la variante WebP: %s", e)
+
+    thumb = make_certificate_thumbnail(img, *CERT_THUMB_SIZE)
+    return {"master": master, "display": display, "thumb": thumb}
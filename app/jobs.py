@@ -1,26 +1,405 @@
 # app/jobs.py
-import uuid
-import time
+"""
+Jobs persistidos en Postgres (tabla background_jobs, ver app/schema.py).
+
+Hay dos usos:
+- Seguimiento de trabajo que corre en el mismo proceso: new_job() + run_job()/set_status().
+  El estado queda en la base, así get_job() responde igual desde cualquier worker. Mientras
+  corren tienen lease como los durables (lo renueva el proceso dueño); si el proceso se
+  reinicia a mitad, el lease vence y se marcan como error.
+- Trabajo durable: enqueue(kind, payload) deja una fila que toma el loop de workers con
+  SELECT ... FOR UPDATE SKIP LOCKED, con reintentos y backoff exponencial. Si el proceso
+  muere a mitad de un job, el lease vence y otro worker lo vuelve a tomar. Mientras el
+  handler corre, un heartbeat renueva el lease cada JOBS_LEASE_SECONDS / 3.
+  Los handlers con efectos no repetibles marcan cada paso con mark_step(); un reintento ve
+  en completed_steps() lo que ya se hizo y lo saltea.
+
+Los jobs terminados (done/error) se borran pasado JOBS_TTL_SECONDS.
+"""
 import asyncio
+import contextvars
+import json
+import logging
+import os
+import uuid
+from typing import Any, Awaitable, Callable
+
+from app.db import get_conn_ctx
+
+log = logging.getLogger(__name__)
+
+JOBS_POLL_INTERVAL_SECONDS = float(os.getenv("JOBS_POLL_INTERVAL_SECONDS", "1.0"))
+JOBS_WORKER_CONCURRENCY = int(os.getenv("JOBS_WORKER_CONCURRENCY", "2"))
+JOBS_LEASE_SECONDS = int(os.getenv("JOBS_LEASE_SECONDS", "300"))
+JOBS_TTL_SECONDS = int(os.getenv("JOBS_TTL_SECONDS", str(7 * 24 * 3600)))
+JOBS_BACKOFF_BASE_SECONDS = float(os.getenv("JOBS_BACKOFF_BASE_SECONDS", "5"))
+JOBS_BACKOFF_MAX_SECONDS = float(os.getenv("JOBS_BACKOFF_MAX_SECONDS", "600"))
+_CLEANUP_EVERY_SECONDS = 600
+
+# kind -> handler(payload, attachment) que devuelve el resultado (serializable a JSON)
+JobHandler = Callable[[dict, bytes | None], Awaitable[Any]]
+_HANDLERS: dict[str, JobHandler] = {}
+
+_worker_tasks: list[asyncio.Task] = []
+
+# Jobs en proceso (kind NULL) que están corriendo en este proceso; su lease se renueva acá
+_local_jobs: set[str] = set()
+_local_lease_task: asyncio.Task | None = None
+
+# (id del job, pasos completados) del job que corre en la tarea actual
+_current_job: contextvars.ContextVar[tuple[str, dict] | None] = contextvars.ContextVar("_current_job", default=None)
+
+
+def _to_json(value) -> str | None:
+    if value is None:
+        return None
+    return json.dumps(value, default=str)
+
+
+def _from_json(value):
+    if value is None:
+        return None
+    return json.loads(value) if isinstance(value, str) else value
 
-_JOBS = {}  # job_id -> {"status": "pending|running|done|error", "result": dict|None, "error": str|None, "updated_at": float}
 
-def new_job() -> str:
+_INSERT_JOB = """
+    INSERT INTO background_jobs (id, kind, status, payload, attachment, max_attempts)
+    VALUES ($1::uuid, $2, 'pending', $3::jsonb, $4, $5)
+"""
+
+
+async def new_job(kind: str | None = None, payload: dict | None = None, attachment: bytes | None = None, max_attempts: int = 1, conn=None) -> str:
+    """`conn` permite encolar dentro de una transacción del llamador."""
     jid = str(uuid.uuid4())
-    _JOBS[jid] = {"status": "pending", "result": None, "error": None, "updated_at": time.time()}
+    args = (jid, kind, _to_json(payload), attachment, max_attempts)
+    if conn is not None:
+        await conn.execute(_INSERT_JOB, *args)
+        return jid
+    async with get_conn_ctx() as conn:
+        await conn.execute(_INSERT_JOB, *args)
     return jid
 
-def set_status(jid: str, status: str, result=None, error: str | None = None):
-    if jid in _JOBS:
-        _JOBS[jid].update({"status": status, "result": result, "error": error, "updated_at": time.time()})
 
-def get_job(jid: str):
-    return _JOBS.get(jid)
+async def enqueue(kind: str, payload: dict | None = None, attachment: bytes | None = None, max_attempts: int = 5, conn=None) -> str:
+    """Encola trabajo durable para el loop de workers."""
+    if kind not in _HANDLERS:
+        raise RuntimeError(f"No hay handler registrado para jobs de tipo {kind}")
+    return await new_job(kind, payload, attachment, max_attempts, conn=conn)
+
+
+async def set_status(jid: str, status: str, result=None, error: str | None = None):
+    if status == "running":
+        _local_jobs.add(jid)
+    else:
+        _local_jobs.discard(jid)
+    async with get_conn_ctx() as conn:
+        await conn.execute(
+            """
+            UPDATE background_jobs
+               SET status = $2, result = $3::jsonb, error = $4, updated_at = NOW(),
+                   locked_until = CASE WHEN $2 = 'running' THEN NOW() + make_interval(secs => $5) END
+             WHERE id = $1::uuid
+            """,
+            jid, status, _to_json(result), error, float(JOBS_LEASE_SECONDS),
+        )
+
+
+async def get_job(jid: str):
+    try:
+        uuid.UUID(str(jid))
+    except ValueError:
+        return None
+    async with get_conn_ctx() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT status, result, error, attempts,
+                   EXTRACT(EPOCH FROM updated_at)::float8 AS updated_at
+              FROM background_jobs
+             WHERE id = $1::uuid
+            """,
+            jid,
+        )
+    if not row:
+        return None
+    return {
+        "status": row["status"],
+        "result": _from_json(row["result"]),
+        "error": row["error"],
+        "attempts": row["attempts"],
+        "updated_at": row["updated_at"],
+    }
+
 
 async def run_job(coro, jid: str):
     try:
-        set_status(jid, "running")
+        await set_status(jid, "running")
         result = await coro
-        set_status(jid, "done", result=result)
+        await set_status(jid, "done", result=result)
+    except Exception as e:
+        await set_status(jid, "error", error=str(e))
+
+
+# ---------- loop de workers ----------
+def register_handler(kind: str):
+    def decorator(fn: JobHandler) -> JobHandler:
+        _HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+
+async def _claim_next():
+    async with get_conn_ctx() as conn:
+        return await conn.fetchrow(
+            """
+            UPDATE background_jobs
+               SET status = 'running',
+                   attempts = attempts + 1,
+                   locked_until = NOW() + make_interval(secs => $2),
+                   updated_at = NOW()
+             WHERE id = (
+                SELECT id
+                  FROM background_jobs
+                 WHERE kind = ANY($1::text[])
+                   AND (
+                        (status = 'pending' AND run_at <= NOW())
+                     OR (status = 'running' AND locked_until < NOW())
+                   )
+                 ORDER BY run_at
+                 LIMIT 1
+                 FOR UPDATE SKIP LOCKED
+             )
+            RETURNING id::text AS id, kind, payload, attachment, attempts, max_attempts, result
+            """,
+            list(_HANDLERS.keys()),
+            float(JOBS_LEASE_SECONDS),
+        )
+
+
+async def _extend_lease(job) -> bool:
+    async with get_conn_ctx() as conn:
+        status = await conn.execute(
+            """
+            UPDATE background_jobs
+               SET locked_until = NOW() + make_interval(secs => $2), updated_at = NOW()
+             WHERE id = $1::uuid AND status = 'running' AND attempts = $3
+            """,
+            job["id"], float(JOBS_LEASE_SECONDS), job["attempts"],
+        )
+    return status.split()[-1] != "0"
+
+
+async def _lease_heartbeat(job) -> None:
+    interval = max(JOBS_LEASE_SECONDS / 3, 1.0)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not await _extend_lease(job):
+                log.warning("Job %s (%s): el lease ya no es de este worker", job["id"], job["kind"])
+                return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Se reintenta en el próximo tick; el lease todavía tiene margen
+            log.warning("No se pudo renovar el lease del job %s: %s", job["id"], e)
+
+
+def completed_steps() -> dict:
+    """Pasos que el job actual ya completó en intentos anteriores (paso -> valor guardado)."""
+    current = _current_job.get()
+    return dict(current[1]) if current else {}
+
+
+async def mark_step(step: str, value=True) -> None:
+    """Registra en el job actual que el paso terminó, para que un reintento no lo repita."""
+    current = _current_job.get()
+    if current is None:
+        return
+    jid, steps = current
+    steps[step] = value
+    async with get_conn_ctx() as conn:
+        await conn.execute(
+            "UPDATE background_jobs SET result = $2::jsonb, updated_at = NOW() WHERE id = $1::uuid",
+            jid, _to_json({"steps": steps}),
+        )
+
+
+async def _finish(job, result) -> None:
+    async with get_conn_ctx() as conn:
+        await conn.execute(
+            """
+            UPDATE background_jobs
+               SET status = 'done', result = $2::jsonb, error = NULL,
+                   attachment = NULL, locked_until = NULL, updated_at = NOW()
+             WHERE id = $1::uuid
+            """,
+            job["id"], _to_json(result),
+        )
+
+
+async def _fail(job, exc: Exception) -> None:
+    attempts = job["attempts"]
+    if attempts < job["max_attempts"]:
+        delay = min(JOBS_BACKOFF_MAX_SECONDS, JOBS_BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)))
+        log.warning("Job %s (%s) falló, reintento %s/%s en %.0fs: %s", job["id"], job["kind"], attempts, job["max_attempts"], delay, exc)
+        query = """
+            UPDATE background_jobs
+               SET status = 'pending', error = $2, locked_until = NULL,
+                   run_at = NOW() + make_interval(secs => $3), updated_at = NOW()
+             WHERE id = $1::uuid
+        """
+        args = (job["id"], str(exc), float(delay))
+    else:
+        log.error("Job %s (%s) falló definitivamente tras %s intentos: %s", job["id"], job["kind"], attempts, exc)
+        query = """
+            UPDATE background_jobs
+               SET status = 'error', error = $2, locked_until = NULL, updated_at = NOW()
+             WHERE id = $1::uuid
+        """
+        args = (job["id"], str(exc))
+    async with get_conn_ctx() as conn:
+        await conn.execute(query, *args)
+
+
+async def _release(job) -> None:
+    async with get_conn_ctx() as conn:
+        await conn.execute(
+            """
+            UPDATE background_jobs
+               SET status = 'pending', attempts = GREATEST(attempts - 1, 0),
+                   locked_until = NULL, updated_at = NOW()
+             WHERE id = $1::uuid
+            """,
+            job["id"],
+        )
+
+
+async def _run_claimed(job) -> None:
+    handler = _HANDLERS[job["kind"]]
+    progress = _from_json(job["result"]) or {}
+    token = _current_job.set((job["id"], dict(progress.get("steps") or {})))
+    heartbeat = asyncio.create_task(_lease_heartbeat(job))
+    try:
+        result = await handler(_from_json(job["payload"]) or {}, job["attachment"])
+    except asyncio.CancelledError:
+        # Apagado del worker (deploy): devolver el job a la cola sin consumir un intento
+        try:
+            await _release(job)
+        except Exception:
+            pass
+        raise
     except Exception as e:
-        set_status(jid, "error", error=str(e))
+        await _fail(job, e)
+        return
+    finally:
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+        _current_job.reset(token)
+    await _finish(job, result)
+
+
+async def cleanup_expired_jobs() -> int:
+    async with get_conn_ctx() as conn:
+        status = await conn.execute(
+            """
+            DELETE FROM background_jobs
+             WHERE updated_at < NOW() - make_interval(secs => $1)
+               AND status IN ('done', 'error')
+            """,
+            float(JOBS_TTL_SECONDS),
+        )
+    try:
+        return int(status.split()[-1])
+    except Exception:
+        return 0
+
+
+async def expire_orphaned_local_jobs() -> int:
+    """Marca como error los jobs en proceso cuyo dueño dejó de renovar el lease (reinicio, crash)."""
+    async with get_conn_ctx() as conn:
+        status = await conn.execute(
+            """
+            UPDATE background_jobs
+               SET status = 'error',
+                   error = 'El proceso que corría el job terminó antes de completarlo',
+                   locked_until = NULL, updated_at = NOW()
+             WHERE kind IS NULL
+               AND status IN ('pending', 'running')
+               AND COALESCE(locked_until, updated_at + make_interval(secs => $1)) < NOW()
+            """,
+            float(JOBS_LEASE_SECONDS),
+        )
+    try:
+        return int(status.split()[-1])
+    except Exception:
+        return 0
+
+
+async def _local_jobs_lease_loop() -> None:
+    # La primera vuelta corre al arrancar: reconcilia lo que quedó colgado del proceso anterior
+    interval = max(JOBS_LEASE_SECONDS / 3, 1.0)
+    while True:
+        try:
+            if _local_jobs:
+                async with get_conn_ctx() as conn:
+                    await conn.execute(
+                        """
+                        UPDATE background_jobs
+                           SET locked_until = NOW() + make_interval(secs => $2)
+                         WHERE id = ANY($1::uuid[]) AND status = 'running'
+                        """,
+                        list(_local_jobs), float(JOBS_LEASE_SECONDS),
+                    )
+            expired = await expire_orphaned_local_jobs()
+            if expired:
+                log.warning("Jobs en proceso huérfanos marcados como error: %s", expired)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("No se pudo renovar el lease de los jobs en proceso: %s", e)
+        await asyncio.sleep(interval)
+
+
+async def _worker_loop(worker_num: int) -> None:
+    loop = asyncio.get_running_loop()
+    next_cleanup = loop.time() + (_CLEANUP_EVERY_SECONDS if worker_num else 0)
+    while True:
+        try:
+            if worker_num == 0 and loop.time() >= next_cleanup:
+                next_cleanup = loop.time() + _CLEANUP_EVERY_SECONDS
+                deleted = await cleanup_expired_jobs()
+                if deleted:
+                    log.info("Jobs vencidos eliminados: %s", deleted)
+
+            job = await _claim_next() if _HANDLERS else None
+            if job is None:
+                await asyncio.sleep(JOBS_POLL_INTERVAL_SECONDS)
+                continue
+            await _run_claimed(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("Error en el loop de jobs: %s", e)
+            await asyncio.sleep(JOBS_POLL_INTERVAL_SECONDS)
+
+
+def start_job_workers() -> None:
+    global _local_lease_task
+    # Los jobs en proceso existen aunque este worker no tome jobs durables
+    if _local_lease_task is None:
+        _local_lease_task = asyncio.create_task(_local_jobs_lease_loop())
+    if _worker_tasks or JOBS_WORKER_CONCURRENCY <= 0:
+        return
+    for n in range(JOBS_WORKER_CONCURRENCY):
+        _worker_tasks.append(asyncio.create_task(_worker_loop(n)))
+
+
+async def stop_job_workers() -> None:
+    global _local_lease_task
+    tasks = list(_worker_tasks)
+    if _local_lease_task is not None:
+        tasks.append(_local_lease_task)
+        _local_lease_task = None
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _worker_tasks.clear()
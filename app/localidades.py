@@ -0,0 +1,164 @@
+# app/localidades.py
+"""
+Índice de localidades (provincia + ciudad -> códigos INDEC) para las reglas de vigencia.
+
+El índice se precompila desde app/utils/localidades.json a app/utils/localidades.idx.pickle:
+
+    python app/localidades.py
+
+En runtime se carga el pickle (milisegundos) en el arranque. Si no existe o quedó viejo
+respecto del JSON (se guarda el sha256 del JSON de origen), se reconstruye desde el JSON
+y se intenta reescribir el archivo.
+
+Estructura: {provincia_normalizada: trie por palabras de la ciudad normalizada}, donde cada
+nodo es un dict palabra -> nodo y el valor vive bajo la key "" como (prov_id, loc_id).
+Así el fallback por prefijo más largo de palabras es un solo recorrido.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+import unicodedata
+
+log = logging.getLogger(__name__)
+
+_UTILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils")
+LOCALIDADES_JSON = os.path.join(_UTILS_DIR, "localidades.json")
+LOCALIDADES_INDEX = os.path.join(_UTILS_DIR, "localidades.idx.pickle")
+_FORMAT_VERSION = 1
+
+_index: dict | None = None
+
+
+def normalize_name(value: str | None) -> str:
+    if not value:
+        return ""
+    s = unicodedata.normalize("NFKD", str(value))
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = s.lower()
+    out = []
+    for ch in s:
+        if ch.isalnum() or ch.isspace():
+            out.append(ch)
+    s = "".join(out)
+    return " ".join(s.split())
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_index_from_json(json_path: str = LOCALIDADES_JSON) -> dict:
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    # Primero el mejor candidato por (provincia, ciudad) según prioridad del nombre
+    flat: dict[tuple[str, str], tuple[str, str, int]] = {}
+    for item in data.get("localidades", []):
+        prov_nombre = (item.get("provincia") or {}).get("nombre")
+        prov_id = (item.get("provincia") or {}).get("id")
+        loc_full_id = item.get("id")
+        loc_censal = item.get("localidad_censal") or {}
+        loc_id = loc_full_id or loc_censal.get("id")
+        prov_norm = normalize_name(prov_nombre)
+
+        candidates = (
+            (item.get("nombre"), 1),
+            ((item.get("municipio") or {}).get("nombre"), 2),
+            (loc_censal.get("nombre"), 3),
+            ((item.get("departamento") or {}).get("nombre"), 4),
+        )
+        for city_raw, priority in candidates:
+            key_city = normalize_name(city_raw)
+            if not (prov_norm and key_city and prov_id and loc_id):
+                continue
+            k = (prov_norm, key_city)
+            current = flat.get(k)
+            if current is None or priority < current[2]:
+                flat[k] = (prov_id, loc_id, priority)
+
+    provinces: dict[str, dict] = {}
+    for (prov_norm, city_norm), (prov_id, loc_id, _) in flat.items():
+        node = provinces.setdefault(prov_norm, {})
+        for word in city_norm.split():
+            node = node.setdefault(word, {})
+        node[""] = (prov_id, loc_id)
+    return provinces
+
+
+def write_index(provinces: dict, source_sha256: str, index_path: str = LOCALIDADES_INDEX) -> None:
+    tmp = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        pickle.dump(
+            {"version": _FORMAT_VERSION, "source_sha256": source_sha256, "provinces": provinces},
+            fh,
+            protocol=4,
+        )
+    os.replace(tmp, index_path)
+
+
+def _load_prebuilt(source_sha256: str) -> dict | None:
+    try:
+        with open(LOCALIDADES_INDEX, "rb") as fh:
+            payload = pickle.load(fh)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("Índice de localidades ilegible, se reconstruye: %s", e)
+        return None
+    if payload.get("version") != _FORMAT_VERSION or payload.get("source_sha256") != source_sha256:
+        return None
+    return payload["provinces"]
+
+
+def load_localidades_index() -> dict:
+    global _index
+    if _index is not None:
+        return _index
+    try:
+        source_sha256 = _file_sha256(LOCALIDADES_JSON)
+        provinces = _load_prebuilt(source_sha256)
+        if provinces is None:
+            log.info("Índice de localidades precompilado ausente o viejo, reconstruyendo desde JSON")
+            provinces = build_index_from_json()
+            try:
+                write_index(provinces, source_sha256)
+            except OSError as e:
+                log.warning("No se pudo guardar el índice de localidades: %s", e)
+        _index = provinces
+    except Exception as e:
+        log.warning("No se pudo cargar el índice de localidades: %s", e)
+        _index = {}
+    return _index
+
+
+def find_localidad_codes(province_name: str | None, city_name: str | None) -> tuple[str | None, str | None]:
+    """Match exacto de la ciudad o, si no, el prefijo de palabras más largo que exista."""
+    prov_norm = normalize_name(province_name)
+    city_norm = normalize_name(city_name)
+    if not prov_norm or not city_norm:
+        return None, None
+    node = load_localidades_index().get(prov_norm)
+    found = None
+    for word in city_norm.split():
+        if node is None:
+            break
+        node = node.get(word)
+        if node is not None and "" in node:
+            found = node[""]
+    if found is None:
+        return None, None
+    return found[0], found[1]
+
+
+if __name__ == "__main__":
+    json_path = sys.argv[1] if len(sys.argv) > 1 else LOCALIDADES_JSON
+    index = build_index_from_json(json_path)
+    write_index(index, _file_sha256(json_path))
+    print(f"Índice escrito en {LOCALIDADES_INDEX} ({len(index)} provincias, {os.path.getsize(LOCALIDADES_INDEX)} bytes)")
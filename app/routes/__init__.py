@@ -17,6 +17,8 @@ from .qr import qr_bp
 from .inspection_validity import inspection_validity_bp
 from .tickets import tickets_bp
 from .cron import cron_bp
+from .internal import internal_bp
+from .health import health_bp
 
 def register_routes(app):
     app.register_blueprint(auth_bp, url_prefix="/auth")
@@ -38,3 +40,5 @@ def register_routes(app):
     app.register_blueprint(inspection_validity_bp, url_prefix="/inspection_validity")
     app.register_blueprint(tickets_bp, url_prefix="/tickets")
     app.register_blueprint(cron_bp, url_prefix="/cron")
+    app.register_blueprint(internal_bp, url_prefix="/internal")
+    app.register_blueprint(health_bp, url_prefix="/health")
@@ -1,11 +1,10 @@
 # app/routes/application_documents.py
 from quart import Blueprint, request, jsonify, g
 from app.db import get_conn_ctx
-from app.supabase_client import SUPABASE_URL, get_supabase_client, supabase_dns_workaround
+from app.supabase_client import is_transient_storage_error, storage_public_url, storage_remove, storage_upload
 import os
 import uuid
 import re, unicodedata
-import time
 import logging
 
 docs_bp = Blueprint("application_documents", __name__)
@@ -24,58 +23,6 @@ ALLOWED_CAR_typeS = {
     "insurance_back",
 }
 
-def _public_url(bucket: str, path: str) -> str:
-    base = (SUPABASE_URL or "").rstrip("/")
-    return f"{base}/storage/v1/object/public/{bucket}/{path}"
-
-def _is_transient_storage_error(exc: Exception) -> bool:
-    error_msg = str(exc).lower()
-    error_type = type(exc).__name__.lower()
-    transient_markers = (
-        "temporary failure in name resolution",
-        "name resolution",
-        "connecterror",
-        "connectionerror",
-        "timed out",
-        "timeout",
-        "network is unreachable",
-        "connection reset",
-        "service unavailable",
-        "gateway timeout",
-    )
-    return any(marker in error_msg for marker in transient_markers) or any(
-        marker in error_type for marker in ("connecterror", "timeout", "connectionerror")
-    )
-
-def _upload_to_storage_with_retry(dest: str, data: bytes, content_type: str, max_retries: int = 3) -> None:
-    last_error = None
-    for attempt in range(1, max_retries + 1):
-        try:
-            with supabase_dns_workaround():
-                client = get_supabase_client()
-                client.storage.from_(BUCKET_DOCS).upload(
-                    path=dest,
-                    file=data,
-                    file_options={
-                        "content_type": content_type,
-                        "x-upsert": "true",
-                    },
-                )
-            return
-        except Exception as exc:
-            last_error = exc
-            if _is_transient_storage_error(exc) and attempt < max_retries:
-                backoff_seconds = 0.4 * (2 ** (attempt - 1))
-                log.warning(
-                    "Reintentando subida a storage (%s/%s) por error transitorio: %s",
-                    attempt,
-                    max_retries,
-                    exc,
-                )
-                time.sleep(backoff_seconds)
-                continue
-            raise last_error
-
 def _norm_role(raw: str | None) -> str:
     r = (raw or "").strip().lower()
     return r if r in {"owner", "driver", "car", "generic"} else "generic"
@@ -163,15 +110,15 @@ async def upload_documents(app_id: int):
         dest = f"apps/{app_id}/{role}/{type_segment}/{uuid.uuid4().hex}-{safe_name}"
 
         try:
-            _upload_to_storage_with_retry(
-                dest=dest,
-                data=data,
+            await storage_upload(
+                BUCKET_DOCS,
+                dest,
+                data,
                 content_type=f.mimetype or "application/octet-stream",
-                max_retries=3,
             )
         except Exception as e:
             error_msg = str(e)
-            status_code = 502 if _is_transient_storage_error(e) else 500
+            status_code = 502 if is_transient_storage_error(e) else 500
             if "JSONDecodeError" in error_msg or "Expecting value" in error_msg:
                 return jsonify({
                     "error": f"No se pudo subir el archivo {f.filename}. Error de comunicación con el almacenamiento."
@@ -180,7 +127,7 @@ async def upload_documents(app_id: int):
                 "error": f"No se pudo subir el archivo {f.filename}: {error_msg}"
             }), status_code
 
-        file_url = _public_url(BUCKET_DOCS, dest)
+        file_url = storage_public_url(BUCKET_DOCS, dest)
 
         async with get_conn_ctx() as conn:
             row = await conn.fetchrow("""
@@ -211,9 +158,7 @@ async def delete_document(app_id: int, doc_id: int):
         if not doc:
             return jsonify({"error": "Documento no encontrado"}), 404
 
-        with supabase_dns_workaround():
-            client = get_supabase_client()
-            client.storage.from_(doc["bucket"]).remove([doc["object_path"]])
+        await storage_remove(doc["bucket"], [doc["object_path"]])
 
         await conn.execute("DELETE FROM application_documents WHERE id = $1", doc_id)
 
@@ -691,7 +691,7 @@ async def list_full_applications_by_workshop(workshop_id: int):
 
     where_sql = " AND ".join(f"({f.strip()})" for f in filters)
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         total = await conn.fetchval(
             f"""
             SELECT COUNT(*)
@@ -1185,7 +1185,7 @@ async def list_completed_applications_by_workshop(workshop_id: int):
 
     where_sql = " AND ".join(f"({f.strip()})" for f in filters)
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         # Obtener total de registros
         total_count = await conn.fetchval(
             f"""
@@ -1356,7 +1356,7 @@ async def get_daily_statistics(workshop_id: int):
             argentina_tz = pytz.timezone('America/Argentina/Buenos_Aires')
             target_date = datetime.datetime.now(argentina_tz).date()
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             # 1. Estadísticas de aplicaciones del día (solo aplicaciones completas)
             app_stats = await conn.fetchrow(
                 """
@@ -1,40 +1,38 @@
 # app/routes/certificates.py
-from quart import Blueprint, request, jsonify, Response
+from quart import Blueprint, request, jsonify, Response, stream_with_context
 import os
 import io
 import fitz  # PyMuPDF
 import qrcode
-import requests
-from dateutil import tz
-from app.db import get_conn_ctx
-from datetime import datetime, timedelta
-import pytz
-from app.supabase_client import SUPABASE_URL, get_supabase_client, supabase_dns_workaround
-import textwrap
+from app.supabase_client import storage_fetch_url
+from app.bytes_cache import BytesLRUCache
+from app.image_variants import CERT_THUMB_SIZE, FRONT_PHOTO_CACHE, front_photo_cache_key, resize_image_bytes
 from fitz import PDF_REDACT_IMAGE_NONE, PDF_REDACT_LINE_ART_NONE, PDF_REDACT_TEXT_REMOVE
 import asyncio
 import json
-import unicodedata
-from calendar import monthrange
-import time
-from PIL import Image
+import zipfile
+import hashlib
+import threading
+from collections import OrderedDict
 
 try:
     fitz.TOOLS.mupdf_display_errors(False)
 except Exception:
     pass
 
-from app.jobs import new_job, get_job, run_job
-from app.email import send_certificate_email
+from app.jobs import new_job, get_job, set_status
+from app import certificate_renderer
+from app.admission import AdmissionRejected, CERT_GATE, RENDER_GATE, STORAGE_GATE
+from app.certificate_engine import CertificateEngine
+from app.db import request_conn
+from app.localidades import load_localidades_index
+from app.template_store import TEMPLATE_STORE, resolve_template_path
 import logging
 
 log = logging.getLogger(__name__)
 
 certificates_bp = Blueprint("certificates", __name__)
 
-# ---------- Supabase helpers ----------
-BUCKET_CERTS = os.getenv("SUPABASE_BUCKET_CERTS", "certificados")
-
 def _adjust_font_size_by_length(ph: str, base_size: float, value: str) -> float:
     s = base_size
     n = len(value or "")
@@ -69,98 +67,9 @@ def _adjust_font_size_by_length(ph: str, base_size: float, value: str) -> float:
         s *= 0.85
     return s
 
-def _valid_doc_value(v) -> bool:
-    """True si el valor es un documento válido (excluye None, '', 'None', 'null')."""
-    if v is None:
-        return False
-    s = str(v).strip()
-    return bool(s) and s.lower() not in ("none", "null")
-
 def _add_transparent_redaction(page: fitz.Page, rect: fitz.Rect):
     page.add_redact_annot(rect, text=None, fill=False, cross_out=False)
 
-def _upload_pdf_and_get_public_url(data: bytes, path: str, max_retries: int = 3) -> str:
-    """
-    Sube un PDF a Supabase Storage con reintentos en caso de errores SSL/conexión.
-    
-    Args:
-        data: Bytes del PDF a subir
-        path: Ruta donde guardar el archivo
-        max_retries: Número máximo de reintentos (default: 3)
-    
-    Returns:
-        URL pública del archivo subido
-    
-    Raises:
-        RuntimeError: Si no se pudo subir después de todos los reintentos
-    """
-    file_size_mb = len(data) / (1024 * 1024)
-    
-    last_error = None
-    # Optimización: reutilizar cliente Supabase
-    sb = None
-    
-    for attempt in range(max_retries):
-        try:
-            with supabase_dns_workaround():
-                if sb is None:
-                    sb = get_supabase_client()
-
-                upload_result = sb.storage.from_(BUCKET_CERTS).upload(
-                    file=data,
-                    path=path,
-                    file_options={"content-type": "application/pdf", "x-upsert": "true"},
-                )
-
-                res = sb.storage.from_(BUCKET_CERTS).get_public_url(path)
-            if isinstance(res, dict):
-                url = res.get("publicUrl") or res.get("public_url") or ""
-            else:
-                url = str(res)
-
-            if url:
-                return url
-            else:
-                raise RuntimeError("No se pudo obtener la URL pública del archivo subido")
-
-        except Exception as e:
-            last_error = e
-            error_msg = str(e).lower()
-            error_type = type(e).__name__
-            
-            is_transient_network_error = any(keyword in error_msg for keyword in [
-                "ssl", "eof", "protocol", "connection", "timeout", "broken pipe",
-                "_ssl.c", "ssl3", "tls", "socket", "errno", "closed", "reset",
-                "temporary failure in name resolution", "name resolution", "network is unreachable",
-                "service unavailable", "gateway timeout"
-            ]) or any(keyword in error_type.lower() for keyword in [
-                "sslerror", "connectionerror", "connecterror", "timeouterror", "readtimeout", "writetimeout"
-            ])
-            
-            if is_transient_network_error and attempt < max_retries - 1:
-                wait_time = (2 ** attempt) + 0.3  # Backoff exponencial corto para errores transitorios
-                log.warning(
-                    "Error transitorio subiendo certificado a storage (intento %s/%s): %s",
-                    attempt + 1,
-                    max_retries,
-                    e,
-                )
-                time.sleep(wait_time)
-                # Optimización: recrear cliente en caso de error de conexión
-                sb = None
-                continue
-            else:
-                raise
-    
-    raise RuntimeError(f"No se pudo subir el PDF después de {max_retries} intentos. Último error: {last_error}")
-
-async def _upload_pdf_and_get_public_url_async(data: bytes, path: str) -> str:
-    try:
-        return await asyncio.to_thread(_upload_pdf_and_get_public_url, data, path)
-    except Exception as e:
-        error_msg = str(e)
-        raise RuntimeError(f"Error al subir PDF a Supabase Storage: {error_msg}")
-
 # ---------- utilidades comunes ----------
 def _make_qr_bytes(text: str, box_size: int = 8, border: int = 1) -> bytes:
     # Optimización: usar versión más rápida sin fit para mejor rendimiento
@@ -174,36 +83,99 @@ def _make_qr_bytes(text: str, box_size: int = 8, border: int = 1) -> bytes:
     buf.seek(0)
     return buf.read()
 
+# El payload del QR es fijo por oblea: se cachea el PNG (o la matriz de módulos si se
+# dibuja vectorial). Vive en cada proceso de render. Sin el pool de procesos el render
+# corre en threads de asyncio.to_thread, por eso los dos caches van con lock (el QR se
+# genera fuera del lock).
+CERT_QR_VECTOR = os.getenv("CERT_QR_VECTOR", "0") == "1"
+_QR_BORDER = 1
+_QR_PNG_CACHE = BytesLRUCache("qr_png", max_bytes=int(os.getenv("CERT_QR_CACHE_KB", "2048")) * 1024)
+_QR_MATRIX_CACHE: "OrderedDict[str, tuple[tuple[bool, ...], ...]]" = OrderedDict()
+_QR_MATRIX_CACHE_MAX = int(os.getenv("CERT_QR_MATRIX_CACHE_SIZE", "512"))
+_QR_CACHE_LOCK = threading.Lock()
+
+def _get_qr_png(text: str) -> bytes:
+    with _QR_CACHE_LOCK:
+        qr_png = _QR_PNG_CACHE.get(text)
+    if qr_png is None:
+        qr_png = _make_qr_bytes(text, border=_QR_BORDER)
+        with _QR_CACHE_LOCK:
+            _QR_PNG_CACHE.put(text, qr_png)
+    return qr_png
+
+def _get_qr_matrix(text: str) -> tuple[tuple[bool, ...], ...]:
+    with _QR_CACHE_LOCK:
+        matrix = _QR_MATRIX_CACHE.get(text)
+        if matrix is not None:
+            _QR_MATRIX_CACHE.move_to_end(text)
+            return matrix
+    qr = qrcode.QRCode(border=_QR_BORDER, error_correction=qrcode.constants.ERROR_CORRECT_L)
+    qr.add_data(text)
+    qr.make(fit=True)
+    matrix = tuple(tuple(bool(v) for v in row) for row in qr.get_matrix())
+    with _QR_CACHE_LOCK:
+        _QR_MATRIX_CACHE[text] = matrix
+        while len(_QR_MATRIX_CACHE) > _QR_MATRIX_CACHE_MAX:
+            _QR_MATRIX_CACHE.popitem(last=False)
+    return matrix
+
+def _draw_qr_vector(page: fitz.Page, rect: fitz.Rect, matrix: tuple[tuple[bool, ...], ...]) -> None:
+    """Dibuja el QR como rectángulos vectoriales (sin PNG), un rect por tramo horizontal de módulos."""
+    n = len(matrix)
+    if not n:
+        return
+    module = min(rect.width, rect.height) / n
+    x0 = rect.x0 + (rect.width - module * n) / 2
+    y0 = rect.y0 + (rect.height - module * n) / 2
+    shape = page.new_shape()
+    # Fondo blanco (zona de silencio incluida), igual que el PNG
+    shape.draw_rect(fitz.Rect(x0, y0, x0 + module * n, y0 + module * n))
+    shape.finish(color=None, fill=(1, 1, 1), width=0)
+    for r, row in enumerate(matrix):
+        c = 0
+        while c < n:
+            if not row[c]:
+                c += 1
+                continue
+            start = c
+            while c < n and row[c]:
+                c += 1
+            shape.draw_rect(fitz.Rect(x0 + start * module, y0 + r * module, x0 + c * module, y0 + (r + 1) * module))
+    shape.finish(color=None, fill=(0, 0, 0), width=0)
+    shape.commit()
+
 async def _download_and_resize_image_async(image_url: str, target_width: int, target_height: int) -> bytes | None:
     """Descarga una imagen desde una URL y la redimensiona al tamaño especificado"""
-    def _download_and_resize() -> bytes | None:
+    try:
+        async with STORAGE_GATE.slot(wait=True):
+            data = await storage_fetch_url(image_url)
+        return await asyncio.to_thread(resize_image_bytes, data, target_width, target_height)
+    except Exception:
+        return None
+
+async def _load_front_photo_async(photo_doc) -> bytes | None:
+    """
+    Foto del frente para el recuadro del certificado. Usa el thumbnail generado al subir
+    la foto; las fotos anteriores al ingest de variantes caen al original + resize.
+    """
+    cache_key = front_photo_cache_key(photo_doc["file_url"], CERT_THUMB_SIZE)
+    cached = await FRONT_PHOTO_CACHE.aget(cache_key)
+    if cached is not None:
+        return cached
+
+    photo_png = None
+    thumb_url = photo_doc.get("thumb_url")
+    if thumb_url:
         try:
-            # Optimización: usar stream=True y timeout más corto
-            resp = requests.get(image_url, timeout=15, stream=True)
-            resp.raise_for_status()
-            
-            img = Image.open(io.BytesIO(resp.content))
-            
-            # Optimización: usar Resampling.NEAREST para imágenes pequeñas (más rápido)
-            # o mantener LANCZOS si se necesita mejor calidad
-            img_resized = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-            
-            if img_resized.mode in ('RGBA', 'LA', 'P'):
-                rgb_img = Image.new('RGB', img_resized.size, (255, 255, 255))
-                if img_resized.mode == 'P':
-                    img_resized = img_resized.convert('RGBA')
-                rgb_img.paste(img_resized, mask=img_resized.split()[-1] if img_resized.mode == 'RGBA' else None)
-                img_resized = rgb_img
-            
-            buf = io.BytesIO()
-            # Optimización: usar optimize=False para guardar más rápido
-            img_resized.save(buf, format="PNG", optimize=False)
-            buf.seek(0)
-            return buf.read()
+            async with STORAGE_GATE.slot(wait=True):
+                photo_png = await storage_fetch_url(thumb_url)
         except Exception as e:
-            return None
-    
-    return await asyncio.to_thread(_download_and_resize)
+            log.warning("No se pudo descargar el thumbnail %s, se usa el original: %s", thumb_url, e)
+    if photo_png is None:
+        photo_png = await _download_and_resize_image_async(photo_doc["file_url"], *CERT_THUMB_SIZE)
+    if photo_png is not None:
+        await FRONT_PHOTO_CACHE.aput(cache_key, photo_png)
+    return photo_png
 
 def _rect_almost_equal(r1: fitz.Rect, r2: fitz.Rect, tol: float = 0.1) -> bool:
     return (
@@ -516,7 +488,77 @@ def _to_upper(val) -> str:
         return ""
     return str(val).upper()
 
-def _replace_placeholders_transparente(doc: fitz.Document, mapping: dict[str, str], qr_png: bytes | None, photo_png: bytes | None = None, usage_type: str | None = None):
+# ---------- Layout precompilado de templates ----------
+# Todos los placeholders que puede llevar un certificado. El layout de cada template se
+# compila una sola vez contra este set completo, así el render no vuelve a recorrer spans.
+CERTIFICATE_PLACEHOLDERS = frozenset({
+    "${fecha_emision}", "${fecha_vencimiento}", "${fecha_em2}", "${fecha_vto}",
+    "${taller}", "${num_reg}", "${nombre_apellido}", "${nombre_apellido2}",
+    "${documento}", "${documento2}", "${domicilio}", "${f_localidad}", "${t_localidad}",
+    "${localidad2}", "${provincia}", "${provincia2}", "${patente}", "${patente2}",
+    "${anio}", "${marca}", "${modelo}", "${marca_motor}", "${numero_motor}",
+    "${combustible}", "${marca_chasis}", "${numero_chasis}", "${ced_tipo}", "${ced_tipo2}",
+    "${tipo_vehiculo}", "${resultado_inspeccion}", "${observaciones}", "${observaciones2}",
+    "${clasif}", "${resultado2}", "${crt_numero}", "${oblea_numero}", "${resultado_final}",
+    "${qr}", "${photo}",
+})
+
+CERTIFICATE_TEMPLATES = (
+    "certificado_base_apto.pdf",
+    "certificado_base_condicional.pdf",
+    "certificado_base_rechazado.pdf",
+    "photos/certificado_base_apto_photo.pdf",
+    "photos/certificado_base_condicional_photo.pdf",
+)
+
+# sha256 del template -> layout por página: [{placeholder: [{"rect": (x0, y0, x1, y1), "font", "size"}]}]
+_LAYOUT_CACHE: dict[str, list[dict[str, list[dict]]]] = {}
+
+def _template_digest(template_bytes: bytes) -> str:
+    # Los templates cacheados ya traen su hash calculado, evitamos re-hashear 1-2 MB por render
+    return TEMPLATE_STORE.digest_of(template_bytes) or hashlib.sha256(template_bytes).hexdigest()
+
+def _compile_template_layout(template_bytes: bytes) -> list[dict[str, list[dict]]]:
+    """
+    Recorre el template una vez y devuelve, por página, los rects, fuente y tamaño de
+    cada placeholder encontrado. Los rects se guardan como tuplas para poder serializarlos.
+    """
+    doc = fitz.open(stream=template_bytes, filetype="pdf")
+    try:
+        layout = []
+        for page in doc:
+            matches_map = _collect_all_placeholder_matches_with_style(page, set(CERTIFICATE_PLACEHOLDERS))
+            layout.append({
+                ph: [
+                    {"rect": tuple(m["rect"]), "font": m["font"], "size": float(m["size"])}
+                    for m in ms
+                ]
+                for ph, ms in matches_map.items()
+                if ms
+            })
+        return layout
+    finally:
+        try:
+            doc.close()
+        except Exception:
+            pass
+
+def _get_template_layout(template_bytes: bytes) -> list[dict[str, list[dict]]]:
+    digest = _template_digest(template_bytes)
+    layout = _LAYOUT_CACHE.get(digest)
+    if layout is None:
+        layout = _compile_template_layout(template_bytes)
+        _LAYOUT_CACHE[digest] = layout
+    return layout
+
+def _layout_page_matches(layout: list[dict[str, list[dict]]], page_num: int) -> dict[str, list[dict]]:
+    page_layout = layout[page_num] if page_num < len(layout) else {}
+    return {
+        ph: [{"rect": fitz.Rect(m["rect"]), "font": m["font"], "size": m["size"]} for m in ms]
+        for ph, ms in page_layout.items()
+    }
+
+def _replace_placeholders_transparente(doc: fitz.Document, mapping: dict[str, str], qr_png: bytes | None, photo_png: bytes | None = None, usage_type: str | None = None, layout: list[dict[str, list[dict]]] | None = None, qr_matrix: tuple[tuple[bool, ...], ...] | None = None):
     total_counts = {k: 0 for k in mapping.keys()}
     SIZE_MULTIPLIER = {
         "${fecha_em2}": 0.75,
@@ -536,25 +578,20 @@ def _replace_placeholders_transparente(doc: fitz.Document, mapping: dict[str, st
 
     # Optimización: pre-calcular ph_set una sola vez
     ph_set = set(list(mapping.keys()) + ["${qr}", "${photo}"])
+    has_qr = qr_png is not None or qr_matrix is not None
     has_photo_placeholder = "${photo}" in mapping
+    # El layout precompilado solo sirve si cubre todos los placeholders del mapping
+    if layout is not None and not ph_set <= CERTIFICATE_PLACEHOLDERS:
+        layout = None
 
     for page_num, page in enumerate(doc):
-        matches_map = _collect_all_placeholder_matches_with_style(page, ph_set)
+        if layout is not None:
+            matches_map = _layout_page_matches(layout, page_num)
+        else:
+            matches_map = _collect_all_placeholder_matches_with_style(page, ph_set)
         page_matches = {ph: matches_map.get(ph, []) for ph in mapping.keys() if matches_map.get(ph)}
-        qr_matches = matches_map.get("${qr}", []) if qr_png is not None else []
+        qr_matches = matches_map.get("${qr}", []) if has_qr else []
         photo_matches = matches_map.get("${photo}", []) if has_photo_placeholder else []
-        
-        # Debug: verificar si placeholders problemáticos están en el mapping pero no se encontraron
-        for ph_debug in ("${numero_motor}", "${numero_chasis}", "${fecha_emision}"):
-            if ph_debug in mapping and ph_debug not in page_matches:
-                # Intentar búsqueda manual para debug
-                try:
-                    debug_rects = page.search_for(ph_debug)
-                    if not debug_rects and ph_debug.startswith("${") and ph_debug.endswith("}"):
-                        ph_clean_debug = ph_debug[2:-1]
-                        debug_rects_clean = page.search_for(ph_clean_debug)
-                except Exception as e:
-                    pass
 
         # Optimización: acumular todas las redacciones antes de aplicar
         has_redactions = False
@@ -562,7 +599,7 @@ def _replace_placeholders_transparente(doc: fitz.Document, mapping: dict[str, st
             for m in ms:
                 _add_transparent_redaction(page, m["rect"])
                 has_redactions = True
-        if qr_png is not None and qr_matches:
+        if has_qr and qr_matches:
             for m in qr_matches:
                 _add_transparent_redaction(page, m["rect"])
                 has_redactions = True
@@ -582,10 +619,6 @@ def _replace_placeholders_transparente(doc: fitz.Document, mapping: dict[str, st
         for ph, ms in page_matches.items():
             raw_val = mapping.get(ph, "")
             val = _to_upper(raw_val)
-            
-            # Debug para placeholders problemáticos
-            if ph in ("${numero_motor}", "${numero_chasis}", "${fecha_emision}"):
-                pass
 
             for m in ms:
                 fontname = m["font"] if m["font"] in (
@@ -645,10 +678,13 @@ def _replace_placeholders_transparente(doc: fitz.Document, mapping: dict[str, st
                         pass
                 total_counts[ph] += 1
 
-        if qr_png is not None and qr_matches:
+        if has_qr and qr_matches:
             for m in qr_matches:
                 sq = _square_and_scale_rect(m["rect"], scale=1.5, page=page)
-                page.insert_image(sq, stream=qr_png, keep_proportion=True)
+                if qr_matrix is not None:
+                    _draw_qr_vector(page, sq, qr_matrix)
+                else:
+                    page.insert_image(sq, stream=qr_png, keep_proportion=True)
 
         if photo_matches:
             if photo_png is not None:
@@ -675,1566 +711,317 @@ def _replace_placeholders_transparente(doc: fitz.Document, mapping: dict[str, st
 
     return total_counts
 
-_TEMPLATE_CACHE: dict[str, tuple[float, bytes]] = {}
-_TEMPLATE_TTL_SECONDS = 3600  # Optimización: aumentar TTL a 1 hora (era 10 minutos)
+def _read_template_file(template_path: str) -> memoryview:
+    try:
+        return TEMPLATE_STORE.get(template_path)[0]
+    except FileNotFoundError:
+        raise RuntimeError(f"No se pudo leer el template desde {template_path}: Template no encontrado: {resolve_template_path(template_path)}")
+    except Exception as e:
+        raise RuntimeError(f"No se pudo leer el template desde {template_path}: {e}")
 
-async def _get_template_bytes_async(template_path: str, max_retries: int = 3) -> bytes:
+async def _get_template_bytes_async(template_path: str, max_retries: int = 3) -> memoryview:
     """
-    Lee el template PDF desde archivos locales.
+    Lee el template PDF desde archivos locales (app/template_store.py: queda en memoria y se
+    relee solo si el archivo cambió).
     
     Args:
         template_path: Ruta del archivo template (relativa a app/utils/templates o absoluta)
         max_retries: Número máximo de reintentos (default: 3, no usado pero mantenido para compatibilidad)
     
     Returns:
-        Bytes del template PDF
+        Bytes del template PDF (memoryview de solo lectura sobre el mmap del archivo)
     
     Raises:
         RuntimeError: Si no se pudo leer el archivo
     """
-    now = time.time()
-    cached = _TEMPLATE_CACHE.get(template_path)
-    if cached and (now - cached[0] < _TEMPLATE_TTL_SECONDS):
-        return cached[1]
+    # Camino normal: un os.stat, sin lecturas
+    cached = TEMPLATE_STORE.cached(template_path)
+    if cached is not None and cached[1] in _LAYOUT_CACHE:
+        return cached[0]
     
-    def _read_file() -> bytes:
+    def _read_and_compile() -> memoryview:
+        data = _read_template_file(template_path)
+        digest = TEMPLATE_STORE.digest_of(data) or hashlib.sha256(data).hexdigest()
+        # Compilar el layout junto con la lectura para que el render vaya directo a redactar
+        if digest not in _LAYOUT_CACHE:
+            _LAYOUT_CACHE[digest] = _compile_template_layout(data)
+        return data
+
+    return await asyncio.to_thread(_read_and_compile)
+
+async def _precompile_template_layouts() -> None:
+    """Carga todos los templates de certificado y compila sus layouts."""
+    for template_path in CERTIFICATE_TEMPLATES:
         try:
-            # Si es una ruta relativa, construir la ruta completa desde app/utils/templates
-            if not os.path.isabs(template_path):
-                # Obtener el directorio base del proyecto (donde está app/)
-                base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-                full_path = os.path.join(base_dir, "app", "utils", "templates", template_path)
-            else:
-                full_path = template_path
-            
-            # Normalizar la ruta para evitar problemas con separadores
-            full_path = os.path.normpath(full_path)
-            
-            if not os.path.exists(full_path):
-                raise FileNotFoundError(f"Template no encontrado: {full_path}")
-            
-            with open(full_path, "rb") as f:
-                data = f.read()
-            
-            if not data:
-                raise RuntimeError("Template está vacío")
-            
-            return data
-            
+            await _get_template_bytes_async(template_path)
         except Exception as e:
-            raise RuntimeError(f"No se pudo leer el template desde {template_path}: {e}")
-    
-    data = await asyncio.to_thread(_read_file)
-    _TEMPLATE_CACHE[template_path] = (now, data)
-    return data
+            log.warning("No se pudo precompilar el layout de %s: %s", template_path, e)
+
+async def _load_localidades_index_async() -> None:
+    # Antes se parseaba el JSON de 2.3 MB en el primer certificado de cada worker
+    await asyncio.to_thread(load_localidades_index)
 
-def _render_certificate_pdf_sync(template_bytes: bytes, mapping: dict[str, str], qr_link: str, photo_png: bytes | None = None, usage_type: str | None = None) -> tuple[bytes, dict]:
+async def _warmup_render(renders: int = 1) -> None:
+    """
+    Renders de prueba (sin base ni Storage) para inicializar fuentes y estado de MuPDF,
+    en el proceso o en los workers del renderer.
+    """
+    template_path = CERTIFICATE_TEMPLATES[0]
+    template_bytes = await _get_template_bytes_async(template_path)
+    mapping = {ph: "WARMUP" for ph in CERTIFICATE_PLACEHOLDERS if ph not in ("${qr}", "${photo}")}
+    await asyncio.gather(*[
+        _render_certificate_pdf_async(template_bytes, mapping, "https://www.checkrto.com/qr/WARMUP", None, None, template_path)
+        for _ in range(max(1, renders))
+    ])
+
+def _render_certificate_pdf_sync(template_bytes: bytes, mapping: dict[str, str], qr_link: str, photo_png: bytes | None = None, usage_type: str | None = None, layout: list[dict[str, list[dict]]] | None = None) -> tuple[memoryview, dict]:
+    """
+    Devuelve el PDF como vista de solo lectura sobre el buffer donde lo escribió MuPDF, sin
+    copiarlo: la misma vista la comparten la respuesta HTTP, la cache y el job de subida.
+    """
     doc = fitz.open(stream=template_bytes, filetype="pdf")
     try:
-        # Optimización: generar QR antes de abrir el documento para paralelizar mejor
-        qr_png = _make_qr_bytes(qr_link)
-        counts = _replace_placeholders_transparente(doc, mapping, qr_png, photo_png, usage_type)
+        if CERT_QR_VECTOR:
+            qr_png, qr_matrix = None, _get_qr_matrix(qr_link)
+        else:
+            qr_png, qr_matrix = _get_qr_png(qr_link), None
+        if layout is None:
+            layout = _get_template_layout(template_bytes)
+        counts = _replace_placeholders_transparente(doc, mapping, qr_png, photo_png, usage_type, layout, qr_matrix)
         # Optimización: usar garbage=2 en lugar de 4 para mejor rendimiento (4 es muy agresivo)
         out_buf = io.BytesIO()
         doc.save(out_buf, garbage=2, deflate=True)
-        pdf_bytes = out_buf.getvalue()
-        return pdf_bytes, counts
+        return out_buf.getbuffer().toreadonly(), counts
     finally:
         try:
             doc.close()
         except Exception:
             pass
 
-async def _render_certificate_pdf_async(template_bytes: bytes, mapping: dict[str, str], qr_link: str, photo_png: bytes | None = None, usage_type: str | None = None) -> tuple[bytes, dict]:
-    return await asyncio.to_thread(_render_certificate_pdf_sync, template_bytes, mapping, qr_link, photo_png, usage_type)
-
-def _fmt_date(dt) -> str | None:
-    if not dt:
-        return None
-    try:
-        z = tz.gettz("America/Argentina/Cordoba")
-        d = dt.astimezone(z) if hasattr(dt, "astimezone") else dt
-    except Exception:
-        d = dt
-    return f"{d:%d-%m-%Y}"
-
-def _years_delta(base_dt: datetime, years: int) -> datetime:
-    try:
-        return base_dt.replace(year=base_dt.year + years)
-    except ValueError:
-        return base_dt + timedelta(days=365 * years)
-
-_LOCALIDADES_INDEX = None 
-
-def _normalize_name(value: str | None) -> str:
-    if not value:
-        return ""
-    s = unicodedata.normalize("NFKD", str(value))
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    s = s.lower()
-    out = []
-    for ch in s:
-        if ch.isalnum() or ch.isspace():
-            out.append(ch)
-    s = "".join(out)
-    return " ".join(s.split())
-
-def _build_localidades_index():
-    global _LOCALIDADES_INDEX
-    if _LOCALIDADES_INDEX is not None:
-        return _LOCALIDADES_INDEX
-
-    try:
-        json_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "utils", "localidades.json")
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        localidades = data.get("localidades", [])
-        index = {}
-        for item in localidades:
-            prov_nombre = (item.get("provincia") or {}).get("nombre")
-            prov_id = (item.get("provincia") or {}).get("id")
-            loc_full_id = item.get("id")
-            loc_censal = item.get("localidad_censal") or {}
-            loc_censal_nombre = loc_censal.get("nombre")
-            loc_censal_id = loc_censal.get("id")
-
-            nombre = item.get("nombre")
-            municipio_nombre = (item.get("municipio") or {}).get("nombre")
-            dpto_nombre = (item.get("departamento") or {}).get("nombre")
-
-            prov_norm = _normalize_name(prov_nombre)
-
-            def register_candidate(city_raw, priority: int):
-                key_city = _normalize_name(city_raw)
-                if not (prov_norm and key_city and prov_id and (loc_full_id or loc_censal_id)):
-                    return
-                k = (prov_norm, key_city)
-                candidate = (prov_id, (loc_full_id or loc_censal_id), priority)
-                if k not in index:
-                    index[k] = candidate
-                else:
-                    _, _, current_pr = index[k]
-                    if priority < current_pr:
-                        index[k] = candidate
-
-            register_candidate(nombre, 1)
-            register_candidate(municipio_nombre, 2)
-            register_candidate(loc_censal_nombre, 3)
-            register_candidate(dpto_nombre, 4)
-        _LOCALIDADES_INDEX = index
-    except Exception:
-        _LOCALIDADES_INDEX = {}
-    return _LOCALIDADES_INDEX
-
-def _find_localidad_codes(province_name: str | None, city_name: str | None) -> tuple[str | None, str | None]:
-    index = _build_localidades_index()
-    prov_norm = _normalize_name(province_name)
-    city_norm = _normalize_name(city_name)
-    if not prov_norm or not city_norm:
-        return None, None
-    if (prov_norm, city_norm) in index:
-        val = index[(prov_norm, city_norm)]
-        return val[0], val[1]
-    parts = city_norm.split()
-    for i in range(len(parts), 0, -1):
-        cand = " ".join(parts[:i])
-        if (prov_norm, cand) in index:
-            val = index[(prov_norm, cand)]
-            return val[0], val[1]
-    return None, None
-
-def _add_months(base_dt: datetime, months: int) -> datetime:
-    if months is None:
-        return base_dt
-    y = base_dt.year + (base_dt.month - 1 + months) // 12
-    m = (base_dt.month - 1 + months) % 12 + 1
-    last_day = monthrange(y, m)[1]
-    d = min(base_dt.day, last_day)
-    try:
-        return base_dt.replace(year=y, month=m, day=d)
-    except ValueError:
-        return base_dt + timedelta(days=30 * months)
-
-def _months_since_registration_year(base_dt: datetime, registration_year: int) -> int:
-    """Calcula la cantidad de meses desde enero del año de patentamiento hasta la fecha base."""
-    try:
-        # Crear fecha de referencia: 1 de enero del año de patentamiento
-        if hasattr(base_dt, 'tzinfo') and base_dt.tzinfo is not None:
-            registration_start = datetime(registration_year, 1, 1, tzinfo=base_dt.tzinfo)
-        else:
-            registration_start = datetime(registration_year, 1, 1)
-        
-        # Calcular diferencia en años y meses
-        years_diff = base_dt.year - registration_start.year
-        months_diff = base_dt.month - registration_start.month
-        
-        # Total de meses transcurridos
-        total_months = years_diff * 12 + months_diff
-        
-        return max(0, total_months)
-    except Exception:
-        return 0
-
-def _parse_spanish_month(value) -> int | None:
-    if value is None:
-        return None
-    if isinstance(value, int):
-        if 1 <= value <= 12:
-            return value
-        return None
-    s = _normalize_name(str(value))
-    mapping = {
-        "enero": 1,
-        "febrero": 2,
-        "marzo": 3,
-        "abril": 4,
-        "mayo": 5,
-        "junio": 6,
-        "julio": 7,
-        "agosto": 8,
-        "septiembre": 9,
-        "octubre": 10,
-        "noviembre": 11,
-        "diciembre": 12
+async def _render_certificate_pdf_async(template_bytes: bytes, mapping: dict[str, str], qr_link: str, photo_png: bytes | None = None, usage_type: str | None = None, template_path: str | None = None) -> tuple[bytes | memoryview, dict]:
+    async with RENDER_GATE.slot():
+        # Con el pool de procesos activo, el worker ya tiene el template y su layout precargados
+        if template_path and certificate_renderer.is_enabled():
+            return await certificate_renderer.render(template_path, mapping, qr_link, photo_png, usage_type)
+        return await asyncio.to_thread(_render_certificate_pdf_sync, template_bytes, mapping, qr_link, photo_png, usage_type)
+
+CERT_RESPONSE_CHUNK_BYTES = int(os.getenv("CERT_RESPONSE_CHUNK_KB", "64")) * 1024
+
+def _pdf_response(pdf: bytes | memoryview, file_name: str) -> Response:
+    """Respuesta en bloques sobre el mismo buffer del PDF (solo se copia cada bloque al enviarlo)."""
+    view = memoryview(pdf)
+
+    async def _chunks():
+        for offset in range(0, len(view), CERT_RESPONSE_CHUNK_BYTES):
+            yield bytes(view[offset:offset + CERT_RESPONSE_CHUNK_BYTES])
+
+    return Response(
+        _chunks(),
+        mimetype='application/pdf',
+        headers={
+            'Content-Disposition': f'inline; filename="{file_name}"',
+            'Content-Type': 'application/pdf',
+            'Content-Length': str(len(view))
         }
-    return mapping.get(s, None)
-
-async def _calc_vencimiento_from_rules(
-    fecha_emision_dt: datetime | None,
-    province_name: str | None,
-    city_name: str | None,
-    usage_code: str | None,
-    registration_year: int | None,
-    now_tz: pytz.BaseTzInfo,
-) -> datetime | None:
-    if not fecha_emision_dt:
-        return None
-
-    base = fecha_emision_dt.astimezone(now_tz) if hasattr(fecha_emision_dt, "astimezone") else fecha_emision_dt
-    prov_code, loc_key = _find_localidad_codes(province_name, city_name)
-    usage = (usage_code or "").strip().upper() or None
-
-    if not usage or not registration_year:
-        return None
-
-    rule = None
-    try:
-        if prov_code and loc_key:
-            async with get_conn_ctx() as conn:
-                rule = await conn.fetchrow(
-                    """
-                    SELECT localidad_key, usage_code, up_to_36_months, from_3_to_7_years, over_7_years
-                    FROM inspection_validity_rules
-                    WHERE (localidad_key = $1 OR localidad_key LIKE ($1 || '%'))
-                    ORDER BY 
-                      CASE WHEN usage_code = $2 THEN 0
-                           WHEN usage_code = 'C' THEN 1
-                           ELSE 2 END,
-                      CASE WHEN localidad_key = $1 THEN 0 ELSE 1 END,
-                      localidad_key
-                    LIMIT 1
-                    """,
-                    str(loc_key),
-                    usage,
-                )
-        else:
-            pass
-    except Exception as e:
-        rule = None
-
-    try:
-        elapsed_months = _months_since_registration_year(base, int(registration_year))
-    except Exception:
-        return None
-    elapsed_years = elapsed_months // 12
-
-    default_up_to_36 = 36  
-    default_from_3_to_7 = 24 
-    default_over_7 = 12
-
-    if rule:
-        up_to_36 = rule["up_to_36_months"]
-        from_3_to_7 = rule["from_3_to_7_years"]
-        over_7 = rule["over_7_years"]
-    else:
-        up_to_36 = default_up_to_36
-        from_3_to_7 = default_from_3_to_7
-        over_7 = default_over_7
-
-    if elapsed_months <= 35 and up_to_36:
-        vto_dt = _add_months(base, int(up_to_36))
-        return vto_dt
-
-    if 3 <= elapsed_years <= 7 and from_3_to_7:
-        vto_dt = _add_months(base, int(from_3_to_7))
-        return vto_dt
-
-    if elapsed_years > 7 and over_7:
-        vto_dt = _add_months(base, int(over_7))
-        return vto_dt
-
-    return None
-
-def _calc_vencimiento_fallback_dt(fecha_emision_dt: datetime | None, car_year: int | None, now_tz: pytz.BaseTzInfo) -> datetime | None:
-    if not fecha_emision_dt:
-        return None
-    base = fecha_emision_dt.astimezone(now_tz) if hasattr(fecha_emision_dt, "astimezone") else fecha_emision_dt
-    try:
-        cy = datetime.now(now_tz).year
-        age = None if not car_year else max(0, cy - int(car_year))
-    except Exception:
-        age = None
-    if age is None:
-        delta_years = 1
-    elif age == 0:
-        delta_years = 3
-    elif 3 <= age <= 7:
-        delta_years = 2
-    elif age > 7:
-        delta_years = 1
-    else:
-        delta_years = 1
-    return _years_delta(base, delta_years)
-
-
-def _calc_vencimiento(fecha_emision_dt: datetime | None, car_year: int | None, now_tz: pytz.BaseTzInfo) -> str | None:
-    if not fecha_emision_dt:
-        return None
-    base = fecha_emision_dt.astimezone(now_tz) if hasattr(fecha_emision_dt, "astimezone") else fecha_emision_dt
-    hoy = datetime.now(now_tz)
-    try:
-        cy = hoy.year
-        age = None if not car_year else max(0, cy - int(car_year))
-    except Exception:
-        age = None
-    if age is None:
-        delta_years = 1
-    elif age == 0:
-        delta_years = 3
-    elif 3 <= age <= 7:
-        delta_years = 2
-    elif age > 7:
-        delta_years = 1
-    else:
-        delta_years = 1
-    vto_dt = _years_delta(base, delta_years)
-    return _fmt_date(vto_dt)
-
-VEHICLE_TYPE_LABELS = {
-    "L":  "Vehículo automotor con menos de CUATRO (4) ruedas",
-    "L1": "2 Ruedas, Menos de 50 CM3, Menos de 40 KM/H",
-    "L2": "3 Ruedas, Menos de 50 CM3, Menos de 40 KM/H",
-    "L3": "2 Ruedas, Más de 50 CM3, Más de 40 KM/H",
-    "L4": "3 Ruedas, Más de 50 CM3, Más de 40 KM/H",
-    "L5": "3 Ruedas, Más de 50 CM3, Más de 40 KM/H",
-    "M":  "Vehículo automotor con por lo menos 4 ruedas, o 3 de más de 1.000 KG",
-    "M1": "Hasta 8 plazas más conductor y menos de 3.500 KG",
-    "M2": "Más de 8 plazas excluido conductor y hasta 5.000 KG",
-    "M3": "Más de 8 plazas excluido conductor y más de 5.000 KG",
-    "N":  "Vehículo automotor con por lo menos 4 ruedas, o 3 de más de 1.000 KG",
-    "N1": "Hasta 3.500 KG",
-    "N2": "Desde 3.500 KG hasta 12.000 KG",
-    "N3": "Más de 12.000 KG",
-    "O":  "Acoplados y semirremolques",
-    "O1": "Acoplados, semirremolques hasta 750 KG",
-    "O2": "Acoplados, semirremolques desde 750 KG hasta 3.500 KG",
-    "O3": "Acoplados, semirremolques de más de 3.500 KG y hasta 10.000 KG",
-    "O4": "Acoplados, semirremolques de más de 10.000 KG",
-}
-
-USAGE_TYPE_LABELS = {
-    "A":  "Oficial",
-    "B":  "Diplomático, Consular u Org. Internacional",
-    "C":  "Particular",
-    "D":  "De alquiler, alquiler con chofer, Taxi, Remis",
-    "E":  "Transporte público de pasajeros",
-    "E1": "Servicio internacional, regular y turismo, larga distancia y urbanos cat. M1, M2, M3",
-    "E2": "Interjurisdiccional y jurisdiccional, regulares, turismo cat. M1, M2, M3",
-    "F":  "Transporte escolar",
-    "G":  "Cargas, generales, peligrosas, recolección, carretones, servicios industriales y trabajos sobre la vía pública",
-    "H":  "Emergencia, seguridad, fúnebres, remolque, maquinaria especial o agrícola y trabajos sobre la vía pública",
-}
-
-def _vehicle_type_display(code: str | None) -> str:
-    c = (code or "").strip().upper()
-    if not c:
-        return ""
-    label = VEHICLE_TYPE_LABELS.get(c, "")
-    return f"{c} - {label}" if label else c
-
-def _usage_type_display(code: str | None) -> str:
-    c = (code or "").strip().upper()
-    if not c:
-        return ""
-    label = USAGE_TYPE_LABELS.get(c, "")
-    return f"{c} - {label}" if label else c
-
-def _wrap_to_width(text: str, width: int = 35) -> str:
-    lines = []
-    for part in (text or "").splitlines():
-        if not part:
-            lines.append("")
-            continue
-        wrapped = textwrap.wrap(part, width=width, break_long_words=False, break_on_hyphens=False)
-        lines.extend(wrapped if wrapped else [""])
-    return "\n".join(lines)
+    )
 
 @certificates_bp.route("/certificates/application/<int:app_id>/generate", methods=["POST"])
+@request_conn
 async def certificates_generate_by_application(app_id: int):
     payload = await request.get_json() or {}
     
-    # Generar PDF inmediatamente
+    # Generar PDF inmediatamente. Datos, estado y encolado usan una misma conexión (@request_conn).
+    # CERT_GATE acota los certificados en curso para que un pico
+    # no agote el pool de la base ni el renderer (rechaza rápido con 503 si está lleno).
     try:
-        pdf_bytes, file_name, metadata = await _generate_pdf_only(app_id, payload)
-        
-        # Programar subida a Supabase y actualizaciones de BD en segundo plano (sin bloquear la respuesta)
-        async def upload_and_update_background():
-            try:
-                storage_path = f"certificados/{app_id}/{file_name}"
-                public_url = await _upload_pdf_and_get_public_url_async(pdf_bytes, storage_path)
-                await _update_application_background(app_id, pdf_bytes, file_name, metadata, payload, public_url)
-            except Exception as e:
-                log.exception("Error en subida/actualización en segundo plano para aplicación %s: %s", app_id, e)
-        
-        asyncio.create_task(upload_and_update_background())
+        async with CERT_GATE.slot():
+            # La subida a Supabase y las actualizaciones de BD quedan encoladas (sin bloquear la respuesta)
+            pdf_bytes, file_name, metadata = await ENGINE.generate(app_id, payload)
         
         # Debug: log del tamaño del PDF
         log.info("Devolviendo PDF para aplicación %s, tamaño: %d bytes, nombre: %s", app_id, len(pdf_bytes), file_name)
         
         # Devolver PDF directamente para visualización/descarga inmediata
-        return Response(
-            pdf_bytes,
-            mimetype='application/pdf',
-            headers={
-                'Content-Disposition': f'inline; filename="{file_name}"',
-                'Content-Type': 'application/pdf',
-                'Content-Length': str(len(pdf_bytes))
-            }
-        )
+        return _pdf_response(pdf_bytes, file_name)
+    except AdmissionRejected as e:
+        log.warning("Admisión rechazada (%s), rechazando certificado para aplicación %s", e.gate, app_id)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         log.exception("Error generando certificado para aplicación %s: %s", app_id, e)
         return jsonify({"error": str(e)}), 500
 
-@certificates_bp.route("/certificates/job/<job_id>", methods=["GET"])
-async def certificates_job_status(job_id: str):
-    j = get_job(job_id)
-    if not j:
-        return jsonify({"error": "job_id no encontrado"}), 404
-    return jsonify(j), 200
+# ---------- GENERACIÓN POR LOTE ----------
+CERT_BATCH_MAX_ITEMS = int(os.getenv("CERT_BATCH_MAX_ITEMS", "200"))
+CERT_BATCH_CONCURRENCY = int(os.getenv("CERT_BATCH_CONCURRENCY", "4"))
+CERT_BATCH_ADMISSION_RETRIES = int(os.getenv("CERT_BATCH_ADMISSION_RETRIES", "5"))
 
-# ---------- FUNCIÓN AUXILIAR PARA ACTUALIZAR ESTADO A COMPLETADO ----------
-async def _update_application_status_to_completed(app_id: int, resultado: str, is_second_inspection: bool, max_retries: int = 3) -> None:
-    """
-    Actualiza el estado de la aplicación a "Completado" con transacción explícita,
-    verificación y reintentos para asegurar que siempre se actualice correctamente.
-    
-    Args:
-        app_id: ID de la aplicación
-        resultado: Resultado de la inspección
-        is_second_inspection: Si es segunda inspección
-        max_retries: Número máximo de reintentos (default: 3)
-    
-    Raises:
-        RuntimeError: Si no se pudo actualizar después de todos los reintentos
-    """
-    update_success = False
-    last_error = None
-    
-    for attempt in range(max_retries):
-        try:
-            async with get_conn_ctx() as conn:
-                # Usar transacción explícita para asegurar atomicidad
-                async with conn.transaction():
-                    if is_second_inspection:
-                        updated_row = await conn.fetchrow(
-                            """
-                            UPDATE applications
-                            SET status = $1,
-                                result_2 = $2
-                            WHERE id = $3
-                            RETURNING id, status, result_2
-                            """,
-                            "Completado",
-                            resultado,
-                            app_id,
-                        )
-                    else:
-                        updated_row = await conn.fetchrow(
-                            """
-                            UPDATE applications
-                            SET status = $1,
-                                result = $2
-                            WHERE id = $3
-                            RETURNING id, status, result
-                            """,
-                            "Completado",
-                            resultado,
-                            app_id,
-                        )
-                    
-                    # Verificar que la actualización se completó correctamente
-                    if updated_row and updated_row["status"] == "Completado":
-                        update_success = True
-                        log.info("Estado actualizado a 'Completado' para aplicación %s (intento %d/%d)", app_id, attempt + 1, max_retries)
-                        break
-                    else:
-                        last_error = RuntimeError(f"Actualización no confirmada: estado={updated_row['status'] if updated_row else 'None'}")
-                        log.warning("Actualización no confirmada para aplicación %s (intento %d/%d)", app_id, attempt + 1, max_retries)
-        except Exception as e:
-            last_error = e
-            log.warning("Error actualizando estado de aplicación %s (intento %d/%d): %s", app_id, attempt + 1, max_retries, e)
-            if attempt < max_retries - 1:
-                # Esperar un poco antes de reintentar (backoff exponencial)
-                await asyncio.sleep(0.5 * (2 ** attempt))
-                continue
-    
-    # Si después de todos los reintentos no se pudo actualizar, lanzar error
-    if not update_success:
-        log.error("No se pudo actualizar el estado a 'Completado' para aplicación %s después de %d intentos", app_id, max_retries)
-        raise RuntimeError(f"PDF generado, no se pudo actualizar el estado del trámite después de {max_retries} intentos: {last_error}")
-
-# ---------- FUNCIÓN PARA GENERAR SOLO EL PDF (SIN SUBIR) ----------
-async def _generate_pdf_only(app_id: int, payload: dict) -> tuple[bytes, str, dict]:
-    """
-    Genera solo el PDF del certificado sin subirlo ni actualizar la BD.
-    Retorna: (pdf_bytes, file_name, metadata)
-    """
-    condicion_raw = (payload.get("condicion") or "Apto").strip().lower()
-    cond_map = {"apto": "Apto", "condicional": "Condicional", "rechazado": "Rechazado"}
-    condicion = cond_map.get(condicion_raw, "Apto")
-    
-    templates_por_cond = {
-        "apto": "certificado_base_apto.pdf",
-        "condicional": "certificado_base_condicional.pdf",
-        "rechazado": "certificado_base_rechazado.pdf",
-    }
-    templates_por_cond_with_photo = {
-        "apto": "photos/certificado_base_apto_photo.pdf",
-        "condicional": "photos/certificado_base_condicional_photo.pdf",
-        "rechazado": "certificado_base_rechazado.pdf",
-    }
-    
-    usage_type = None
-    needs_photo_template = False
-    photo_png = None
-    template_url = None  
-    insp = None  
-    step_obs_rows = []
-    
-    async with get_conn_ctx() as conn:
-        row = await conn.fetchrow(
-            """
-            SELECT
-            a.id AS application_id,
-            a.date AS app_date,
-            a.status AS app_status,
-            a.result AS app_result,
-            a.workshop_id AS workshop_id,
-
-            o.first_name AS owner_first_name,
-            o.last_name  AS owner_last_name,
-            o.dni        AS owner_dni,
-            o.cuit       AS owner_cuit,
-            o.passport_number AS owner_passport_number,
-            o.razon_social AS owner_razon_social,
-            o.street     AS owner_street,
-            o.city       AS owner_city,
-            o.province   AS owner_province,
-            o.email      AS owner_email,
-            d.first_name AS driver_first_name,
-            d.last_name  AS driver_last_name,
-            d.dni        AS driver_dni,
-            d.cuit       AS driver_cuit,
-            d.passport_number AS driver_passport_number,
-
-            c.license_plate    AS car_plate,
-            c.brand            AS car_brand,
-            c.model            AS car_model,
-            c.manufacture_year AS car_year,
-            c.registration_year AS car_registration_year,
-            c.engine_brand     AS engine_brand,
-            c.engine_number    AS engine_number,
-            c.chassis_brand    AS chassis_brand,
-            c.chassis_number   AS chassis_number,
-            c.fuel_type        AS fuel_type,
-            c.insurance        AS insurance,
-            c.vehicle_type     AS vehicle_type,
-            c.usage_type       AS usage_type,
-            c.type_ced         AS car_type_ced,
-
-            ws.razon_social AS workshop_name,
-            ws.plant_number AS workshop_plant_number,
-            ws.province      AS workshop_province,
-            ws.city          AS workshop_city,
-
-            s.id AS sticker_id,
-            s.sticker_number AS sticker_number
-            FROM applications a
-            LEFT JOIN persons   o  ON o.id  = a.owner_id
-            LEFT JOIN persons   d  ON d.id  = a.driver_id
-            LEFT JOIN cars      c  ON c.id  = a.car_id
-            LEFT JOIN workshop  ws ON ws.id = a.workshop_id
-            LEFT JOIN stickers  s  ON s.id  = c.sticker_id
-            WHERE a.id = $1
-            """,
-            app_id
-        )
-        if not row:
-            raise RuntimeError("Trámite no encontrado")
-        
-        usage_type = (row.get("usage_type") or "").strip().upper()
-        needs_photo_template = (usage_type == "D" and condicion_raw in ("apto", "condicional"))
-        
-        if needs_photo_template:
-            template_url = templates_por_cond_with_photo.get(condicion_raw, templates_por_cond_with_photo["apto"])
-        else:
-            template_url = templates_por_cond.get(condicion_raw, templates_por_cond["apto"])
-    
-        if not template_url:
-            template_url = templates_por_cond.get(condicion_raw, templates_por_cond["apto"])
-
-        # Optimización: ejecutar consultas en paralelo cuando sea posible
-        insp = await conn.fetchrow(
-            """
-            SELECT
-                i.id,
-                i.global_observations,
-                i.created_at,
-                COALESCE(i.is_second, FALSE) AS is_second
-            FROM inspections i
-            WHERE i.application_id = $1
-            ORDER BY i.id DESC
-            LIMIT 1
-            """,
-            app_id
-        )
-
-        # Ejecutar consultas secuencialmente (asyncpg no permite paralelismo en la misma conexión)
-        step_obs_rows = []
-        photo_doc = None
-        
-        if insp:
-            step_obs_rows = await conn.fetch(
-                """
-                SELECT
-                  COALESCE(st.name, '')    AS step_name,
-                  o.description            AS obs_desc,
-                  COALESCE(so.number,999)  AS step_order,
-                  o.id                     AS obs_id
-                FROM observation_details od
-                JOIN inspection_details idet ON idet.id = od.inspection_detail_id
-                JOIN observations o          ON o.id    = od.observation_id
-                LEFT JOIN steps st           ON st.id   = o.step_id
-                LEFT JOIN steps_order so     ON so.step_id = st.id
-                                             AND so.workshop_id = $2
-                WHERE idet.inspection_id = $1
-                ORDER BY step_order, obs_id
-                """,
-                insp["id"],
-                row["workshop_id"],
-            )
-            
-            # Consulta de photo_doc si es necesario
-            if needs_photo_template and insp.get("id"):
-                photo_doc = await conn.fetchrow(
-                    """
-                    SELECT file_url
-                    FROM inspection_documents
-                    WHERE inspection_id = $1
-                      AND is_front = true
-                    LIMIT 1
-                    """,
-                    insp["id"]
-                )
-        
-        # Optimización: descargar template y foto en paralelo si es necesario
-        photo_task = None
-        
-        if needs_photo_template and photo_doc and photo_doc.get("file_url"):
-            photo_url = photo_doc["file_url"]
-            photo_task = _download_and_resize_image_async(photo_url, 246, 170)
-        elif needs_photo_template:
-            pass
+class _ZipChunkBuffer:
+    """Destino no seekable para zipfile: acumula lo escrito hasta que se drena hacia la respuesta."""
 
-    # Optimización: cargar template y foto en paralelo
-    try:
-        tasks = [_get_template_bytes_async(template_url)]
-        if photo_task:
-            tasks.append(photo_task)
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        template_bytes = results[0]
-        if isinstance(template_bytes, Exception):
-            raise RuntimeError(f"No se pudo cargar el template, {template_bytes}")
-        
-        if photo_task:
-            photo_png_result = results[1]
-            if isinstance(photo_png_result, Exception):
-                photo_png = None
-            else:
-                photo_png = photo_png_result
-        else:
-            photo_png = None
-    except Exception as e:
-        raise RuntimeError(f"No se pudo cargar el template, {e}")
-
-    is_second_inspection = bool(insp and insp.get("is_second"))
-
-    base_owner_fullname = " ".join([x for x in [row["owner_first_name"], row["owner_last_name"]] if x])
-
-    documento = None
-    documento_label = "D.N.I."
-    using_cuit = False
-    if _valid_doc_value(row.get("owner_cuit")):
-        documento = str(row["owner_cuit"]).strip()
-        documento_label = "CUIT"
-        using_cuit = True
-    elif _valid_doc_value(row.get("owner_dni")) or _valid_doc_value(row.get("owner_passport_number")):
-        if _valid_doc_value(row.get("owner_dni")):
-            documento = str(row["owner_dni"]).strip()
-            documento_label = "D.N.I."
-        else:
-            documento = str(row["owner_passport_number"]).strip()
-            documento_label = "PAS"
-        using_cuit = False
-    elif _valid_doc_value(row.get("driver_dni")) or _valid_doc_value(row.get("driver_passport_number")):
-        if _valid_doc_value(row.get("driver_dni")):
-            documento = str(row["driver_dni"]).strip()
-            documento_label = "D.N.I."
-        else:
-            documento = str(row["driver_passport_number"]).strip()
-            documento_label = "PAS"
-        using_cuit = False
-    elif _valid_doc_value(row.get("driver_cuit")):
-        documento = str(row["driver_cuit"]).strip()
-        documento_label = "CUIT"
-        using_cuit = True
-
-    if os.getenv("CRT_DEBUG") == "1":
-        log.info(
-            "[CRT][documento] app_id=%s owner_dni=%r owner_cuit=%r owner_passport=%r driver_dni=%r driver_cuit=%r driver_passport=%r -> documento=%r label=%s",
-            app_id,
-            row.get("owner_dni"),
-            row.get("owner_cuit"),
-            row.get("owner_passport_number"),
-            row.get("driver_dni"),
-            row.get("driver_cuit"),
-            row.get("driver_passport_number"),
-            documento,
-            documento_label,
-        )
-
-    if using_cuit and (row.get("owner_razon_social")):
-        owner_fullname = row["owner_razon_social"]
-    else:
-        owner_fullname = base_owner_fullname
+    def __init__(self):
+        self._chunks: list[bytes | memoryview] = []
 
-    domicilio = row["owner_street"]
-    localidad = row["owner_city"]
-    provincia = row["owner_province"]
+    def write(self, data) -> int:
+        # Los PDFs llegan como bytes o vistas de solo lectura: se guardan sin copiar
+        self._chunks.append(data if isinstance(data, (bytes, memoryview)) else bytes(data))
+        return len(data)
 
-    argentina_tz = pytz.timezone("America/Argentina/Buenos_Aires")
-    insp_created_at = insp.get("created_at") if insp else None
-    if is_second_inspection and insp_created_at:
-        fecha_emision_dt = insp_created_at
-    else:
-        fecha_emision_dt = insp_created_at or row["app_date"]
-    fecha_emision = _fmt_date(fecha_emision_dt) if fecha_emision_dt else ""
-    
-    fecha_base_vencimiento_dt = row["app_date"]
-    fecha_vencimiento = None
-    vto_dt_for_db = None
-    if fecha_base_vencimiento_dt:
-        if condicion == "Condicional":
-            vto_dt_for_db = fecha_base_vencimiento_dt + timedelta(days=59)
-        elif condicion == "Rechazado":
-            vto_dt_for_db = None
-        else:
-            vto_dt_for_db = await _calc_vencimiento_from_rules(
-                fecha_emision_dt=fecha_base_vencimiento_dt,
-                province_name=row["workshop_province"],
-                city_name=row["workshop_city"],
-                usage_code=row["usage_type"],
-                registration_year=row["car_registration_year"],
-                now_tz=argentina_tz,
-            )
-            if not vto_dt_for_db:
-                vto_dt_for_db = _calc_vencimiento_fallback_dt(fecha_base_vencimiento_dt, row["car_year"], argentina_tz)
-        fecha_vencimiento = _fmt_date(vto_dt_for_db) if vto_dt_for_db else None
-    
-    resultado = condicion or (row["app_result"] or row["app_status"] or "Apto")
-    resultado_primera_inspeccion = (row["app_result"] or row["app_status"] or "").strip()
-    resultado_mapeo_principal = resultado if not is_second_inspection else (resultado_primera_inspeccion or resultado)
-    resultado_segunda_inspeccion = resultado if is_second_inspection else ""
-    tipo_puro = (row["vehicle_type"] or "").strip().upper()
-    tipo_display = _vehicle_type_display((row["vehicle_type"] or "").strip())
-    uso_display = _usage_type_display((row["usage_type"] or "").strip())
-    clasificacion_base = "\n".join([t for t in [tipo_display, uso_display] if t])
-    clasificacion = _wrap_to_width(clasificacion_base, width=40)
-
-    resultado_final = resultado_mapeo_principal if not is_second_inspection else resultado_segunda_inspeccion
-    oblea = str(row["sticker_number"] or "")
-    current_year_ar = datetime.now(argentina_tz).year
-    crt_numero = f"{row['application_id']}"
-
-    step_groups = {}
-    for r in step_obs_rows or []:
-        step_name = (r["step_name"] or "").strip()
-        desc = (r["obs_desc"] or "").strip()
-        if not step_name and not desc:
-            continue
-        step_groups.setdefault(step_name, []).append(desc) if desc else step_groups.setdefault(step_name, [])
-
-    step_lines = []
-    seen = set()
-    for r in step_obs_rows or []:
-        name = (r["step_name"] or "").strip()
-        if name in seen:
-            continue
-        seen.add(name)
-        descs = [d for d in step_groups.get(name, []) if d]
-        if not name and not descs:
-            continue
-        if descs:
-            step_lines.append(f"{name}: {', '.join(descs)}" if name else ", ".join(descs))
-        else:
-            if name:
-                step_lines.append(f"{name}:")
-    step_obs_text = "\n".join(step_lines).strip()
-
-    global_obs_text = (insp["global_observations"] if insp and insp["global_observations"] else "").strip()
-    global_obs_wrapped = textwrap.fill(global_obs_text, width=115, break_long_words=False, break_on_hyphens=False) if global_obs_text else ""
-    obs2_width = 45 if (usage_type and usage_type.strip().upper() == "D") else 90
-    global_obs_wrapped2 = textwrap.fill(global_obs_text, width=obs2_width, break_long_words=False, break_on_hyphens=False) if global_obs_text else ""
-    observaciones_text = global_obs_wrapped
-    observaciones_text2 = global_obs_wrapped2
-
-    oblea = str(row["sticker_number"] or "").strip()
-    qr_target = oblea
-    qr_link = f"https://www.checkrto.com/qr/{qr_target}"
-    oblea_text = oblea if oblea else "Sin Asignar"
-
-    dominio_value_for_mapping = row["car_plate"] or ""
-    
-    fecha_em2 = _fmt_date(row["app_date"]) if row["app_date"] else ""
-    
-    mapping = {
-        "${fecha_emision}":         fecha_emision or "",
-        "${fecha_vencimiento}":     fecha_vencimiento or "",
-        "${fecha_em2}":              fecha_em2 or "",
-        "${fecha_vto}":             fecha_vencimiento or "",
-        "${taller}":                row["workshop_name"] or "",
-        "${num_reg}":               str(row["workshop_plant_number"] or ""),
-        "${nombre_apellido}":       owner_fullname or "",
-        "${nombre_apellido2}":      (f"{owner_fullname} ({documento_label} {documento}) - TITULAR" if documento else f"{owner_fullname} - TITULAR") or "",
-        "${documento}":             str(documento or ""),
-        "${documento2}":            str(documento or ""),
-        "${domicilio}":             domicilio or "",
-        "${f_localidad}":           localidad or "",
-        "${t_localidad}":           row["workshop_city"] or "",
-        "${localidad2}":            f"{localidad} ({provincia})" if localidad or provincia else "",
-        "${provincia}":             provincia or "",
-        "${provincia2}":            provincia or "",
-        "${patente}":               dominio_value_for_mapping,
-        "${patente2}":              dominio_value_for_mapping,
-        "${anio}":                  str(row["car_registration_year"] or ""),
-        "${marca}":                 row["car_brand"] or "",
-        "${modelo}":                row["car_model"] or "",
-        "${marca_motor}":           row["engine_brand"] or "",
-        "${numero_motor}":          str(row["engine_number"] or ""),
-        "${combustible}":           row["fuel_type"] or "",
-        "${marca_chasis}":          row["chassis_brand"] or "",
-        "${numero_chasis}":         str(row["chassis_number"] or ""),
-        "${ced_tipo}":              str(row["car_type_ced"] or ""),
-        "${ced_tipo2}":             str(row["car_type_ced"] or ""),
-        "${tipo_vehiculo}":         tipo_puro,
-        "${resultado_inspeccion}":  resultado_mapeo_principal,
-        "${observaciones}":         observaciones_text,
-        "${observaciones2}":        observaciones_text2,
-        "${clasif}":                clasificacion,
-        "${resultado2}":            resultado_segunda_inspeccion,
-        "${crt_numero}":            crt_numero,
-        "${oblea_numero}":          oblea_text,
-        "${resultado_final}":       resultado_final,
-    }
+    def flush(self) -> None:
+        pass
 
-    if needs_photo_template:
-        mapping["${photo}"] = ""  
-    
-    try:
-        pdf_bytes, counts = await _render_certificate_pdf_async(template_bytes, mapping, qr_link, photo_png, usage_type)
-    except Exception as e:
-        raise RuntimeError(f"No se pudo renderizar el PDF, {e}")
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
 
-    file_name = "certificado_2.pdf" if is_second_inspection else "certificado.pdf"
-    
-    # Actualizar estado de la aplicación a "Completado" cuando se crea el PDF
-    # Usar función auxiliar con transacción explícita, verificación y reintentos
-    await _update_application_status_to_completed(app_id, resultado, is_second_inspection)
-    
-    # Preparar metadata para la función de subida
-    metadata = {
-        "condicion": condicion,
-        "resultado": resultado,
-        "is_second_inspection": is_second_inspection,
-        "template_url": template_url,
-        "counts": counts,
-        "row": row,
-        "insp": insp,
-        "fecha_emision": fecha_emision,
-        "fecha_vencimiento": fecha_vencimiento,
-        "vto_dt_for_db": vto_dt_for_db if fecha_base_vencimiento_dt else None,
-        "owner_fullname": owner_fullname,
-        "oblea": oblea,
-        "crt_numero": crt_numero,
-        "resultado_final": resultado_final,
-        "email_owner": row["owner_email"],
-    }
-    
-    return pdf_bytes, file_name, metadata
-
-# ---------- FUNCIÓN PARA ACTUALIZAR EN SEGUNDO PLANO (PDF ya subido) ----------
-async def _update_application_background(app_id: int, pdf_bytes: bytes, file_name: str, metadata: dict, payload: dict, public_url: str):
+def _parse_batch_items(body: dict) -> list[tuple[int, dict]]:
     """
-    Actualiza la aplicación en segundo plano (el PDF ya fue subido).
+    Acepta {"items": [{"application_id": 1, "condicion": "Apto"}, ...]}
+    o {"application_ids": [1, 2], "condicion": "Apto"} (misma condición para todos).
     """
-
-    # Actualizar sticker si es rechazado (solo si es la primera revisión del vehículo)
-    # Casos cubiertos:
-    # 1. Primera revisión da Rechazado → marca sticker como No Disponible
-    # 2. Primera revisión Condicional, segunda Rechazado → marca sticker como No Disponible
-    # 3. Si ya tiene revisiones previas completadas (Apto, Condicional, etc.) y luego da Rechazado → NO marca (se queda en uso)
-    # 4. Si ya había dado Rechazado antes → no modifica el sticker (ya debería estar No Disponible)
-    condicion = metadata["condicion"]
-    row = metadata["row"]
-    try:
-        async with get_conn_ctx() as conn: 
-            # Verificar si es la primera revisión del vehículo cuando da rechazado
-            if condicion == "Rechazado" and row.get("sticker_id"):
-                # Obtener el car_id de la aplicación actual
-                car_id_result = await conn.fetchval(
-                    "SELECT car_id FROM applications WHERE id = $1",
-                    app_id
-                )
-                
-                if car_id_result:
-                    # Verificar si hay aplicaciones previas completadas para el mismo vehículo
-                    # Si hay aplicaciones previas completadas, el sticker ya estaba en uso, no se marca como No Disponible
-                    prev_completed_count = await conn.fetchval(
-                        """
-                        SELECT COUNT(*) 
-                        FROM applications 
-                        WHERE car_id = $1 
-                          AND status = 'Completado'
-                          AND id < $2
-                        """,
-                        car_id_result,
-                        app_id
-                    )
-                    
-                    # Solo actualizar sticker si es la primera revisión del vehículo (no hay aplicaciones previas completadas)
-                    # Esto cubre: primera revisión rechazado, o primera condicional + segunda rechazado
-                    # Si ya tiene revisiones previas (Apto, Condicional, etc.), el sticker se queda en uso
-                    if prev_completed_count == 0:
-                        await conn.execute(
-                            "UPDATE stickers SET status = 'No Disponible' WHERE id = $1",
-                            row["sticker_id"]
-                        )
-    except Exception as e:
-        log.exception("Error actualizando sticker para aplicación %s: %s", app_id, e)
-
-    # Actualizar inspección (created_at y expiration_date)
-    insp = metadata["insp"]
-    vto_dt_for_db = metadata.get("vto_dt_for_db")
-    try:
-        if insp and insp.get("id"):
-            async with get_conn_ctx() as conn:
-                await conn.execute(
-                    """
-                    UPDATE inspections
-                    SET created_at = NOW() AT TIME ZONE 'America/Argentina/Buenos_Aires',
-                        expiration_date = $2
-                    WHERE id = $1
-                    """,
-                    insp["id"],
-                    vto_dt_for_db.date() if vto_dt_for_db else None,
-                )
-    except Exception as e:
-        log.exception("Error actualizando inspección para aplicación %s: %s", app_id, e)
-
-    # El estado de la aplicación ya se actualizó cuando se creó el PDF
-    # Aquí solo se actualizan otros datos (sticker, inspección, email)
-
-    # Enviar email si hay email del owner
-    email_owner = metadata.get("email_owner")
-    if email_owner and email_owner.strip():
-        try:
-            await send_certificate_email(
-                to_email=email_owner.strip(),
-                pdf_bytes=pdf_bytes,
-                pdf_filename=file_name,
-                owner_name=metadata["owner_fullname"],
-                sticker_number=metadata["oblea"],
-                car_plate=row["car_plate"],
-                fecha_emision=metadata["fecha_emision"],
-                fecha_vencimiento=metadata["fecha_vencimiento"],
-                resultado=metadata["resultado_final"],
-                certificate_number=metadata["crt_numero"],
-                workshop_name=row["workshop_name"],
-            )
-            log.info("Certificado enviado por email a %s para aplicación %s", email_owner, app_id)
-        except Exception as e:
-            # No fallar la generación del certificado si falla el envío del email
-            log.exception("Error enviando certificado por email a %s para aplicación %s: %s", email_owner, app_id, e)
-
-# ---------- LÓGICA DE GENERACIÓN MOVIDA A FUNCIÓN REUTILIZABLE (MANTENER PARA COMPATIBILIDAD) ----------
-async def _do_generate_certificate(app_id: int, payload: dict):
-    condicion_raw = (payload.get("condicion") or "Apto").strip().lower()
-    cond_map = {"apto": "Apto", "condicional": "Condicional", "rechazado": "Rechazado"}
-    condicion = cond_map.get(condicion_raw, "Apto")
-    
-    templates_por_cond = {
-        "apto": "certificado_base_apto.pdf",
-        "condicional": "certificado_base_condicional.pdf",
-        "rechazado": "certificado_base_rechazado.pdf",
-    }
-    templates_por_cond_with_photo = {
-        "apto": "photos/certificado_base_apto_photo.pdf",
-        "condicional": "photos/certificado_base_condicional_photo.pdf",
-        "rechazado": "certificado_base_rechazado.pdf",
-    }
-    
-    usage_type = None
-    needs_photo_template = False
-    photo_png = None
-    template_url = None  
-    insp = None  
-    step_obs_rows = []
-    
-    async with get_conn_ctx() as conn:
-        row = await conn.fetchrow(
-            """
-            SELECT
-            a.id AS application_id,
-            a.date AS app_date,
-            a.status AS app_status,
-            a.result AS app_result,
-            a.workshop_id AS workshop_id,
-
-            o.first_name AS owner_first_name,
-            o.last_name  AS owner_last_name,
-            o.dni        AS owner_dni,
-            o.cuit       AS owner_cuit,
-            o.passport_number AS owner_passport_number,
-            o.razon_social AS owner_razon_social,
-            o.street     AS owner_street,
-            o.city       AS owner_city,
-            o.province   AS owner_province,
-            o.email      AS owner_email,
-            d.first_name AS driver_first_name,
-            d.last_name  AS driver_last_name,
-            d.dni        AS driver_dni,
-            d.cuit       AS driver_cuit,
-            d.passport_number AS driver_passport_number,
-
-            c.license_plate    AS car_plate,
-            c.brand            AS car_brand,
-            c.model            AS car_model,
-            c.manufacture_year AS car_year,
-            c.registration_year AS car_registration_year,
-            c.engine_brand     AS engine_brand,
-            c.engine_number    AS engine_number,
-            c.chassis_brand    AS chassis_brand,
-            c.chassis_number   AS chassis_number,
-            c.fuel_type        AS fuel_type,
-            c.insurance        AS insurance,
-            c.vehicle_type     AS vehicle_type,
-            c.usage_type       AS usage_type,
-            c.type_ced         AS car_type_ced,
-
-            ws.razon_social AS workshop_name,
-            ws.plant_number AS workshop_plant_number,
-            ws.province      AS workshop_province,
-            ws.city          AS workshop_city,
-
-            s.id AS sticker_id,
-            s.sticker_number AS sticker_number
-            FROM applications a
-            LEFT JOIN persons   o  ON o.id  = a.owner_id
-            LEFT JOIN persons   d  ON d.id  = a.driver_id
-            LEFT JOIN cars      c  ON c.id  = a.car_id
-            LEFT JOIN workshop  ws ON ws.id = a.workshop_id
-            LEFT JOIN stickers  s  ON s.id  = c.sticker_id
-            WHERE a.id = $1
-            """,
-            app_id
-        )
-        if not row:
-            raise RuntimeError("Trámite no encontrado")
-        
-        usage_type = (row.get("usage_type") or "").strip().upper()
-        needs_photo_template = (usage_type == "D" and condicion_raw in ("apto", "condicional"))
-        
-        if needs_photo_template:
-            template_url = templates_por_cond_with_photo.get(condicion_raw, templates_por_cond_with_photo["apto"])
-        else:
-            template_url = templates_por_cond.get(condicion_raw, templates_por_cond["apto"])
-    
-        if not template_url:
-            template_url = templates_por_cond.get(condicion_raw, templates_por_cond["apto"])
-
-        # Optimización: ejecutar consultas en paralelo cuando sea posible
-        insp = await conn.fetchrow(
-            """
-            SELECT
-                i.id,
-                i.global_observations,
-                i.created_at,
-                COALESCE(i.is_second, FALSE) AS is_second
-            FROM inspections i
-            WHERE i.application_id = $1
-            ORDER BY i.id DESC
-            LIMIT 1
-            """,
-            app_id
-        )
-        
-        # Determinar si es segunda inspección antes de actualizar sticker
-        is_second_inspection = bool(insp and insp.get("is_second"))
-        
-        # Actualizar sticker solo si es la primera revisión del vehículo cuando da rechazado
-        # Casos cubiertos:
-        # 1. Primera revisión da Rechazado → marca sticker como No Disponible
-        # 2. Primera revisión Condicional, segunda Rechazado → marca sticker como No Disponible
-        # 3. Si ya tiene revisiones previas completadas (Apto, Condicional, etc.) y luego da Rechazado → NO marca (se queda en uso)
-        # 4. Si ya había dado Rechazado antes → no modifica el sticker (ya debería estar No Disponible)
-        if condicion == "Rechazado" and row.get("sticker_id"):
-            # Obtener el car_id de la aplicación actual
-            car_id_result = await conn.fetchval(
-                "SELECT car_id FROM applications WHERE id = $1",
-                app_id
-            )
-            
-            if car_id_result:
-                # Verificar si hay aplicaciones previas completadas para el mismo vehículo
-                # Si hay aplicaciones previas completadas, el sticker ya estaba en uso, no se marca como No Disponible
-                prev_completed_count = await conn.fetchval(
-                    """
-                    SELECT COUNT(*) 
-                    FROM applications 
-                    WHERE car_id = $1 
-                      AND status = 'Completado'
-                      AND id < $2
-                    """,
-                    car_id_result,
-                    app_id
-                )
-                
-                # Solo actualizar sticker si es la primera revisión del vehículo (no hay aplicaciones previas completadas)
-                # Esto cubre: primera revisión rechazado, o primera condicional + segunda rechazado
-                # Si ya tiene revisiones previas (Apto, Condicional, etc.), el sticker se queda en uso
-                if prev_completed_count == 0:
-                    await conn.execute(
-                        "UPDATE stickers SET status = 'No Disponible' WHERE id = $1",
-                        row["sticker_id"]
-                    )
-
-        # Actualizar created_at de la inspección a la fecha actual (zona horaria Argentina)
-        if insp and insp.get("id"):
-            await conn.execute(
-                """
-                UPDATE inspections
-                SET created_at = NOW() AT TIME ZONE 'America/Argentina/Buenos_Aires'
-                WHERE id = $1
-                """,
-                insp["id"],
-            )
-
-        # Ejecutar consultas secuencialmente (asyncpg no permite paralelismo en la misma conexión)
-        step_obs_rows = []
-        photo_doc = None
-        
-        if insp:
-            step_obs_rows = await conn.fetch(
-                """
-                SELECT
-                  COALESCE(st.name, '')    AS step_name,
-                  o.description            AS obs_desc,
-                  COALESCE(so.number,999)  AS step_order,
-                  o.id                     AS obs_id
-                FROM observation_details od
-                JOIN inspection_details idet ON idet.id = od.inspection_detail_id
-                JOIN observations o          ON o.id    = od.observation_id
-                LEFT JOIN steps st           ON st.id   = o.step_id
-                LEFT JOIN steps_order so     ON so.step_id = st.id
-                                             AND so.workshop_id = $2
-                WHERE idet.inspection_id = $1
-                ORDER BY step_order, obs_id
-                """,
-                insp["id"],
-                row["workshop_id"],
-            )
-            
-            # Consulta de photo_doc si es necesario
-            if needs_photo_template and insp.get("id"):
-                photo_doc = await conn.fetchrow(
-                    """
-                    SELECT file_url
-                    FROM inspection_documents
-                    WHERE inspection_id = $1
-                      AND is_front = true
-                    LIMIT 1
-                    """,
-                    insp["id"]
-                )
-        
-        # Optimización: descargar template y foto en paralelo si es necesario
-        template_task = None
-        photo_task = None
-        
-        if needs_photo_template and photo_doc and photo_doc.get("file_url"):
-            photo_url = photo_doc["file_url"]
-            photo_task = _download_and_resize_image_async(photo_url, 246, 170)
-        elif needs_photo_template:
-            pass
-
-    # Optimización: cargar template y foto en paralelo
-    try:
-        tasks = [_get_template_bytes_async(template_url)]
-        if photo_task:
-            tasks.append(photo_task)
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        template_bytes = results[0]
-        if isinstance(template_bytes, Exception):
-            raise RuntimeError(f"No se pudo descargar el template, {template_bytes}")
-        
-        if photo_task:
-            photo_png_result = results[1]
-            if isinstance(photo_png_result, Exception):
-                photo_png = None
-            else:
-                photo_png = photo_png_result
-        else:
-            photo_png = None
-    except Exception as e:
-        raise RuntimeError(f"No se pudo cargar el template, {e}")
-
-    # is_second_inspection ya se determinó antes (después de obtener insp)
-
-    base_owner_fullname = " ".join([x for x in [row["owner_first_name"], row["owner_last_name"]] if x])
-
-    documento = None
-    documento_label = "D.N.I."
-    using_cuit = False
-    if _valid_doc_value(row.get("owner_cuit")):
-        documento = str(row["owner_cuit"]).strip()
-        documento_label = "CUIT"
-        using_cuit = True
-    elif _valid_doc_value(row.get("owner_dni")) or _valid_doc_value(row.get("owner_passport_number")):
-        if _valid_doc_value(row.get("owner_dni")):
-            documento = str(row["owner_dni"]).strip()
-            documento_label = "D.N.I."
-        else:
-            documento = str(row["owner_passport_number"]).strip()
-            documento_label = "PAS"
-        using_cuit = False
-    elif _valid_doc_value(row.get("driver_dni")) or _valid_doc_value(row.get("driver_passport_number")):
-        if _valid_doc_value(row.get("driver_dni")):
-            documento = str(row["driver_dni"]).strip()
-            documento_label = "D.N.I."
-        else:
-            documento = str(row["driver_passport_number"]).strip()
-            documento_label = "PAS"
-        using_cuit = False
-    elif _valid_doc_value(row.get("driver_cuit")):
-        documento = str(row["driver_cuit"]).strip()
-        documento_label = "CUIT"
-        using_cuit = True
-
-    if os.getenv("CRT_DEBUG") == "1":
-        log.info(
-            "[CRT][documento] app_id=%s owner_dni=%r owner_cuit=%r owner_passport=%r driver_dni=%r driver_cuit=%r driver_passport=%r -> documento=%r label=%s",
-            app_id,
-            row.get("owner_dni"),
-            row.get("owner_cuit"),
-            row.get("owner_passport_number"),
-            row.get("driver_dni"),
-            row.get("driver_cuit"),
-            row.get("driver_passport_number"),
-            documento,
-            documento_label,
-        )
-
-    if using_cuit and (row.get("owner_razon_social")):
-        owner_fullname = row["owner_razon_social"]
-    else:
-        owner_fullname = base_owner_fullname
-
-    domicilio = row["owner_street"]
-    localidad = row["owner_city"]
-    provincia = row["owner_province"]
-
-    argentina_tz = pytz.timezone("America/Argentina/Buenos_Aires")
-    insp_created_at = insp.get("created_at") if insp else None
-    if is_second_inspection and insp_created_at:
-        fecha_emision_dt = insp_created_at
+    items = []
+    if isinstance(body.get("items"), list):
+        for it in body["items"]:
+            if not isinstance(it, dict):
+                raise ValueError("Cada item debe ser un objeto con application_id")
+            items.append((int(it["application_id"]), {"condicion": it.get("condicion") or body.get("condicion")}))
+    elif isinstance(body.get("application_ids"), list):
+        for app_id in body["application_ids"]:
+            items.append((int(app_id), {"condicion": body.get("condicion")}))
     else:
-        fecha_emision_dt = insp_created_at or row["app_date"]
-    fecha_emision = _fmt_date(fecha_emision_dt) if fecha_emision_dt else ""
-    
-    # Para calcular la fecha de vencimiento, siempre usar la fecha de la aplicación (app_date)
-    fecha_base_vencimiento_dt = row["app_date"]
-    fecha_vencimiento = None
-    vto_dt_for_db = None
-    if fecha_base_vencimiento_dt:
-        if condicion == "Condicional":
-            vto_dt_for_db = fecha_base_vencimiento_dt + timedelta(days=59)
-        elif condicion == "Rechazado":
-            vto_dt_for_db = None
-        else:
-            vto_dt_for_db = await _calc_vencimiento_from_rules(
-                fecha_emision_dt=fecha_base_vencimiento_dt,
-                province_name=row["workshop_province"],
-                city_name=row["workshop_city"],
-                usage_code=row["usage_type"],
-                registration_year=row["car_registration_year"],
-                now_tz=argentina_tz,
-            )
-            if not vto_dt_for_db:
-                vto_dt_for_db = _calc_vencimiento_fallback_dt(fecha_base_vencimiento_dt, row["car_year"], argentina_tz)
-        fecha_vencimiento = _fmt_date(vto_dt_for_db) if vto_dt_for_db else None
-    email_owner = row["owner_email"]
-    
-    resultado = condicion or (row["app_result"] or row["app_status"] or "Apto")
-    resultado_primera_inspeccion = (row["app_result"] or row["app_status"] or "").strip()
-    resultado_mapeo_principal = resultado if not is_second_inspection else (resultado_primera_inspeccion or resultado)
-    resultado_segunda_inspeccion = resultado if is_second_inspection else ""
-    tipo_puro = (row["vehicle_type"] or "").strip().upper()
-    tipo_display = _vehicle_type_display((row["vehicle_type"] or "").strip())
-    uso_display = _usage_type_display((row["usage_type"] or "").strip())
-    clasificacion_base = "\n".join([t for t in [tipo_display, uso_display] if t])
-    clasificacion = _wrap_to_width(clasificacion_base, width=40)
-
-    resultado_final = resultado_mapeo_principal if not is_second_inspection else resultado_segunda_inspeccion
-    oblea = str(row["sticker_number"] or "")
-    current_year_ar = datetime.now(argentina_tz).year
-    crt_numero = f"{row['application_id']}"
-
-    step_groups = {}
-    for r in step_obs_rows or []:
-        step_name = (r["step_name"] or "").strip()
-        desc = (r["obs_desc"] or "").strip()
-        if not step_name and not desc:
-            continue
-        step_groups.setdefault(step_name, []).append(desc) if desc else step_groups.setdefault(step_name, [])
+        raise ValueError("Falta items o application_ids")
 
-    step_lines = []
     seen = set()
-    for r in step_obs_rows or []:
-        name = (r["step_name"] or "").strip()
-        if name in seen:
+    unique = []
+    for app_id, payload in items:
+        if app_id in seen:
             continue
-        seen.add(name)
-        descs = [d for d in step_groups.get(name, []) if d]
-        if not name and not descs:
-            continue
-        if descs:
-            step_lines.append(f"{name}: {', '.join(descs)}" if name else ", ".join(descs))
-        else:
-            if name:
-                step_lines.append(f"{name}:")
-    step_obs_text = "\n".join(step_lines).strip()
-
-    global_obs_text = (insp["global_observations"] if insp and insp["global_observations"] else "").strip()
-    global_obs_wrapped = textwrap.fill(global_obs_text, width=115, break_long_words=False, break_on_hyphens=False) if global_obs_text else ""
-    obs2_width = 45 if (usage_type and usage_type.strip().upper() == "D") else 90
-    global_obs_wrapped2 = textwrap.fill(global_obs_text, width=obs2_width, break_long_words=False, break_on_hyphens=False) if global_obs_text else ""
-    observaciones_text = global_obs_wrapped
-    observaciones_text2 = global_obs_wrapped2
-
-    oblea = str(row["sticker_number"] or "").strip()
-    qr_target = oblea
-    qr_link = f"https://www.checkrto.com/qr/{qr_target}"
-    oblea_text = oblea if oblea else "Sin Asignar"
-
-    if insp and insp.get("id") and vto_dt_for_db:
-        try:
-            async with get_conn_ctx() as conn:
-                await conn.execute(
-                    """
-                    UPDATE inspections
-                    SET expiration_date = $2
-                    WHERE id = $1
-                    """,
-                    insp["id"],
-                    vto_dt_for_db.date(),
-                )
-        except Exception:
-            pass
-
-    dominio_value_for_mapping = row["car_plate"] or ""
-    
-    fecha_em2 = _fmt_date(row["app_date"]) if row["app_date"] else ""
-    
-    mapping = {
-        "${fecha_emision}":         fecha_emision or "",
-        "${fecha_vencimiento}":     fecha_vencimiento or "",
-        "${fecha_em2}":              fecha_em2 or "",
-        "${fecha_vto}":             fecha_vencimiento or "",
-        "${taller}":                row["workshop_name"] or "",
-        "${num_reg}":               str(row["workshop_plant_number"] or ""),
-        "${nombre_apellido}":       owner_fullname or "",
-        "${nombre_apellido2}":      (f"{owner_fullname} ({documento_label} {documento}) - TITULAR" if documento else f"{owner_fullname} - TITULAR") or "",
-        "${documento}":             str(documento or ""),
-        "${documento2}":            str(documento or ""),
-        "${domicilio}":             domicilio or "",
-        "${f_localidad}":           localidad or "",
-        "${t_localidad}":           row["workshop_city"] or "",
-        "${localidad2}":            f"{localidad} ({provincia})" if localidad or provincia else "",
-        "${provincia}":             provincia or "",
-        "${provincia2}":            provincia or "",
-        "${patente}":               dominio_value_for_mapping,
-        "${patente2}":              dominio_value_for_mapping,
-        "${anio}":                  str(row["car_registration_year"] or ""),
-        "${marca}":                 row["car_brand"] or "",
-        "${modelo}":                row["car_model"] or "",
-        "${marca_motor}":           row["engine_brand"] or "",
-        "${numero_motor}":          str(row["engine_number"] or ""),
-        "${combustible}":           row["fuel_type"] or "",
-        "${marca_chasis}":          row["chassis_brand"] or "",
-        "${numero_chasis}":         str(row["chassis_number"] or ""),
-        "${ced_tipo}":              str(row["car_type_ced"] or ""),
-        "${ced_tipo2}":             str(row["car_type_ced"] or ""),
-        "${tipo_vehiculo}":         tipo_puro,
-        "${resultado_inspeccion}":  resultado_mapeo_principal,
-        "${observaciones}":         observaciones_text,
-        "${observaciones2}":        observaciones_text2,
-        "${clasif}":                clasificacion,
-        "${resultado2}":            resultado_segunda_inspeccion,
-        "${crt_numero}":            crt_numero,
-        "${oblea_numero}":          oblea_text,
-        "${resultado_final}":       resultado_final,
-    }
-
-    if needs_photo_template:
-        mapping["${photo}"] = ""  
-    
-    try:
-        pdf_bytes, counts = await _render_certificate_pdf_async(template_bytes, mapping, qr_link, photo_png, usage_type)
-    except Exception as e:
-        raise RuntimeError(f"No se pudo renderizar el PDF, {e}")
+        seen.add(app_id)
+        unique.append((app_id, payload))
+    return unique
 
-    file_name = "certificado_2.pdf" if is_second_inspection else "certificado.pdf"
-    storage_path = f"certificados/{app_id}/{file_name}"
+@certificates_bp.route("/certificates/batch/generate", methods=["POST"])
+async def certificates_generate_batch():
+    """
+    Genera certificados para varios trámites y los devuelve en un ZIP que se va
+    transmitiendo a medida que se renderizan. El progreso queda en el job cuyo id
+    viaja en el header X-Job-Id (consultable en /certificates/job/<job_id>).
+    """
+    body = await request.get_json() or {}
     try:
-        public_url = await _upload_pdf_and_get_public_url_async(pdf_bytes, storage_path)
-    except Exception as e:
-        raise RuntimeError(f"PDF generado, no se pudo subir a Supabase Storage, {e}")
-
-    # Actualizar estado de la aplicación a "Completado" cuando se crea el PDF
-    # Usar función auxiliar con transacción explícita, verificación y reintentos
-    await _update_application_status_to_completed(app_id, resultado, is_second_inspection)
-
-    # ----- DEBUG RESUMEN FINAL (opcional por env var CRT_DEBUG=1) -----
-    if os.getenv("CRT_DEBUG") == "1":
-        try:
-            prov_dbg = row.get("workshop_province")
-            city_dbg = row.get("workshop_city")
-            usage_dbg = (row.get("usage_type") or "").strip().upper()
-            reg_year_dbg = row.get("car_registration_year")
-            reg_mon_dbg = None
-
-            prov_code_dbg, loc_key_dbg = _find_localidad_codes(prov_dbg, city_dbg)
+        items = _parse_batch_items(body)
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({"error": f"Body inválido, {e}"}), 400
+    if not items:
+        return jsonify({"error": "No se recibieron trámites"}), 400
+    if len(items) > CERT_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Máximo {CERT_BATCH_MAX_ITEMS} trámites por lote"}), 400
+
+    prefetched = await ENGINE.load_data([app_id for app_id, _ in items])
+
+    jid = await new_job()
+    progress = {
+        "total": len(items),
+        "done": 0,
+        "failed": [
+            {"application_id": app_id, "error": "Trámite no encontrado"}
+            for app_id, _ in items if app_id not in prefetched
+        ],
+        "files": [],
+    }
+    pending = [(app_id, payload) for app_id, payload in items if app_id in prefetched]
 
-            base_dbg = fecha_emision_dt.astimezone(argentina_tz) if hasattr(fecha_emision_dt, "astimezone") else fecha_emision_dt
-            elapsed_months_dbg = None
-            elapsed_years_dbg = None
+    async def _generate_one(app_id: int, payload: dict) -> tuple[bytes, str, dict]:
+        # El lote ya limita su propio paralelismo, si el renderer está saturado esperamos turno
+        # y comparte con los pedidos sueltos el cupo de certificados en curso. Si sigue
+        # saturado después del último intento, AdmissionRejected sale hacia el worker
+        for attempt in range(CERT_BATCH_ADMISSION_RETRIES):
             try:
-                if reg_year_dbg:
-                    elapsed_months_dbg = _months_since_registration_year(base_dbg, int(reg_year_dbg))
-                    elapsed_years_dbg = elapsed_months_dbg // 12
-                    reg_mon_dbg = base_dbg.month
-            except Exception:
-                pass
-
-            up36_dbg = 36
-            a3_7_dbg = 24
-            o7_dbg = 12
-            used_lkey_dbg = None
-            used_usage_dbg = None
-            if prov_code_dbg and loc_key_dbg and usage_dbg:
+                async with CERT_GATE.slot(wait=True):
+                    return await ENGINE.generate(app_id, payload, prefetched[app_id])
+            except AdmissionRejected:
+                await asyncio.sleep(1.0 + attempt)
+        async with CERT_GATE.slot(wait=True):
+            return await ENGINE.generate(app_id, payload, prefetched[app_id])
+
+    # Con el contexto del request: el job, la conexión y las métricas lo leen mientras se
+    # transmite el ZIP
+    @stream_with_context
+    async def _stream_zip():
+        # Cola acotada: como máximo hay CERT_BATCH_CONCURRENCY PDFs esperando a escribirse
+        results: asyncio.Queue = asyncio.Queue(maxsize=max(1, CERT_BATCH_CONCURRENCY))
+        todo = iter(pending)
+        # Recién acá pasa a running: si el cliente corta antes de leer, el job queda pending
+        # y expire_orphaned_local_jobs lo cierra cuando vence
+        await set_status(jid, "running", result=progress)
+
+        async def _worker():
+            for app_id, payload in todo:
                 try:
-                    async with get_conn_ctx() as conn:
-                        rule_dbg = await conn.fetchrow(
-                            """
-                            SELECT localidad_key, usage_code, up_to_36_months, from_3_to_7_years, over_7_years
-                            FROM inspection_validity_rules
-                            WHERE (localidad_key = $1 OR localidad_key LIKE ($1 || '%'))
-                            ORDER BY 
-                              CASE WHEN usage_code = $2 THEN 0
-                                   WHEN usage_code = 'C' THEN 1
-                                   ELSE 2 END,
-                              CASE WHEN localidad_key = $1 THEN 0 ELSE 1 END,
-                              localidad_key
-                            LIMIT 1
-                            """,
-                            str(loc_key_dbg),
-                            usage_dbg,
-                        )
-                    if rule_dbg:
-                        used_lkey_dbg = rule_dbg["localidad_key"]
-                        used_usage_dbg = rule_dbg["usage_code"]
-                        up36_dbg = rule_dbg["up_to_36_months"] or up36_dbg
-                        a3_7_dbg = rule_dbg["from_3_to_7_years"] or a3_7_dbg
-                        o7_dbg = rule_dbg["over_7_years"] or o7_dbg
+                    pdf_bytes, file_name, metadata = await _generate_one(app_id, payload)
+                    await results.put((app_id, file_name, pdf_bytes, None))
+                except AdmissionRejected as e:
+                    # Queda como error del item (errores.json), el resto del ZIP sigue
+                    log.warning("Lote: certificado de aplicación %s rechazado por saturación (%s)", app_id, e.gate)
+                    await results.put((app_id, None, None, str(e)))
                 except Exception as e:
-                    print(f"[CRT][RESUMEN] Error consultando regla para debug: {e}")
-
-            bucket_dbg = None
-            if elapsed_months_dbg is not None:
-                if elapsed_months_dbg <= 35:
-                    bucket_dbg = "up_to_36"
-                elif elapsed_years_dbg is not None and 3 <= elapsed_years_dbg <= 7:
-                    bucket_dbg = "3_to_7_years"
-                elif elapsed_years_dbg is not None and elapsed_years_dbg > 7:
-                    bucket_dbg = "over_7_years"
+                    log.exception("Error generando certificado en lote para aplicación %s: %s", app_id, e)
+                    await results.put((app_id, None, None, str(e)))
 
-        except Exception as e:
-            print(f"[CRT][RESUMEN] Error generando resumen final: {e}")
-
-    # Enviar certificado por email si el owner tiene email
-    if email_owner and email_owner.strip():
+        workers = [asyncio.create_task(_worker()) for _ in range(max(1, min(CERT_BATCH_CONCURRENCY, len(pending))))]
+        buf = _ZipChunkBuffer()
         try:
-            await send_certificate_email(
-                to_email=email_owner.strip(),
-                pdf_bytes=pdf_bytes,
-                pdf_filename=file_name,
-                owner_name=owner_fullname,
-                sticker_number=oblea,
-                car_plate=row["car_plate"],
-                fecha_emision=fecha_emision,
-                fecha_vencimiento=fecha_vencimiento,
-                resultado=resultado_final,
-                certificate_number=crt_numero,
-                workshop_name=row["workshop_name"],
-            )
-            log.info("Certificado enviado por email a %s para aplicación %s", email_owner, app_id)
-        except Exception as e:
-            # No fallar la generación del certificado si falla el envío del email
-            log.exception("Error enviando certificado por email a %s para aplicación %s: %s", email_owner, app_id, e)
+            with zipfile.ZipFile(buf, mode="w", compression=zipfile.ZIP_STORED) as zf:
+                for _ in range(len(pending)):
+                    app_id, file_name, pdf_bytes, error = await results.get()
+                    if error is None:
+                        arcname = f"{app_id}_{file_name}"
+                        zf.writestr(arcname, pdf_bytes)
+                        progress["files"].append(arcname)
+                    else:
+                        progress["failed"].append({"application_id": app_id, "error": error})
+                    progress["done"] += 1
+                    await set_status(jid, "running", result=progress)
+                    chunk = buf.drain()
+                    if chunk:
+                        yield chunk
+                if progress["failed"]:
+                    zf.writestr("errores.json", json.dumps(progress["failed"], ensure_ascii=False, indent=2))
+            await set_status(jid, "done", result=progress)
+            chunk = buf.drain()
+            if chunk:
+                yield chunk
+        except BaseException as e:
+            await set_status(jid, "error", result=progress, error=str(e) or type(e).__name__)
+            raise
+        finally:
+            for w in workers:
+                w.cancel()
+
+    response = Response(
+        _stream_zip(),
+        mimetype="application/zip",
+        headers={
+            "Content-Disposition": 'attachment; filename="certificados.zip"',
+            "X-Job-Id": jid,
+        },
+    )
+    # El ZIP puede tardar más que el timeout de respuesta por defecto de Quart
+    response.timeout = None
+    return response
 
-    # devolver dict final para el job
-    return {
-        "message": "PDF generado y trámite actualizado",
-        "application_id": app_id,
-        "new_status": "Completado",
-        "new_result": resultado,
-        "is_second_inspection": is_second_inspection,
-        "file_name": file_name,
-        "template_url": template_url,
-        "storage_bucket": BUCKET_CERTS,
-        "storage_path": storage_path,
-        "public_url": public_url,
-        "replacements": counts
-    }
+@certificates_bp.route("/certificates/job/<job_id>", methods=["GET"])
+async def certificates_job_status(job_id: str):
+    j = await get_job(job_id)
+    if not j:
+        return jsonify({"error": "job_id no encontrado"}), 404
+    return jsonify(j), 200
+
+# Motor compartido por el endpoint individual y el lote (app/certificate_engine.py)
+ENGINE = CertificateEngine(
+    load_template=_get_template_bytes_async,
+    load_photo=_load_front_photo_async,
+    render=_render_certificate_pdf_async,
+    template_digest=_template_digest,
+    render_flavor="qr-vector" if CERT_QR_VECTOR else "qr-png",
+)
@@ -0,0 +1,26 @@
+"""
+Endpoints de salud para el load balancer (sin autenticación).
+- /health/live:  el proceso responde.
+- /health/ready: el warm-up terminó y el pool de la base está inicializado (503 si no).
+"""
+from quart import Blueprint, jsonify
+import os
+
+from app import db
+from app.warmup import is_ready, warmup_status
+
+health_bp = Blueprint("health", __name__)
+
+
+@health_bp.route("/live", methods=["GET"])
+async def live():
+    return jsonify({"ok": True, "pid": os.getpid()}), 200
+
+
+@health_bp.route("/ready", methods=["GET"])
+async def ready():
+    ok = is_ready() and db.db_pool is not None
+    body = {"ok": ok, "pid": os.getpid(), "warmup": warmup_status()}
+    if not ok:
+        return jsonify(body), 503, {"Retry-After": "2"}
+    return jsonify(body), 200
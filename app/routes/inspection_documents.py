@@ -1,11 +1,12 @@
 # app/routes/inspection_documents.py
 from quart import Blueprint, request, jsonify, g
 from app.db import get_conn_ctx
-from app.supabase_client import SUPABASE_URL, get_supabase_client, supabase_dns_workaround
+from app.supabase_client import is_transient_storage_error, storage_public_url, storage_remove, storage_upload
+from app.image_variants import build_image_variants, invalidate_front_photos
+import asyncio
 import os
 import uuid
 import re, unicodedata
-import time
 import logging
 
 inspection_docs_bp = Blueprint("inspection_documents", __name__)
@@ -14,60 +15,13 @@ log = logging.getLogger(__name__)
 # ==== Supabase (storage) ====
 BUCKET_INSPECTION_DOCS = os.getenv("SUPABASE_BUCKET_INSPECTION_DOCS", "inspections")
 
-def _public_url(bucket: str, path: str) -> str:
-    base = (SUPABASE_URL or "").rstrip("/")
-    return f"{base}/storage/v1/object/public/{bucket}/{path}"
-
-def _is_transient_storage_error(exc: Exception) -> bool:
-    error_msg = str(exc).lower()
-    error_type = type(exc).__name__.lower()
-    transient_markers = (
-        "temporary failure in name resolution",
-        "name resolution",
-        "connecterror",
-        "connectionerror",
-        "timed out",
-        "timeout",
-        "network is unreachable",
-        "connection reset",
-        "service unavailable",
-        "gateway timeout",
-    )
-    return any(marker in error_msg for marker in transient_markers) or any(
-        marker in error_type for marker in ("connecterror", "timeout", "connectionerror")
-    )
-
-def _upload_to_storage_with_retry(bucket: str, dest: str, data: bytes, content_type: str, max_retries: int = 3) -> None:
-    last_error = None
-    for attempt in range(1, max_retries + 1):
-        try:
-            with supabase_dns_workaround():
-                client = get_supabase_client()
-                client.storage.from_(bucket).upload(
-                    path=dest,
-                    file=data,
-                    file_options={
-                        "content_type": content_type,
-                        "x-upsert": "true",
-                    },
-                )
-            return
-        except Exception as exc:
-            last_error = exc
-            if _is_transient_storage_error(exc) and attempt < max_retries:
-                backoff_seconds = 0.4 * (2 ** (attempt - 1))
-                log.warning(
-                    "Reintentando subida de inspeccion (%s/%s) por error transitorio: %s",
-                    attempt,
-                    max_retries,
-                    exc,
-                )
-                time.sleep(backoff_seconds)
-                continue
-            raise last_error
-
 # ==============================================
 
+MAX_FILE_MB = 15
+# Subidas simultáneas por request (una tanda de fotos no acapara el pool de conexiones a storage)
+UPLOAD_CONCURRENCY = int(os.getenv("INSPECTION_UPLOAD_CONCURRENCY", "4"))
+_UPLOAD_CHUNK_SIZE = 256 * 1024
+
 def _norm_role(raw: str | None) -> str:
     r = (raw or "").strip().lower()
     return r if r in {"global", "step", "owner", "driver", "car", "generic"} else "generic"
@@ -81,6 +35,65 @@ def _parse_int(raw: str | None):
         return None
 
 
+def _safe_file_name(raw: str | None) -> str:
+    safe_name = unicodedata.normalize("NFD", (raw or "file")).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^A-Za-z0-9._-]+", "-", safe_name).strip("-.")
+
+
+def _file_size(f) -> int | None:
+    # Quart deja cada parte del multipart en un SpooledTemporaryFile: el tamaño sale del
+    # seek al final, sin leer el contenido a memoria
+    try:
+        stream = f.stream
+        pos = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(pos)
+        return size
+    except Exception:
+        return None
+
+
+def _file_chunks(f):
+    """Fábrica de iteradores async sobre el archivo, uno nuevo por intento de subida."""
+    def factory():
+        async def chunks():
+            # El archivo temporal puede estar en disco: leer fuera del event loop
+            await asyncio.to_thread(f.stream.seek, 0)
+            while True:
+                chunk = await asyncio.to_thread(f.stream.read, _UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        return chunks()
+    return factory
+
+
+def _image_variants(f) -> dict | None:
+    # PIL lee del archivo temporal directamente, sin copiarlo entero a memoria
+    f.stream.seek(0)
+    return build_image_variants(f.stream)
+
+
+def _variant_root(dest: str) -> str:
+    head, _, name = dest.rpartition("/")
+    stem = name.rsplit(".", 1)[0] if "." in name else name
+    return f"{head}/{stem}"
+
+
+def _upload_error_response(filename: str | None, e: Exception):
+    error_msg = str(e)
+    # Si el error contiene información sobre JSON, dar un mensaje más claro
+    if "JSONDecodeError" in error_msg or "Expecting value" in error_msg:
+        return jsonify({
+            "error": f"No se pudo subir el archivo {filename}. Error de comunicación con el almacenamiento."
+        }), 502
+    status_code = 502 if is_transient_storage_error(e) else 500
+    return jsonify({
+        "error": f"No se pudo subir el archivo {filename}: {error_msg}"
+    }), status_code
+
+
 @inspection_docs_bp.route("/inspections/<int:inspection_id>/documents", methods=["GET"])
 async def list_inspection_documents(inspection_id: int):
     user_id = g.get("user_id")
@@ -113,7 +126,8 @@ async def list_inspection_documents(inspection_id: int):
             SELECT id, inspection_id, step_id, role,
                    type, file_name, bucket, object_path, file_url,
                    size_bytes, mime_type, created_at,
-                   COALESCE(is_front, false) AS is_front
+                   COALESCE(is_front, false) AS is_front,
+                   display_url, thumb_url
             FROM inspection_documents
             WHERE {where_sql}
             ORDER BY created_at DESC
@@ -156,8 +170,6 @@ async def upload_inspection_documents(inspection_id: int):
     if role == "step" and step_id is None:
         return jsonify({"error": "Falta step_id para role = 'step'"}), 400
 
-    saved = []
-
     # Soporte para marcar "frente del vehículo" (solo para type=vehicle_photo)
     front_idx_raw = request.args.get("front_idx") or form_data.get("front_idx")
     front_existing_raw = request.args.get("front_existing_id") or form_data.get("front_existing_id")
@@ -170,83 +182,162 @@ async def upload_inspection_documents(inspection_id: int):
     except Exception:
         front_existing_id = None
 
-    # Si corresponde, limpiar bandera is_front antes de subir (para asegurar unicidad)
-    if doc_type == "vehicle_photo" and (front_idx is not None or front_existing_id is not None):
-        async with get_conn_ctx() as conn:
-            await conn.execute("""
-                UPDATE inspection_documents
-                   SET is_front = false
-                 WHERE inspection_id = $1
-                   AND type = 'vehicle_photo'
-            """, inspection_id)
-
+    # Validar todo antes de subir nada
+    # ruta en el bucket algo como: inspections/<inspection_id>/<role or step>/<uuid>-<file>
+    subfolder = f"step-{step_id}" if (role == "step" and step_id is not None) else role
+    type_folder = f"{doc_type}/" if doc_type else ""
+    uploads = []
     for f in files:
-        data = f.read()
-        if not isinstance(data, (bytes, bytearray)):
+        size = _file_size(f)
+        if size is None:
             return jsonify({"error": f"No se pudo leer el archivo {f.filename}"}), 400
+        if size > MAX_FILE_MB * 1024 * 1024:
+            return jsonify({"error": f"El archivo {f.filename} excede {MAX_FILE_MB}MB"}), 413
+        safe_name = _safe_file_name(f.filename)
+        uploads.append({
+            "file": f,
+            "file_name": safe_name,
+            "size": size,
+            "mime_type": f.mimetype,
+            "dest": f"inspections/{inspection_id}/{subfolder}/{type_folder}{uuid.uuid4().hex}-{safe_name}",
+            "display_path": None,
+            "thumb_path": None,
+            "uploaded": [],
+        })
+
+    sem = asyncio.Semaphore(max(1, UPLOAD_CONCURRENCY))
+
+    async def _put(item, path, data, content_type, content_length=None):
+        await storage_upload(BUCKET_INSPECTION_DOCS, path, data, content_type=content_type, content_length=content_length)
+        item["uploaded"].append(path)
+
+    async def _upload_image(item) -> bool:
+        # Ingest de fotos: master acotado + WebP de display + thumbnail del certificado
+        variants = await asyncio.to_thread(_image_variants, item["file"])
+        if variants is None:
+            return False
+        root = _variant_root(item["dest"])
+        if variants["master"] is not None:
+            data, item["mime_type"] = variants["master"]
+            item["dest"] = f"{root}.jpg"
+            item["file_name"] = item["file_name"].rsplit(".", 1)[0] + ".jpg"
+            item["size"] = len(data)
+            puts = [_put(item, item["dest"], data, item["mime_type"])]
+        else:
+            # El original ya sirve como master: se sube en streaming desde el archivo temporal
+            puts = [_put(
+                item,
+                item["dest"],
+                _file_chunks(item["file"]),
+                item["mime_type"] or "application/octet-stream",
+                content_length=item["size"],
+            )]
+        if variants["display"] is not None:
+            item["display_path"] = f"{root}.display.webp"
+            puts.append(_put(item, item["display_path"], variants["display"], "image/webp"))
+        item["thumb_path"] = f"{root}.thumb.png"
+        puts.append(_put(item, item["thumb_path"], variants["thumb"], "image/png"))
+        for r in await asyncio.gather(*puts, return_exceptions=True):
+            if isinstance(r, BaseException):
+                raise r
+        return True
+
+    async def _upload_one(item):
+        async with sem:
+            if (item["mime_type"] or "").startswith("image/") and await _upload_image(item):
+                return
+            # Resto de archivos: streaming desde el archivo temporal del multipart
+            await _put(
+                item,
+                item["dest"],
+                _file_chunks(item["file"]),
+                item["mime_type"] or "application/octet-stream",
+                content_length=item["size"],
+            )
 
-        if len(data) > 15 * 1024 * 1024:
-            return jsonify({"error": f"El archivo {f.filename} excede 15MB"}), 413
-
-        safe_name = unicodedata.normalize("NFD", (f.filename or "file")).encode("ascii", "ignore").decode("ascii")
-        safe_name = re.sub(r"[^A-Za-z0-9._-]+", "-", safe_name).strip("-.")
-
-        # ruta en el bucket algo como: inspections/<inspection_id>/<role or step>/<uuid>-<file>
-        subfolder = f"step-{step_id}" if (role == "step" and step_id is not None) else role
-        type_folder = f"{doc_type}/" if doc_type else ""
-        dest = f"inspections/{inspection_id}/{subfolder}/{type_folder}{uuid.uuid4().hex}-{safe_name}"
+    results = await asyncio.gather(*[_upload_one(item) for item in uploads], return_exceptions=True)
+    failed = [(item, r) for item, r in zip(uploads, results) if isinstance(r, BaseException)]
+    if failed:
+        # Todo o nada: limpiar lo que sí llegó a subirse para no dejar objetos huérfanos
+        uploaded = [path for item in uploads for path in item["uploaded"]]
+        if uploaded:
+            try:
+                await storage_remove(BUCKET_INSPECTION_DOCS, uploaded)
+            except Exception as e:
+                log.warning("No se pudieron limpiar subidas parciales de la inspección %s: %s", inspection_id, e)
+        item, exc = failed[0]
+        if not isinstance(exc, Exception):
+            raise exc
+        return _upload_error_response(item["file"].filename, exc)
+
+    # Metadata en un solo INSERT multi-fila y una sola conexión para todo el guardado
+    async with get_conn_ctx() as conn:
+        async with conn.transaction():
+            # Si corresponde, limpiar bandera is_front (para asegurar unicidad)
+            if doc_type == "vehicle_photo" and (front_idx is not None or front_existing_id is not None):
+                prev_urls = await conn.fetch("""
+                    SELECT file_url FROM inspection_documents
+                     WHERE inspection_id = $1
+                       AND type = 'vehicle_photo'
+                       AND (is_front = true OR id = $2)
+                """, inspection_id, front_existing_id)
+                invalidate_front_photos(r["file_url"] for r in prev_urls)
+                await conn.execute("""
+                    UPDATE inspection_documents
+                       SET is_front = false
+                     WHERE inspection_id = $1
+                       AND type = 'vehicle_photo'
+                """, inspection_id)
 
-        try:
-            _upload_to_storage_with_retry(
-                bucket=BUCKET_INSPECTION_DOCS,
-                dest=dest,
-                data=data,
-                content_type=f.mimetype or "application/octet-stream",
-                max_retries=3,
-            )
-        except Exception as e:
-            error_msg = str(e)
-            # Si el error contiene información sobre JSON, dar un mensaje más claro
-            if "JSONDecodeError" in error_msg or "Expecting value" in error_msg:
-                return jsonify({
-                    "error": f"No se pudo subir el archivo {f.filename}. Error de comunicación con el almacenamiento."
-                }), 502
-            status_code = 502 if _is_transient_storage_error(e) else 500
-            return jsonify({
-                "error": f"No se pudo subir el archivo {f.filename}: {error_msg}"
-            }), status_code
-
-        file_url = _public_url(BUCKET_INSPECTION_DOCS, dest)
-
-        async with get_conn_ctx() as conn:
-            row = await conn.fetchrow("""
+            rows = await conn.fetch("""
                 INSERT INTO inspection_documents
                   (inspection_id, step_id, role, type, file_name, bucket, object_path, file_url,
-                   size_bytes, mime_type, is_front)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, false)
+                   size_bytes, mime_type, is_front,
+                   display_object_path, display_url, thumb_object_path, thumb_url)
+                SELECT $1, $2, $3, $4, u.file_name, $5, u.object_path, u.file_url,
+                       u.size_bytes, u.mime_type, false,
+                       u.display_object_path, u.display_url, u.thumb_object_path, u.thumb_url
+                  FROM unnest($6::text[], $7::text[], $8::text[], $9::bigint[], $10::text[],
+                              $11::text[], $12::text[], $13::text[], $14::text[])
+                       WITH ORDINALITY AS u(file_name, object_path, file_url, size_bytes, mime_type,
+                                            display_object_path, display_url, thumb_object_path, thumb_url, ord)
+                 ORDER BY u.ord
                 RETURNING id, inspection_id, step_id, role, type,
                           file_name, bucket, object_path, file_url,
-                          size_bytes, mime_type, created_at, COALESCE(is_front,false) AS is_front
-            """, inspection_id, step_id, role, doc_type, safe_name,
-                 BUCKET_INSPECTION_DOCS, dest, file_url, len(data), f.mimetype)
-            saved.append(dict(row))
-
-    # Marcar como frente el documento indicado
-    if doc_type == "vehicle_photo":
-        chosen_doc_id = None
-        if front_idx is not None and 0 <= front_idx < len(saved):
-            chosen_doc_id = saved[front_idx]["id"]
-        elif front_existing_id is not None:
-            chosen_doc_id = front_existing_id
-
-        if chosen_doc_id is not None:
-            async with get_conn_ctx() as conn:
-                await conn.execute("""
-                    UPDATE inspection_documents
-                       SET is_front = CASE WHEN id = $2 THEN true ELSE false END
-                     WHERE inspection_id = $1
-                       AND type = 'vehicle_photo'
-                """, inspection_id, chosen_doc_id)
+                          size_bytes, mime_type, created_at, COALESCE(is_front,false) AS is_front,
+                          display_url, thumb_url
+            """, inspection_id, step_id, role, doc_type, BUCKET_INSPECTION_DOCS,
+                 [item["file_name"] for item in uploads],
+                 [item["dest"] for item in uploads],
+                 [storage_public_url(BUCKET_INSPECTION_DOCS, item["dest"]) for item in uploads],
+                 [item["size"] for item in uploads],
+                 [item["mime_type"] for item in uploads],
+                 [item["display_path"] for item in uploads],
+                 [storage_public_url(BUCKET_INSPECTION_DOCS, item["display_path"]) if item["display_path"] else None for item in uploads],
+                 [item["thumb_path"] for item in uploads],
+                 [storage_public_url(BUCKET_INSPECTION_DOCS, item["thumb_path"]) if item["thumb_path"] else None for item in uploads])
+
+            # RETURNING no garantiza orden: respetar el de los archivos recibidos
+            by_path = {r["object_path"]: dict(r) for r in rows}
+            saved = [by_path[item["dest"]] for item in uploads]
+
+            # Marcar como frente el documento indicado
+            if doc_type == "vehicle_photo":
+                chosen_doc_id = None
+                if front_idx is not None and 0 <= front_idx < len(saved):
+                    chosen_doc_id = saved[front_idx]["id"]
+                elif front_existing_id is not None:
+                    chosen_doc_id = front_existing_id
+
+                if chosen_doc_id is not None:
+                    await conn.execute("""
+                        UPDATE inspection_documents
+                           SET is_front = CASE WHEN id = $2 THEN true ELSE false END
+                         WHERE inspection_id = $1
+                           AND type = 'vehicle_photo'
+                    """, inspection_id, chosen_doc_id)
+                    for doc in saved:
+                        doc["is_front"] = doc["id"] == chosen_doc_id
 
     return jsonify(saved), 201
 
@@ -276,6 +367,15 @@ async def set_front_vehicle_photo(inspection_id: int):
         if (doc["type"] or "").strip().lower() != "vehicle_photo":
             return jsonify({"error": "El documento no es una foto de vehículo"}), 400
 
+        # El frente cambia: sacar del cache de certificados el anterior y el nuevo
+        prev_urls = await conn.fetch("""
+            SELECT file_url FROM inspection_documents
+             WHERE inspection_id = $1
+               AND type = 'vehicle_photo'
+               AND (is_front = true OR id = $2)
+        """, inspection_id, doc_id)
+        invalidate_front_photos(r["file_url"] for r in prev_urls)
+
         await conn.execute("""
             UPDATE inspection_documents
                SET is_front = false
@@ -300,16 +400,16 @@ async def delete_inspection_document(inspection_id: int, doc_id: int):
 
     async with get_conn_ctx() as conn:
         doc = await conn.fetchrow("""
-            SELECT id, bucket, object_path
+            SELECT id, bucket, object_path, file_url, display_object_path, thumb_object_path
             FROM inspection_documents
             WHERE id = $1 AND inspection_id = $2
         """, doc_id, inspection_id)
         if not doc:
             return jsonify({"error": "Documento no encontrado"}), 404
 
-        with supabase_dns_workaround():
-            client = get_supabase_client()
-            client.storage.from_(doc["bucket"]).remove([doc["object_path"]])
+        paths = [doc["object_path"], doc["display_object_path"], doc["thumb_object_path"]]
+        await storage_remove(doc["bucket"], [p for p in paths if p])
+        invalidate_front_photos([doc["file_url"]])
 
         await conn.execute("DELETE FROM inspection_documents WHERE id = $1", doc_id)
 
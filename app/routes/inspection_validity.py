@@ -1,5 +1,6 @@
 from quart import Blueprint, request, jsonify, g
 from app.db import get_conn_ctx
+from app.validity_rules import notify_rules_changed
 
 inspection_validity_bp = Blueprint("inspection_validity", __name__)
 
@@ -141,6 +142,7 @@ async def upsert_inspection_validity(province_code: str, localidad_key: str):
                     o7,
                     user_id,
                 )
+        await notify_rules_changed(conn)
 
     return jsonify({"message": "Validez guardada"}), 200
 
@@ -256,6 +258,7 @@ async def bulk_apply_inspection_validity(province_code: str):
                     """,
                     *params_list,
                 )
+        await notify_rules_changed(conn)
 
     return jsonify({"message": f"Aplicado a {len(loc_keys)} localidad(es)"}), 200
 
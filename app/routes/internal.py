@@ -0,0 +1,62 @@
+"""
+Endpoints internos de diagnóstico (métricas del proceso).
+Protegidos por API key via header X-Api-Key (INTERNAL_API_KEY, o CRON_API_KEY si no está).
+"""
+from quart import Blueprint, request, jsonify, current_app
+import os
+
+from app.admission import admission_stats
+from app.db import pool_stats
+from app.db_metrics import snapshot as query_snapshot
+from app.timing import snapshot
+
+internal_bp = Blueprint("internal", __name__)
+
+
+def _validate_api_key() -> bool:
+    api_key = request.headers.get("X-Api-Key")
+    expected = current_app.config.get("INTERNAL_API_KEY") or current_app.config.get("CRON_API_KEY")
+    if not expected:
+        return False
+    return api_key == expected and bool(api_key)
+
+
+@internal_bp.route("/metrics/stages", methods=["GET"])
+async def get_stage_metrics():
+    """
+    Histogramas de duración por etapa (generación de certificados, etc.) de este proceso,
+    incluido el tiempo en cola de admisión (queue_*), y el estado de cada cupo de admisión.
+    ?reset=1 vuelve a cero los histogramas después de leerlos.
+    """
+    if not _validate_api_key():
+        return jsonify({"error": "API key inválida o faltante"}), 401
+
+    reset = request.args.get("reset") == "1"
+    return jsonify({"pid": os.getpid(), "stages": snapshot(reset=reset), "admission": admission_stats()}), 200
+
+
+@internal_bp.route("/metrics/queries", methods=["GET"])
+async def get_query_metrics():
+    """
+    Consultas de este proceso agrupadas por blueprint y huella, ordenadas por tiempo total,
+    espera del pool por blueprint y últimas consultas lentas (parámetros redactados).
+    ?top=N limita la lista (50 por defecto), ?reset=1 vuelve todo a cero después de leerlo.
+    """
+    if not _validate_api_key():
+        return jsonify({"error": "API key inválida o faltante"}), 401
+
+    try:
+        top = int(request.args.get("top", "50"))
+    except ValueError:
+        return jsonify({"error": "top debe ser un entero"}), 400
+    reset = request.args.get("reset") == "1"
+    return jsonify({"pid": os.getpid(), **query_snapshot(top=top, reset=reset)}), 200
+
+
+@internal_bp.route("/metrics/pool", methods=["GET"])
+async def get_pool_metrics():
+    """Estado del pool de la base de este proceso: en uso, libres, en espera, timeouts, cupo de fondo."""
+    if not _validate_api_key():
+        return jsonify({"error": "API key inválida o faltante"}), 401
+
+    return jsonify({"pid": os.getpid(), "pool": pool_stats()}), 200
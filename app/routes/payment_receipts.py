@@ -1,12 +1,11 @@
 from quart import Blueprint, request, jsonify, g
 from app.db import get_conn_ctx
-from app.supabase_client import SUPABASE_URL, get_supabase_client, supabase_dns_workaround
+from app.supabase_client import is_transient_storage_error, storage_public_url, storage_remove, storage_upload
 import os
 import uuid
 import datetime as dt
 import unicodedata
 import re
-import time
 import logging
 
 payment_receipts_bp = Blueprint("payment_receipts", __name__, url_prefix="/payments")
@@ -19,58 +18,6 @@ IN_REVIEW = "IN_REVIEW"
 # ===== Supabase (storage) =====
 BUCKET_DOCS = os.getenv("SUPABASE_BUCKET_DOCS", "certificados")  # usa tu bucket existente
 
-def _public_url(bucket: str, path: str) -> str:
-    base = (SUPABASE_URL or "").rstrip("/")
-    return f"{base}/storage/v1/object/public/{bucket}/{path}"
-
-def _is_transient_storage_error(exc: Exception) -> bool:
-    error_msg = str(exc).lower()
-    error_type = type(exc).__name__.lower()
-    transient_markers = (
-        "temporary failure in name resolution",
-        "name resolution",
-        "connecterror",
-        "connectionerror",
-        "timed out",
-        "timeout",
-        "network is unreachable",
-        "connection reset",
-        "service unavailable",
-        "gateway timeout",
-    )
-    return any(marker in error_msg for marker in transient_markers) or any(
-        marker in error_type for marker in ("connecterror", "timeout", "connectionerror")
-    )
-
-def _upload_to_storage_with_retry(dest: str, data: bytes, content_type: str, max_retries: int = 3) -> None:
-    last_error = None
-    for attempt in range(1, max_retries + 1):
-        try:
-            with supabase_dns_workaround():
-                client = get_supabase_client()
-                client.storage.from_(BUCKET_DOCS).upload(
-                    path=dest,
-                    file=data,
-                    file_options={
-                        "content_type": content_type,
-                        "x-upsert": "true",
-                    },
-                )
-            return
-        except Exception as exc:
-            last_error = exc
-            if _is_transient_storage_error(exc) and attempt < max_retries:
-                backoff_seconds = 0.4 * (2 ** (attempt - 1))
-                log.warning(
-                    "Reintentando subida de comprobante (%s/%s) por error transitorio: %s",
-                    attempt,
-                    max_retries,
-                    exc,
-                )
-                time.sleep(backoff_seconds)
-                continue
-            raise last_error
-
 # ===== Helpers de acceso =====
 async def _is_admin(conn, user_id: int) -> bool:
     return await conn.fetchval("SELECT COALESCE(is_admin, false) FROM users WHERE id = $1", user_id)
@@ -145,19 +92,14 @@ async def upload_payment_receipt(order_id: int):
     dest = f"comprobantes/payments/{order_id}/{uuid.uuid4().hex}-{safe_name}"
 
     try:
-        _upload_to_storage_with_retry(
-            dest=dest,
-            data=data,
-            content_type=mime,
-            max_retries=3,
-        )
+        await storage_upload(BUCKET_DOCS, dest, data, content_type=mime)
     except Exception as e:
-        status_code = 502 if _is_transient_storage_error(e) else 500
+        status_code = 502 if is_transient_storage_error(e) else 500
         return jsonify({
             "error": f"No se pudo subir el comprobante {f.filename}: {str(e)}"
         }), status_code
 
-    url = _public_url(BUCKET_DOCS, dest)
+    url = storage_public_url(BUCKET_DOCS, dest)
     # guardar en la orden y cambiar estado de PENDING a IN_REVIEW si corresponde
     # Reutilizamos el estado obtenido anteriormente en la validación
     current_status = order["status"]
@@ -262,9 +204,7 @@ async def delete_payment_receipt(order_id: int):
       object_path = receipt_url.split(marker, 1)[-1]
       object_path = f"comprobantes/{object_path}"
 
-    with supabase_dns_workaround():
-        client = get_supabase_client()
-        client.storage.from_(bucket).remove([object_path])
+    await storage_remove(bucket, [object_path])
 
     async with get_conn_ctx() as conn:
         await conn.execute(
@@ -1,7 +1,7 @@
 # app/blueprints/payments_admin.py
 from quart import Blueprint, request, jsonify, g, Response
 from app.db import get_conn_ctx
-from app.supabase_client import get_supabase_client, supabase_dns_workaround
+from app.supabase_client import storage_download
 import os
 import logging
 import httpx
@@ -40,7 +40,7 @@ async def admin_list_orders():
     if not user_id:
         return jsonify({"error": "No autorizado"}), 401
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         if not await _is_admin(conn, user_id):
             return jsonify({"error": "Requiere admin"}), 403
 
@@ -314,9 +314,7 @@ async def admin_download_receipt(order_id: int):
 
     # Descargar el archivo desde Supabase usando service role key
     try:
-        with supabase_dns_workaround():
-            client = get_supabase_client()
-            file_bytes = client.storage.from_(bucket).download(object_path)
+        file_bytes = await storage_download(bucket, object_path)
     except Exception as e:
         logger.exception("admin_download_receipt, error descargando de Supabase, %s", _log_ctx(order_id=order_id))
         return jsonify({"error": "No se pudo descargar el archivo"}), 502
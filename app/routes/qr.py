@@ -3,98 +3,98 @@ from app.db import get_conn_ctx
 
 qr_bp = Blueprint("qr", __name__)
 
+# Sticker con su auto, taller y última aplicación completada (la usa también benchmarks/)
+QR_DATA_SQL = """
+WITH base AS (
+  SELECT
+    c.id              AS car_id,
+    c.license_plate,
+    c.brand,
+    c.model,
+    c.registration_year,
+    s.sticker_number,
+    s.status          AS sticker_status,
+    w.cuit,
+    w.razon_social,
+    w.province,
+    w.city,
+    w.address,
+    w.name
+  FROM stickers s
+  LEFT JOIN cars c           ON c.sticker_id = s.id
+  LEFT JOIN sticker_orders so ON so.id = s.sticker_order_id
+  LEFT JOIN workshop w        ON w.id = so.workshop_id
+  WHERE s.sticker_number = $1
+)
+SELECT
+  b.car_id,
+  b.license_plate,
+  b.brand,
+  b.model,
+  b.name,
+  b.registration_year,
+  b.sticker_number,
+  b.sticker_status,
+  b.cuit,
+  b.razon_social,
+  b.province,
+  b.city,
+  b.address,
+  la.id      AS application_id,
+  la.date    AS application_date,
+  la.status  AS application_status,
+  la.result  AS application_result,
+  la.result_2 AS application_result_2,
+  li.inspection_id,
+  li.expiration_date AS expiration_date,
+  li.inspection_created_at,
+  li.is_second AS is_second_inspection,
+  li_first.first_inspection_id,
+  li_second.second_inspection_id
+FROM base b
+LEFT JOIN LATERAL (
+  SELECT a.id, a.date, a.status, a.result, a.result_2
+  FROM applications a
+  WHERE a.car_id = b.car_id
+  AND a.status = 'Completado'
+  ORDER BY a.date DESC NULLS LAST, a.id DESC
+  LIMIT 1
+) la ON TRUE
+LEFT JOIN LATERAL (
+  SELECT i.id AS inspection_id, i.expiration_date, i.created_at AS inspection_created_at, COALESCE(i.is_second, FALSE) AS is_second
+  FROM inspections i
+  WHERE i.application_id = la.id
+  ORDER BY 
+    CASE 
+      WHEN la.result_2 IS NOT NULL AND COALESCE(i.is_second, FALSE) = TRUE THEN 0
+      WHEN la.result_2 IS NULL AND COALESCE(i.is_second, FALSE) = FALSE THEN 0
+      ELSE 1
+    END,
+    i.id DESC
+  LIMIT 1
+) li ON TRUE
+LEFT JOIN LATERAL (
+  SELECT i.id AS first_inspection_id
+  FROM inspections i
+  WHERE i.application_id = la.id
+    AND COALESCE(i.is_second, FALSE) = FALSE
+  ORDER BY i.id ASC
+  LIMIT 1
+) li_first ON TRUE
+LEFT JOIN LATERAL (
+  SELECT i.id AS second_inspection_id
+  FROM inspections i
+  WHERE i.application_id = la.id
+    AND COALESCE(i.is_second, FALSE) = TRUE
+  ORDER BY i.id ASC
+  LIMIT 1
+) li_second ON TRUE
+"""
+
 @qr_bp.route("/get-qr-data/<string:sticker_number>", methods=["GET"])
 async def get_qr_data(sticker_number: str):
-    async with get_conn_ctx() as conn:
-        row = await conn.fetchrow(
-            """
-            WITH base AS (
-              SELECT
-                c.id              AS car_id,
-                c.license_plate,
-                c.brand,
-                c.model,
-                c.registration_year,
-                s.sticker_number,
-                s.status          AS sticker_status,
-                w.cuit,
-                w.razon_social,
-                w.province,
-                w.city,
-                w.address,
-                w.name
-              FROM stickers s
-              LEFT JOIN cars c           ON c.sticker_id = s.id
-              LEFT JOIN sticker_orders so ON so.id = s.sticker_order_id
-              LEFT JOIN workshop w        ON w.id = so.workshop_id
-              WHERE s.sticker_number = $1
-            )
-            SELECT
-              b.car_id,
-              b.license_plate,
-              b.brand,
-              b.model,
-              b.name,
-              b.registration_year,
-              b.sticker_number,
-              b.sticker_status,
-              b.cuit,
-              b.razon_social,
-              b.province,
-              b.city,
-              b.address,
-              la.id      AS application_id,
-              la.date    AS application_date,
-              la.status  AS application_status,
-              la.result  AS application_result,
-              la.result_2 AS application_result_2,
-              li.inspection_id,
-              li.expiration_date AS expiration_date,
-              li.inspection_created_at,
-              li.is_second AS is_second_inspection,
-              li_first.first_inspection_id,
-              li_second.second_inspection_id
-            FROM base b
-            LEFT JOIN LATERAL (
-              SELECT a.id, a.date, a.status, a.result, a.result_2
-              FROM applications a
-              WHERE a.car_id = b.car_id
-              AND a.status = 'Completado'
-              ORDER BY a.date DESC NULLS LAST, a.id DESC
-              LIMIT 1
-            ) la ON TRUE
-            LEFT JOIN LATERAL (
-              SELECT i.id AS inspection_id, i.expiration_date, i.created_at AS inspection_created_at, COALESCE(i.is_second, FALSE) AS is_second
-              FROM inspections i
-              WHERE i.application_id = la.id
-              ORDER BY 
-                CASE 
-                  WHEN la.result_2 IS NOT NULL AND COALESCE(i.is_second, FALSE) = TRUE THEN 0
-                  WHEN la.result_2 IS NULL AND COALESCE(i.is_second, FALSE) = FALSE THEN 0
-                  ELSE 1
-                END,
-                i.id DESC
-              LIMIT 1
-            ) li ON TRUE
-            LEFT JOIN LATERAL (
-              SELECT i.id AS first_inspection_id
-              FROM inspections i
-              WHERE i.application_id = la.id
-                AND COALESCE(i.is_second, FALSE) = FALSE
-              ORDER BY i.id ASC
-              LIMIT 1
-            ) li_first ON TRUE
-            LEFT JOIN LATERAL (
-              SELECT i.id AS second_inspection_id
-              FROM inspections i
-              WHERE i.application_id = la.id
-                AND COALESCE(i.is_second, FALSE) = TRUE
-              ORDER BY i.id ASC
-              LIMIT 1
-            ) li_second ON TRUE
-            """,
-            sticker_number
-        )
+    async with get_conn_ctx(readonly=True) as conn:
+        row = await conn.fetchrow(QR_DATA_SQL, sticker_number)
 
     if not row:
         return jsonify({"error": "Sticker no encontrado"}), 404
@@ -192,7 +192,8 @@ async def get_vehicle_photos(inspection_id: int):
             SELECT id, inspection_id, step_id, role,
                    type, file_name, bucket, object_path, file_url,
                    size_bytes, mime_type, created_at,
-                   COALESCE(is_front, false) AS is_front
+                   COALESCE(is_front, false) AS is_front,
+                   display_url, thumb_url
             FROM inspection_documents
             WHERE inspection_id = $1
               AND type = 'vehicle_photo'
@@ -40,7 +40,7 @@ async def statistics_overview(workshop_id: int):
         await _auth()
         date_from, date_to = _range()
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             row = await conn.fetchrow(
                 """
                 WITH base AS (
@@ -108,7 +108,7 @@ async def statistics_daily(workshop_id: int):
         await _auth()
         date_from, date_to = _range()
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 WITH base AS (
@@ -161,7 +161,7 @@ async def statistics_status_breakdown(workshop_id: int):
     try:
         await _auth()
         date_from, date_to = _range()
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 SELECT status, COUNT(*) AS c
@@ -194,7 +194,7 @@ async def statistics_results_breakdown(workshop_id: int):
     try:
         await _auth()
         date_from, date_to = _range()
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 SELECT result, COUNT(*) AS c
@@ -231,7 +231,7 @@ async def statistics_top_models(workshop_id: int):
         limit = request.args.get("limit", 8, type=int)
         limit = max(1, min(limit, 50))
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 SELECT c.brand, c.model, COUNT(*) AS c
@@ -270,7 +270,7 @@ async def statistics_top_brands(workshop_id: int):
         limit = request.args.get("limit", 5, type=int)
         limit = max(1, min(limit, 50))
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 SELECT c.brand, COUNT(*) AS c
@@ -304,7 +304,7 @@ async def statistics_usage_types(workshop_id: int):
         await _auth()
         date_from, date_to = _range()
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 SELECT c.usage_type, COUNT(*) AS c
@@ -343,7 +343,7 @@ async def statistics_common_errors(workshop_id: int):
         limit = request.args.get("limit", 3, type=int)
         limit = max(1, min(limit, 20))
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 SELECT s.name AS step_name, COUNT(*) AS c
@@ -397,7 +397,7 @@ async def statistics_upcoming_expirations(workshop_id: int):
         today_ar = datetime.datetime.now(ar).date()
         max_date = today_ar + datetime.timedelta(days=90)
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             rows = await conn.fetch(
                 """
                 SELECT
@@ -468,7 +468,7 @@ async def statistics_lost_stickers(workshop_id: int):
         await _auth()
         date_from, date_to = _range()
 
-        async with get_conn_ctx() as conn:
+        async with get_conn_ctx(readonly=True) as conn:
             count = await conn.fetchval(
                 """
                 SELECT COUNT(DISTINCT s.id) AS c
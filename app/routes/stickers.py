@@ -18,7 +18,7 @@ async def list_available_stickers():
     if not workshop_id:
         return jsonify({"error": "workshop_id requerido"}), 400
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         rows = await conn.fetch(
             """
             SELECT
@@ -57,7 +57,7 @@ async def list_available_orders():
     if not workshop_id:
         return jsonify({"error": "workshop_id requerido"}), 400
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         rows = await conn.fetch(
             """
             SELECT
@@ -108,7 +108,7 @@ async def list_orders():
     ORDER BY so.id DESC
     """
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         rows = await conn.fetch(sql, workshop_id)
 
     out = [dict(r) for r in rows]
@@ -121,7 +121,7 @@ async def list_sticker_orders():
     if not workshop_id:
         return jsonify({"error": "workshop_id requerido"}), 400
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         rows = await conn.fetch(
             """
             SELECT
@@ -302,7 +302,7 @@ async def get_stickers_by_workshop(workshop_id: int):
     
     offset = (page - 1) * per_page
 
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         # Build search condition
         if q:
             search_pattern = f"%{q}%"
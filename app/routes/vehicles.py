@@ -20,7 +20,7 @@ async def get_vehicle_data(license_plate: str):
     no 2), devuelve un error indicando que debe continuar el trámite en lugar de
     devolver la información del vehículo.
     """
-    async with get_conn_ctx() as conn:
+    async with get_conn_ctx(readonly=True) as conn:
         row = await conn.fetchrow(
             """
             SELECT
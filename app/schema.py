@@ -0,0 +1,154 @@
+# app/schema.py
+"""
+DDL idempotente que necesita el backend y no existe en el esquema base.
+
+Se ejecuta al arrancar cada worker (ver create_app). Todas las sentencias usan
+IF NOT EXISTS (las columnas nuevas se comparan antes contra information_schema) y
+corren dentro de una transacción con advisory lock, así varios workers arrancando a
+la vez no compiten por crear lo mismo. Se puede desactivar
+con DB_AUTO_MIGRATE=0 si el esquema se administra por fuera: en ese caso hay que
+correr este DDL antes del deploy (python -m app.schema lo imprime). En los dos casos,
+si al terminar falta alguna tabla o columna, el arranque falla con la lista de lo que
+falta en vez de devolver 500 en cada generación.
+"""
+import logging
+import os
+
+from app.db import get_conn_ctx
+
+log = logging.getLogger(__name__)
+
+SCHEMA_STATEMENTS: list[str] = [
+    # Cola de jobs durable (app/jobs.py)
+    """
+    CREATE TABLE IF NOT EXISTS background_jobs (
+        id            uuid PRIMARY KEY,
+        kind          text,
+        status        text NOT NULL DEFAULT 'pending',
+        payload       jsonb,
+        attachment    bytea,
+        result        jsonb,
+        error         text,
+        attempts      integer NOT NULL DEFAULT 0,
+        max_attempts  integer NOT NULL DEFAULT 1,
+        run_at        timestamptz NOT NULL DEFAULT NOW(),
+        locked_until  timestamptz,
+        created_at    timestamptz NOT NULL DEFAULT NOW(),
+        updated_at    timestamptz NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS background_jobs_ready_idx
+        ON background_jobs (run_at)
+        WHERE kind IS NOT NULL AND status IN ('pending', 'running')
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS background_jobs_updated_at_idx
+        ON background_jobs (updated_at)
+    """,
+    # Última emisión de cada certificado, para no repetirla (idempotencia)
+    """
+    CREATE TABLE IF NOT EXISTS certificate_render_keys (
+        application_id  bigint NOT NULL,
+        is_second       boolean NOT NULL DEFAULT false,
+        render_hash     text NOT NULL,
+        storage_path    text NOT NULL,
+        public_url      text,
+        job_id          uuid,
+        updated_at      timestamptz NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (application_id, is_second)
+    )
+    """,
+]
+
+# Columnas agregadas a tablas existentes: tabla -> [(columna, tipo)]. Solo se hace el ALTER
+# si falta alguna, porque ALTER TABLE toma ACCESS EXCLUSIVE aunque la columna ya exista y
+# estas tablas se leen todo el tiempo
+SCHEMA_COLUMNS: dict[str, list[tuple[str, str]]] = {
+    # Variantes de fotos generadas al subir (app/image_variants.py)
+    "inspection_documents": [
+        ("display_object_path", "text"),
+        ("display_url", "text"),
+        ("thumb_object_path", "text"),
+        ("thumb_url", "text"),
+    ],
+    # Job de post-proceso que todavía no terminó (NULL = emisión ya subida)
+    "certificate_render_keys": [
+        ("job_id", "uuid"),
+    ],
+}
+
+
+async def _add_missing_columns(conn) -> None:
+    for table, columns in SCHEMA_COLUMNS.items():
+        existing = {
+            r["column_name"]
+            for r in await conn.fetch(
+                """
+                SELECT column_name
+                  FROM information_schema.columns
+                 WHERE table_schema = current_schema() AND table_name = $1
+                """,
+                table,
+            )
+        }
+        missing = [(name, type_) for name, type_ in columns if name not in existing]
+        if not missing:
+            continue
+        adds = ", ".join(f"ADD COLUMN IF NOT EXISTS {name} {type_}" for name, type_ in missing)
+        await conn.execute(f"ALTER TABLE {table} {adds}")
+        log.info("Columnas agregadas a %s: %s", table, ", ".join(name for name, _ in missing))
+
+
+# Tablas que crea SCHEMA_STATEMENTS y sin las que el backend no funciona
+SCHEMA_TABLES: list[str] = ["background_jobs", "certificate_render_keys"]
+
+
+async def _missing_schema(conn) -> list[str]:
+    rows = await conn.fetch(
+        """
+        SELECT table_name, column_name
+          FROM information_schema.columns
+         WHERE table_schema = current_schema() AND table_name = ANY($1::text[])
+        """,
+        list(set(SCHEMA_TABLES) | set(SCHEMA_COLUMNS)),
+    )
+    existing = {(r["table_name"], r["column_name"]) for r in rows}
+    tables = {table for table, _ in existing}
+    missing = [table for table in SCHEMA_TABLES if table not in tables]
+    for table, columns in SCHEMA_COLUMNS.items():
+        missing += [f"{table}.{name}" for name, _ in columns if (table, name) not in existing]
+    return missing
+
+
+async def ensure_schema() -> None:
+    if os.getenv("DB_AUTO_MIGRATE", "1") == "1":
+        try:
+            async with get_conn_ctx() as conn:
+                async with conn.transaction():
+                    await conn.execute("SELECT pg_advisory_xact_lock(hashtext('svt_backend_schema'))")
+                    for stmt in SCHEMA_STATEMENTS:
+                        await conn.execute(stmt)
+                    await _add_missing_columns(conn)
+        except Exception as e:
+            log.exception("No se pudo aplicar el esquema auxiliar: %s", e)
+    async with get_conn_ctx() as conn:
+        missing = await _missing_schema(conn)
+    if missing:
+        raise RuntimeError(
+            "Falta esquema que necesita el backend: " + ", ".join(missing)
+            + ". Con DB_AUTO_MIGRATE=0 hay que aplicar el DDL de app/schema.py (python -m app.schema)"
+        )
+
+
+def schema_sql() -> str:
+    """El DDL completo, para aplicarlo a mano cuando DB_AUTO_MIGRATE=0."""
+    stmts = [stmt.strip() for stmt in SCHEMA_STATEMENTS]
+    for table, columns in SCHEMA_COLUMNS.items():
+        adds = ", ".join(f"ADD COLUMN IF NOT EXISTS {name} {type_}" for name, type_ in columns)
+        stmts.append(f"ALTER TABLE {table} {adds}")
+    return ";\n\n".join(stmts) + ";\n"
+
+
+if __name__ == "__main__":
+    print(schema_sql())
@@ -7,11 +7,13 @@ entornos (otro host Supabase) no ven resolución forzada.
 
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
 from contextlib import contextmanager
 from urllib.parse import urlparse
 
+import httpx
 from supabase import Client, create_client
 
 from app.dns_forced_resolution import forced_dns_resolution
@@ -49,3 +51,212 @@ def supabase_dns_workaround():
     )
     with forced_dns_resolution(hostname, _SUPABASE_DO_DNS_PATCH_IPS):
         yield
+
+
+# ---------- Storage async (REST directo) ----------
+# Un único httpx.AsyncClient por proceso: reutiliza conexiones keep-alive (HTTP/2 si está
+# instalado h2) en lugar de abrir una sesión TLS nueva por archivo, y los reintentos usan
+# asyncio.sleep para no bloquear el event loop.
+
+STORAGE_TIMEOUT_SECONDS = float(os.getenv("SUPABASE_STORAGE_TIMEOUT_SECONDS", "30"))
+STORAGE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_STORAGE_MAX_CONNECTIONS", "20"))
+STORAGE_MAX_RETRIES = int(os.getenv("SUPABASE_STORAGE_MAX_RETRIES", "3"))
+
+_TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+_TRANSIENT_MARKERS = (
+    "ssl", "eof", "protocol", "connection", "timeout", "timed out", "broken pipe",
+    "tls", "socket", "closed", "reset", "temporary failure in name resolution",
+    "name resolution", "network is unreachable", "service unavailable", "gateway timeout",
+)
+
+_storage_client: httpx.AsyncClient | None = None
+
+
+class StorageError(RuntimeError):
+    def __init__(self, message: str, status_code: int | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_transient_storage_error(exc: Exception) -> bool:
+    """Clasifica en un solo lugar si vale la pena reintentar una operación de storage."""
+    if isinstance(exc, StorageError) and exc.status_code is not None:
+        return exc.status_code in _TRANSIENT_STATUS_CODES
+    if isinstance(exc, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    error_msg = str(exc).lower()
+    error_type = type(exc).__name__.lower()
+    return any(marker in error_msg for marker in _TRANSIENT_MARKERS) or any(
+        marker in error_type for marker in ("sslerror", "connecterror", "connectionerror", "timeout")
+    )
+
+
+def storage_public_url(bucket: str, path: str) -> str:
+    base = (SUPABASE_URL or "").rstrip("/")
+    return f"{base}/storage/v1/object/public/{bucket}/{path}"
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _get_storage_client() -> httpx.AsyncClient:
+    global _storage_client
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise RuntimeError("Faltan SUPABASE_URL o SUPABASE_SERVICE_ROLE_KEY")
+    if _storage_client is None or _storage_client.is_closed:
+        _storage_client = httpx.AsyncClient(
+            http2=_http2_available(),
+            timeout=httpx.Timeout(STORAGE_TIMEOUT_SECONDS, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=STORAGE_MAX_CONNECTIONS,
+                max_keepalive_connections=STORAGE_MAX_CONNECTIONS,
+                keepalive_expiry=60.0,
+            ),
+            headers={
+                "Authorization": f"Bearer {SUPABASE_KEY}",
+                "apikey": SUPABASE_KEY,
+            },
+        )
+    return _storage_client
+
+
+async def close_storage_client() -> None:
+    global _storage_client
+    if _storage_client is not None:
+        await _storage_client.aclose()
+        _storage_client = None
+
+
+def _storage_origins() -> list[tuple[str, dict, dict]]:
+    """
+    Orígenes a probar, en orden: (base_url, headers extra, extensions).
+
+    Para el proyecto con DNS intermitente en App Platform nos conectamos directo a las IPs
+    conocidas y mandamos el hostname real por Host y SNI, así el certificado se valida
+    contra el host correcto. Es el equivalente async de supabase_dns_workaround().
+    """
+    base = (SUPABASE_URL or "").rstrip("/")
+    parsed = urlparse(base)
+    hostname = (parsed.hostname or "").lower().rstrip(".")
+    if hostname != _SUPABASE_DO_DNS_PATCH_HOST:
+        return [(base, {}, {})]
+    return [
+        (f"{parsed.scheme}://{ip}", {"Host": hostname}, {"sni_hostname": hostname})
+        for ip in _SUPABASE_DO_DNS_PATCH_IPS
+    ]
+
+
+async def _storage_request(
+    method: str,
+    path: str,
+    *,
+    content=None,
+    json=None,
+    headers: dict | None = None,
+    max_retries: int | None = None,
+) -> httpx.Response:
+    """
+    `content` puede ser bytes o una función sin argumentos que devuelva un iterador
+    async de chunks; en ese caso se pide un iterador nuevo en cada intento.
+    """
+    client = _get_storage_client()
+    retries = max(1, max_retries or STORAGE_MAX_RETRIES)
+    origins = _storage_origins()
+    last_error: Exception | None = None
+
+    for attempt in range(1, retries + 1):
+        # Ante errores de conexión se rota al siguiente origen (IP de fallback)
+        base, origin_headers, extensions = origins[(attempt - 1) % len(origins)]
+        try:
+            resp = await client.request(
+                method,
+                f"{base}/storage/v1/{path}",
+                content=content() if callable(content) else content,
+                json=json,
+                headers={**(headers or {}), **origin_headers},
+                extensions=extensions or None,
+            )
+            if resp.status_code >= 400:
+                raise StorageError(
+                    f"Storage respondió {resp.status_code}: {resp.text[:300]}",
+                    status_code=resp.status_code,
+                )
+            return resp
+        except Exception as exc:
+            last_error = exc
+            if is_transient_storage_error(exc) and attempt < retries:
+                backoff_seconds = 0.4 * (2 ** (attempt - 1))
+                log.warning(
+                    "Storage: error transitorio en %s %s (%s/%s), reintentando en %.1fs: %s",
+                    method, path, attempt, retries, backoff_seconds, exc,
+                )
+                await asyncio.sleep(backoff_seconds)
+                continue
+            raise
+    raise last_error or StorageError("No se pudo completar la operación de storage")
+
+
+async def storage_upload(
+    bucket: str,
+    path: str,
+    data,
+    content_type: str,
+    upsert: bool = True,
+    max_retries: int | None = None,
+    content_length: int | None = None,
+) -> str:
+    """
+    Sube un objeto y devuelve su URL pública.
+
+    `data` puede ser bytes o una fábrica de iteradores async (ver _storage_request);
+    para esto último conviene pasar content_length y evitar chunked encoding.
+    """
+    headers = {
+        "Content-Type": content_type or "application/octet-stream",
+        "x-upsert": "true" if upsert else "false",
+        "cache-control": "max-age=3600",
+    }
+    if content_length is not None:
+        headers["Content-Length"] = str(content_length)
+    await _storage_request(
+        "POST",
+        f"object/{bucket}/{path}",
+        max_retries=max_retries,
+        content=data,
+        headers=headers,
+    )
+    return storage_public_url(bucket, path)
+
+
+async def storage_download(bucket: str, path: str, max_retries: int | None = None) -> bytes:
+    resp = await _storage_request("GET", f"object/{bucket}/{path}", max_retries=max_retries)
+    return resp.content
+
+
+async def storage_remove(bucket: str, paths: list[str], max_retries: int | None = None) -> None:
+    await _storage_request(
+        "DELETE",
+        f"object/{bucket}",
+        max_retries=max_retries,
+        json={"prefixes": list(paths)},
+    )
+
+
+async def storage_fetch_url(url: str, max_retries: int | None = None) -> bytes:
+    """
+    Descarga una URL pública. Si es del storage propio pasa por el cliente compartido
+    (pool keep-alive, reintentos y workaround DNS); si no, un GET directo.
+    """
+    public_prefix = f"{(SUPABASE_URL or '').rstrip('/')}/storage/v1/"
+    if SUPABASE_URL and url.startswith(public_prefix):
+        resp = await _storage_request("GET", url[len(public_prefix):], max_retries=max_retries)
+        return resp.content
+    async with httpx.AsyncClient(timeout=STORAGE_TIMEOUT_SECONDS, follow_redirects=True) as client:
+        resp = await client.get(url)
+        resp.raise_for_status()
+        return resp.content
@@ -0,0 +1,87 @@
+# app/template_store.py
+"""
+Templates PDF de certificados en memoria, invalidados por cambio de archivo.
+
+Cada entrada guarda la identidad del archivo (inode, mtime_ns, tamaño). Una consulta hace
+solo un os.stat: si la identidad no cambió se devuelven los mismos bytes y hash, si cambió
+(edición en el lugar o reemplazo atómico con rename) se relee en ese momento. No hay TTL
+ni relecturas periódicas.
+
+Los bytes son una memoryview de solo lectura sobre un mmap del archivo: el proceso web y
+los workers del renderer comparten las mismas páginas del page cache en vez de tener cada
+uno su copia. Los templates se actualizan reemplazándolos (rename); truncar en el lugar un
+archivo mapeado hace fallar a quien lo esté leyendo en ese momento.
+
+Lo usan el proceso web (app/routes/certificates.py) y los workers del renderer, así una
+edición del template se ve en el siguiente certificado en ambos.
+"""
+import hashlib
+import mmap
+import os
+import threading
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils", "templates")
+
+
+def resolve_template_path(template_path: str) -> str:
+    # Rutas relativas a app/utils/templates
+    if not os.path.isabs(template_path):
+        template_path = os.path.join(TEMPLATES_DIR, template_path)
+    return os.path.normpath(template_path)
+
+
+def _file_identity(st: os.stat_result) -> tuple[int, int, int]:
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class TemplateStore:
+    def __init__(self):
+        # ruta -> (identidad, vista del mmap, sha256)
+        self._entries: dict[str, tuple[tuple[int, int, int], memoryview, str]] = {}
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def cached(self, template_path: str) -> tuple[memoryview, str] | None:
+        """(bytes, sha256) si la copia en memoria sigue vigente, sin leer el archivo."""
+        full_path = resolve_template_path(template_path)
+        entry = self._entries.get(full_path)
+        if entry is None:
+            return None
+        try:
+            identity = _file_identity(os.stat(full_path))
+        except OSError:
+            return None
+        if identity != entry[0]:
+            return None
+        return entry[1], entry[2]
+
+    def get(self, template_path: str) -> tuple[memoryview, str]:
+        """(bytes, sha256) vigentes, volviendo a mapear el archivo si cambió. Bloqueante."""
+        hit = self.cached(template_path)
+        if hit is not None:
+            return hit
+        full_path = resolve_template_path(template_path)
+        with self._lock:
+            with open(full_path, "rb") as fh:
+                # Identidad del archivo abierto: si lo reemplazan mientras leemos, la próxima
+                # consulta ve otro inode y vuelve a leer
+                identity = _file_identity(os.fstat(fh.fileno()))
+                if not identity[2]:
+                    raise RuntimeError("Template está vacío")
+                # El mapeo sigue vigente después de cerrar el archivo; se libera cuando
+                # nadie más referencia la vista
+                data = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+            digest = hashlib.sha256(data).hexdigest()
+            self._entries[full_path] = (identity, data, digest)
+            self.reloads += 1
+        return data, digest
+
+    def digest_of(self, data: bytes | memoryview) -> str | None:
+        """sha256 ya calculado si `data` es uno de los templates en memoria."""
+        for _, entry_data, digest in list(self._entries.values()):
+            if entry_data is data:
+                return digest
+        return None
+
+
+TEMPLATE_STORE = TemplateStore()
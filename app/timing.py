@@ -0,0 +1,113 @@
+# app/timing.py
+"""
+Medición liviana de etapas por request.
+
+    with stage("db_load"):
+        ...
+    photo = await timed("photo", _load_front_photo_async(doc))
+
+Cada etapa queda en la lista del request actual (contextvar, así los awaits concurrentes
+de un mismo request suman a la misma lista) y en un histograma global por etapa. El hook
+after_request de la app vuelca la lista en el header Server-Timing, y los histogramas se
+consultan desde /internal/metrics/stages. Los histogramas son por proceso.
+"""
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Límites superiores de los buckets, en milisegundos
+_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_request_spans: ContextVar[list | None] = ContextVar("request_spans", default=None)
+
+_lock = threading.Lock()
+_histograms: dict[str, dict] = {}
+
+
+def start_request_timing() -> None:
+    _request_spans.set([])
+
+
+def request_spans() -> list[tuple[str, float]]:
+    return _request_spans.get() or []
+
+
+def record(name: str, seconds: float) -> None:
+    """Registra una duración. Fuera de un request (jobs) solo alimenta el histograma."""
+    ms = seconds * 1000.0
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, ms))
+    with _lock:
+        h = _histograms.get(name)
+        if h is None:
+            h = _histograms[name] = {"count": 0, "sum_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(_BUCKETS_MS) + 1)}
+        h["count"] += 1
+        h["sum_ms"] += ms
+        h["max_ms"] = max(h["max_ms"], ms)
+        idx = len(_BUCKETS_MS)
+        for i, limit in enumerate(_BUCKETS_MS):
+            if ms <= limit:
+                idx = i
+                break
+        h["buckets"][idx] += 1
+
+
+@contextmanager
+def stage(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0)
+
+
+async def timed(name: str, awaitable):
+    with stage(name):
+        return await awaitable
+
+
+def server_timing_header(spans: list[tuple[str, float]]) -> str:
+    # Etapas repetidas (p. ej. un batch) se suman en una sola entrada
+    totals: dict[str, float] = {}
+    for name, ms in spans:
+        key = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+        totals[key] = totals.get(key, 0.0) + ms
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in totals.items())
+
+
+def _quantile(buckets: list[int], count: int, q: float) -> float | None:
+    # Aproximado: límite superior del bucket donde cae el cuantil
+    if not count:
+        return None
+    target = q * count
+    acc = 0
+    for i, n in enumerate(buckets):
+        acc += n
+        if acc >= target:
+            return float(_BUCKETS_MS[i]) if i < len(_BUCKETS_MS) else None
+    return None
+
+
+def snapshot(reset: bool = False) -> dict:
+    with _lock:
+        out = {}
+        for name, h in sorted(_histograms.items()):
+            count = h["count"]
+            out[name] = {
+                "count": count,
+                "avg_ms": round(h["sum_ms"] / count, 2) if count else None,
+                "max_ms": round(h["max_ms"], 2),
+                "p50_ms": _quantile(h["buckets"], count, 0.50),
+                "p95_ms": _quantile(h["buckets"], count, 0.95),
+                "p99_ms": _quantile(h["buckets"], count, 0.99),
+                "buckets_ms": {
+                    **{f"le_{limit}": n for limit, n in zip(_BUCKETS_MS, h["buckets"])},
+                    "le_inf": h["buckets"][-1],
+                },
+            }
+        if reset:
+            _histograms.clear()
+        return out
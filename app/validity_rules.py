@@ -0,0 +1,226 @@
+# app/validity_rules.py
+"""
+Índice en memoria de inspection_validity_rules para calcular vencimientos sin ir a la base.
+
+Las reglas solo cambian desde los endpoints de inspection_validity, que después del commit llaman
+a notify_rules_changed(): recarga el proceso actual y hace pg_notify para los demás workers.
+
+- Con DB_LISTEN_HOST configurado (conexión directa a Postgres, no a PgBouncer en modo
+  transacción, donde LISTEN no es confiable) cada proceso escucha el canal y recarga.
+- Sin LISTEN activo (no configurado o caído), index_is_current() compara la versión barata
+  (count + max(updated_at)) en cada búsqueda: si cambió, esa búsqueda va a la base y se
+  agenda la recarga, así ningún worker usa reglas viejas.
+- Siempre corre además el mismo chequeo periódico como respaldo, cada
+  VALIDITY_RULES_POLL_SECONDS.
+
+La búsqueda replica la consulta original: reglas cuya localidad_key es igual a la pedida o
+la extiende (LIKE key || '%'), prefiriendo el mismo usage_code, después 'C' y después
+cualquiera; a igual uso, primero la coincidencia exacta y después la key menor.
+"""
+import asyncio
+import logging
+import os
+import ssl
+
+import asyncpg
+
+from app.db import get_conn_ctx
+
+log = logging.getLogger(__name__)
+
+VALIDITY_RULES_CHANNEL = "inspection_validity_rules_changed"
+VALIDITY_RULES_POLL_SECONDS = float(os.getenv("VALIDITY_RULES_POLL_SECONDS", "60"))
+
+_RULE_FIELDS = ("localidad_key", "usage_code", "up_to_36_months", "from_3_to_7_years", "over_7_years")
+
+_index: "_RulesTrie | None" = None
+_version = None
+_lookup_memo: dict[tuple[str, str], dict | None] = {}
+_reload_lock: asyncio.Lock | None = None
+_tasks: list[asyncio.Task] = []
+_listen_conn: asyncpg.Connection | None = None
+_pending_reload: asyncio.Task | None = None
+
+
+class _RulesTrie:
+    """Trie por caracteres de localidad_key; cada nodo guarda sus reglas por usage_code."""
+
+    __slots__ = ("root",)
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, rule: dict) -> None:
+        node = self.root
+        for ch in rule["localidad_key"]:
+            node = node.setdefault(ch, {})
+        node.setdefault(None, {})[rule["usage_code"]] = rule
+
+    def subtree_rules(self, key: str):
+        node = self.root
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                return
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            for k, child in n.items():
+                if k is None:
+                    yield from child.values()
+                else:
+                    stack.append(child)
+
+
+def is_loaded() -> bool:
+    return _index is not None
+
+
+def lookup_validity_rule(localidad_key: str, usage_code: str) -> dict | None:
+    """Misma regla que devolvería la consulta original, o None si no hay."""
+    if _index is None:
+        raise RuntimeError("Índice de reglas no cargado")
+    memo_key = (localidad_key, usage_code)
+    if memo_key in _lookup_memo:
+        return _lookup_memo[memo_key]
+    best = None
+    best_rank = None
+    for rule in _index.subtree_rules(localidad_key):
+        usage_rank = 0 if rule["usage_code"] == usage_code else (1 if rule["usage_code"] == "C" else 2)
+        rank = (usage_rank, 0 if rule["localidad_key"] == localidad_key else 1, rule["localidad_key"])
+        if best_rank is None or rank < best_rank:
+            best, best_rank = rule, rank
+    _lookup_memo[memo_key] = best
+    return best
+
+
+async def _fetch_version(conn):
+    row = await conn.fetchrow("SELECT COUNT(*) AS n, MAX(updated_at) AS ts FROM inspection_validity_rules")
+    return (row["n"], row["ts"])
+
+
+async def index_is_current(conn=None) -> bool:
+    """
+    True si el índice se puede usar para esta búsqueda. Con LISTEN activo alcanza con que
+    esté cargado; si no, compara la versión en la base (con `conn` si el llamador ya tiene una).
+    """
+    if _index is None:
+        return False
+    if _listen_conn is not None and not _listen_conn.is_closed():
+        return True
+    if conn is None:
+        async with get_conn_ctx() as conn:
+            version = await _fetch_version(conn)
+    else:
+        version = await _fetch_version(conn)
+    if version == _version:
+        return True
+    if _pending_reload is None or _pending_reload.done():
+        _schedule_reload()
+    return False
+
+
+async def reload_validity_rules() -> None:
+    global _index, _version, _reload_lock
+    if _reload_lock is None:
+        _reload_lock = asyncio.Lock()
+    async with _reload_lock:
+        async with get_conn_ctx() as conn:
+            version = await _fetch_version(conn)
+            rows = await conn.fetch(f"SELECT {', '.join(_RULE_FIELDS)} FROM inspection_validity_rules")
+        index = _RulesTrie()
+        for r in rows:
+            if r["localidad_key"] and r["usage_code"]:
+                index.add({k: r[k] for k in _RULE_FIELDS})
+        _index = index
+        _version = version
+        _lookup_memo.clear()
+        log.info("Reglas de vigencia cargadas: %s", len(rows))
+
+
+async def notify_rules_changed(conn) -> None:
+    """
+    Llamar después de que confirmó la transacción que modificó reglas, nunca dentro: la
+    recarga tiene que leer lo ya confirmado. La del proceso actual se agenda para después
+    de la respuesta.
+    """
+    await conn.execute("SELECT pg_notify($1, '')", VALIDITY_RULES_CHANNEL)
+    _schedule_reload()
+
+
+def _schedule_reload() -> None:
+    global _pending_reload
+
+    async def _reload_soon():
+        try:
+            await reload_validity_rules()
+        except Exception as e:
+            log.warning("No se pudieron recargar las reglas de vigencia: %s", e)
+
+    _pending_reload = asyncio.create_task(_reload_soon())
+    _tasks.append(_pending_reload)
+    _tasks[:] = [t for t in _tasks if not t.done()]
+
+
+async def _poll_loop() -> None:
+    while True:
+        await asyncio.sleep(VALIDITY_RULES_POLL_SECONDS)
+        try:
+            async with get_conn_ctx() as conn:
+                version = await _fetch_version(conn)
+            if version != _version:
+                await reload_validity_rules()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Chequeo de reglas de vigencia falló: %s", e)
+
+
+async def _start_listener() -> None:
+    global _listen_conn
+    host = os.getenv("DB_LISTEN_HOST")
+    if not host:
+        return
+    ssl_ctx = ssl.create_default_context()
+    ssl_ctx.check_hostname = False
+    ssl_ctx.verify_mode = ssl.CERT_NONE
+    try:
+        _listen_conn = await asyncpg.connect(
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASSWORD"),
+            database=os.getenv("DB_NAME"),
+            host=host,
+            port=int(os.getenv("DB_LISTEN_PORT", os.getenv("DB_PORT", 5432))),
+            ssl=ssl_ctx,
+            statement_cache_size=0,
+        )
+        await _listen_conn.add_listener(VALIDITY_RULES_CHANNEL, lambda *_: _schedule_reload())
+        log.info("Escuchando cambios de reglas de vigencia en %s", host)
+    except Exception as e:
+        log.warning("No se pudo abrir LISTEN para reglas de vigencia, queda el chequeo periódico: %s", e)
+        _listen_conn = None
+
+
+async def start_validity_rules() -> None:
+    try:
+        await reload_validity_rules()
+    except Exception as e:
+        # Sin índice los certificados consultan la base como antes
+        log.warning("No se pudieron cargar las reglas de vigencia al arrancar: %s", e)
+    await _start_listener()
+    if VALIDITY_RULES_POLL_SECONDS > 0:
+        _tasks.append(asyncio.create_task(_poll_loop()))
+
+
+async def stop_validity_rules() -> None:
+    global _listen_conn
+    for t in _tasks:
+        t.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    if _listen_conn is not None:
+        try:
+            await _listen_conn.close()
+        except Exception:
+            pass
+        _listen_conn = None
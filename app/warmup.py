@@ -0,0 +1,95 @@
+# app/warmup.py
+"""
+Warm-up de cada worker al arrancar, para que el primer certificado después de un deploy no
+pague la carga perezosa de templates, índices, conexiones y fuentes de MuPDF.
+
+Pasos (en orden, cada uno con su tiempo y error en warmup_status()):
+  templates     lee los templates de certificado y compila sus layouts
+  localidades   carga el índice precompilado de localidades
+  db_pool       abre WARMUP_DB_CONNECTIONS conexiones del pool
+  render        WARMUP_RENDERS renders de prueba (uno por worker del renderer por defecto)
+
+Un paso que falla se registra y no frena a los demás: el worker queda listo igual, solo
+frío en esa parte. /health/ready responde 503 hasta que el warm-up termina.
+
+Configuración por variables de entorno:
+  WARMUP_ENABLED           0 lo desactiva (el worker queda listo al arrancar)
+  WARMUP_BLOCKING          1 corre el warm-up dentro de before_serving (no acepta conexiones
+                           hasta terminar); por defecto corre en segundo plano
+  WARMUP_DB_CONNECTIONS    conexiones a abrir (por defecto 2)
+  WARMUP_RENDERS           renders de prueba (por defecto uno por proceso del renderer)
+"""
+import asyncio
+import logging
+import os
+import time
+
+from app import certificate_renderer
+from app.db import warm_pool
+
+log = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_BLOCKING = os.getenv("WARMUP_BLOCKING", "0") == "1"
+WARMUP_DB_CONNECTIONS = int(os.getenv("WARMUP_DB_CONNECTIONS", "2"))
+WARMUP_RENDERS = int(os.getenv("WARMUP_RENDERS", "0"))
+
+_ready = False
+_task: asyncio.Task | None = None
+_status: dict = {"state": "pending", "steps": {}}
+
+
+def is_ready() -> bool:
+    return _ready
+
+
+def warmup_status() -> dict:
+    return {"ready": _ready, **_status}
+
+
+async def _step(name: str, coro) -> None:
+    t0 = time.perf_counter()
+    try:
+        await coro
+        _status["steps"][name] = {"ok": True, "ms": round((time.perf_counter() - t0) * 1000.0, 1)}
+    except Exception as e:
+        log.warning("Warm-up: paso %s falló: %s", name, e)
+        _status["steps"][name] = {"ok": False, "ms": round((time.perf_counter() - t0) * 1000.0, 1), "error": str(e)}
+
+
+async def run_warmup() -> None:
+    global _ready
+    from app.routes.certificates import _load_localidades_index_async, _precompile_template_layouts, _warmup_render
+
+    _status["state"] = "running"
+    t0 = time.perf_counter()
+    await _step("templates", _precompile_template_layouts())
+    await _step("localidades", _load_localidades_index_async())
+    if WARMUP_DB_CONNECTIONS > 0:
+        await _step("db_pool", warm_pool(WARMUP_DB_CONNECTIONS))
+    renders = WARMUP_RENDERS or (certificate_renderer.RENDER_PROCESSES if certificate_renderer.is_enabled() else 1)
+    await _step("render", _warmup_render(renders))
+    _status["state"] = "done"
+    _status["ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    _ready = True
+    log.info("Warm-up terminado en %.0f ms: %s", _status["ms"], _status["steps"])
+
+
+async def start_warmup() -> None:
+    global _task, _ready
+    if not WARMUP_ENABLED:
+        _status["state"] = "disabled"
+        _ready = True
+        return
+    if WARMUP_BLOCKING:
+        await run_warmup()
+    else:
+        _task = asyncio.create_task(run_warmup())
+
+
+async def stop_warmup() -> None:
+    global _task
+    if _task is not None and not _task.done():
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+    _task = None
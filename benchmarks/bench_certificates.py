@@ -0,0 +1,301 @@
+"""
+Benchmark del render de certificados (camino de CPU más caliente del servicio).
+
+Corre offline: usa los templates de app/utils/templates, mappings sintéticos y una foto
+generada con PIL, sin base de datos ni storage.
+
+    python benchmarks/bench_certificates.py                    # corre y compara contra baseline
+    python benchmarks/bench_certificates.py --update-baseline  # guarda los resultados como baseline
+    python benchmarks/bench_certificates.py --only photo -n 50
+
+Reporta por caso renders/seg, p50/p99 en ms, tamaño del PDF y RSS pico del proceso.
+Sale con código 1 si algún caso empeora más que --tolerance respecto del baseline y con
+código 2 si no hay baseline (salvo --allow-missing-baseline).
+El baseline commiteado (benchmarks/baseline.json) se generó en la máquina que figura en
+su campo "machine"; en otra máquina, regenerarlo antes de comparar.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Sin pool de procesos ni red: todo se llama en forma sincrónica en este proceso
+os.environ.setdefault("CERT_RENDER_PROCESSES", "0")
+
+import fitz  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from app.image_variants import CERT_THUMB_SIZE, build_image_variants, resize_image_bytes  # noqa: E402
+from app.routes import certificates as certs  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+LONG_DOMICILIO = (
+    "Avenida Presidente Bernardino Rivadavia 12345, Piso 14, Departamento C, "
+    "Barrio Parque Los Aromos Norte, entre calles Independencia y Juan B. Justo"
+)
+LONG_OBSERVACIONES = " ".join(
+    [
+        "Se observa desgaste irregular en neumáticos delanteros, se recomienda alineación y balanceo.",
+        "Luz de patente trasera con intermitencia. Limpiaparabrisas del lado del acompañante gastado.",
+        "Pérdida leve de aceite en cárter, controlar antes de la próxima revisión.",
+    ] * 3
+)
+
+
+def _base_mapping(**overrides) -> dict[str, str]:
+    mapping = {
+        "${fecha_emision}": "16/10/2026",
+        "${fecha_vencimiento}": "16/10/2027",
+        "${fecha_em2}": "16/10/2026",
+        "${fecha_vto}": "16/10/2027",
+        "${taller}": "Taller de Revisión Técnica Centro",
+        "${num_reg}": "1234",
+        "${nombre_apellido}": "María Fernanda Gómez",
+        "${nombre_apellido2}": "María Fernanda Gómez (DNI 30123456) - TITULAR",
+        "${documento}": "30123456",
+        "${documento2}": "30123456",
+        "${domicilio}": "San Martín 123",
+        "${f_localidad}": "Córdoba",
+        "${t_localidad}": "Córdoba",
+        "${localidad2}": "Córdoba (Córdoba)",
+        "${provincia}": "Córdoba",
+        "${provincia2}": "Córdoba",
+        "${patente}": "AB123CD",
+        "${patente2}": "AB123CD",
+        "${anio}": "2019",
+        "${marca}": "Volkswagen",
+        "${modelo}": "Gol Trend 1.6",
+        "${marca_motor}": "Volkswagen",
+        "${numero_motor}": "CFZ123456",
+        "${combustible}": "Nafta",
+        "${marca_chasis}": "Volkswagen",
+        "${numero_chasis}": "9BWAB45U0KT012345",
+        "${ced_tipo}": "M1",
+        "${ced_tipo2}": "M1",
+        "${tipo_vehiculo}": "M1",
+        "${resultado_inspeccion}": "APTO",
+        "${observaciones}": "",
+        "${observaciones2}": "",
+        "${clasif}": "Automóvil\nParticular",
+        "${resultado2}": "",
+        "${crt_numero}": "104512",
+        "${oblea_numero}": "A0012345",
+        "${resultado_final}": "APTO",
+    }
+    mapping.update(overrides)
+    return mapping
+
+
+def _observaciones(usage_type: str | None) -> dict[str, str]:
+    import textwrap
+
+    width2 = 45 if usage_type == "D" else 90
+    return {
+        "${observaciones}": textwrap.fill(LONG_OBSERVACIONES, width=115, break_long_words=False, break_on_hyphens=False),
+        "${observaciones2}": textwrap.fill(LONG_OBSERVACIONES, width=width2, break_long_words=False, break_on_hyphens=False),
+    }
+
+
+def _synthetic_photo(width: int = 3000, height: int = 2000) -> bytes:
+    img = Image.new("RGB", (width, height), (90, 120, 160))
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, 40):
+        draw.line([(i, 0), (width - i, height)], fill=(i % 255, 80, 200 - i % 200), width=6)
+    draw.rectangle([width // 4, height // 3, 3 * width // 4, 2 * height // 3], fill=(200, 40, 40))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def _build_cases(photo_png: bytes) -> list[dict]:
+    qr_link = "https://www.checkrto.com/qr/A0012345"
+    cases = []
+    for template in certs.CERTIFICATE_TEMPLATES:
+        is_photo = template.startswith("photos/")
+        usage_type = "D" if is_photo else "A"
+        extra = {"${photo}": ""} if is_photo else {}
+        cases.append({
+            "name": f"render:{template}",
+            "template": template,
+            "mapping": _base_mapping(**extra),
+            "usage_type": usage_type,
+            "photo": photo_png if is_photo else None,
+            "qr_link": qr_link,
+        })
+
+    apto = "certificado_base_apto.pdf"
+    cases.append({
+        "name": "scenario:long_domicilio",
+        "template": apto,
+        "mapping": _base_mapping(**{"${domicilio}": LONG_DOMICILIO}),
+        "usage_type": "A",
+        "photo": None,
+        "qr_link": qr_link,
+    })
+    cases.append({
+        "name": "scenario:long_observaciones",
+        "template": "certificado_base_condicional.pdf",
+        "mapping": _base_mapping(**_observaciones("A"), **{"${resultado_inspeccion}": "CONDICIONAL"}),
+        "usage_type": "A",
+        "photo": None,
+        "qr_link": qr_link,
+    })
+    cases.append({
+        "name": "scenario:usage_d_photo",
+        "template": "photos/certificado_base_condicional_photo.pdf",
+        "mapping": _base_mapping(**_observaciones("D"), **{"${photo}": "", "${clasif}": "Automóvil\nTaxi / Remis"}),
+        "usage_type": "D",
+        "photo": photo_png,
+        "qr_link": qr_link,
+    })
+    cases.append({
+        "name": "scenario:second_inspection",
+        "template": apto,
+        "mapping": _base_mapping(**{
+            "${resultado_inspeccion}": "CONDICIONAL",
+            "${resultado2}": "APTO",
+            "${resultado_final}": "APTO",
+        }),
+        "usage_type": "A",
+        "photo": None,
+        "qr_link": qr_link,
+    })
+    return cases
+
+
+def _measure(fn, iterations: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    out = None
+    t_start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        out = fn()
+        latencies.append(time.perf_counter() - t0)
+    total = time.perf_counter() - t_start
+    latencies.sort()
+    p99_idx = min(len(latencies) - 1, max(0, int(round(0.99 * len(latencies))) - 1))
+    return {
+        "ops_per_sec": round(iterations / total, 2) if total else None,
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(latencies[p99_idx] * 1000, 3),
+        # El render devuelve una memoryview de solo lectura sobre el PDF
+        "output_bytes": memoryview(out).nbytes if isinstance(out, (bytes, bytearray, memoryview)) else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run(iterations: int, warmup: int, only: str | None, use_layout: bool) -> dict:
+    photo_src = _synthetic_photo()
+    photo_png = resize_image_bytes(photo_src, *CERT_THUMB_SIZE)
+    templates = {t: certs._read_template_file(t) for t in certs.CERTIFICATE_TEMPLATES}
+    layouts = {t: certs._compile_template_layout(data) for t, data in templates.items()} if use_layout else {}
+
+    benches = []
+    for case in _build_cases(photo_png):
+        def render(case=case):
+            pdf_bytes, _ = certs._render_certificate_pdf_sync(
+                templates[case["template"]], case["mapping"], case["qr_link"],
+                case["photo"], case["usage_type"], layouts.get(case["template"]),
+            )
+            return pdf_bytes
+        benches.append((case["name"], render))
+
+        if case["name"].startswith("render:"):
+            def replace_only(case=case):
+                doc = fitz.open(stream=templates[case["template"]], filetype="pdf")
+                try:
+                    certs._replace_placeholders_transparente(
+                        doc, case["mapping"], certs._get_qr_png(case["qr_link"]),
+                        case["photo"], case["usage_type"], layouts.get(case["template"]),
+                    )
+                finally:
+                    doc.close()
+            benches.append((case["name"].replace("render:", "replace:"), replace_only))
+
+    benches.append(("qr:make_qr_bytes", lambda: certs._make_qr_bytes("https://www.checkrto.com/qr/A0012345")))
+    benches.append(("photo:resize_original", lambda: resize_image_bytes(photo_src, *CERT_THUMB_SIZE)))
+    benches.append(("photo:ingest_variants", lambda: build_image_variants(photo_src)["thumb"]))
+
+    results = {}
+    for name, fn in benches:
+        if only and only not in name:
+            continue
+        n = iterations if not name.startswith("photo:ingest") else max(1, iterations // 5)
+        results[name] = _measure(fn, n, warmup)
+        r = results[name]
+        size = f"{r['output_bytes'] / 1024:.1f}KB" if r["output_bytes"] else "-"
+        print(f"{name:55s} {r['ops_per_sec']:>9.1f}/s  p50 {r['p50_ms']:>8.2f}ms  p99 {r['p99_ms']:>8.2f}ms  out {size:>9s}  rss {r['peak_rss_mb']}MB")
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if base.get("ops_per_sec") and cur["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {cur['ops_per_sec']}/s vs baseline {base['ops_per_sec']}/s")
+        if base.get("p99_ms") and cur["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {cur['p99_ms']}ms vs baseline {base['p99_ms']}ms")
+        if base.get("output_bytes") and cur["output_bytes"] and cur["output_bytes"] > base["output_bytes"] * (1 + tolerance):
+            regressions.append(f"{name}: PDF {cur['output_bytes']}B vs baseline {base['output_bytes']}B")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--only", help="solo casos cuyo nombre contenga este texto")
+    parser.add_argument("--no-layout", action="store_true", help="renderizar sin el layout precompilado")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--allow-missing-baseline", action="store_true", help="no fallar si no existe el baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="empeoramiento permitido (0.25 = 25%%)")
+    parser.add_argument("--json", help="guardar los resultados en este archivo")
+    args = parser.parse_args()
+
+    results = run(args.iterations, args.warmup, args.only, not args.no_layout)
+    doc = {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "pymupdf": fitz.VersionBind},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(doc, fh, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as fh:
+            json.dump(doc, fh, indent=2)
+        print(f"Baseline guardado en {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"Sin baseline en {args.baseline}, correr con --update-baseline para crearlo")
+        return 0 if args.allow_missing_baseline else 2
+    with open(args.baseline) as fh:
+        baseline = json.load(fh).get("results", {})
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\nRegresiones respecto del baseline:")
+        for line in regressions:
+            print(f"  - {line}")
+        return 1
+    print("\nSin regresiones respecto del baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
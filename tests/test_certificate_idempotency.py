@@ -0,0 +1,146 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+
+from app import certificate_engine as ce
+
+
+class _Row(dict):
+    # El engine indexa muchas columnas del JOIN; las que el test no define valen NULL
+    def __missing__(self, key):
+        return None
+
+
+class _FakeConn:
+    def __init__(self, store):
+        self.store = store
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchrow(self, query, job_id):
+        # Único SELECT que hace el engine acá: el estado del job de post-proceso
+        return self.store.jobs.get(job_id)
+
+
+class _FakeStore:
+    """Las tablas que tocan dos pedidos seguidos: render keys y background_jobs."""
+
+    def __init__(self):
+        self.keys = {}
+        self.jobs = {}
+        self.created_at = datetime(2026, 10, 1, 12, 0)
+
+    def data(self, app_id):
+        key = self.keys.get((app_id, False))
+        row = _Row(
+            application_id=app_id,
+            car_plate="AB123CD",
+            sticker_number="000123",
+            usage_type="C",
+            app_date=datetime(2026, 10, 1, 12, 0),
+            last_render_hash=key["render_hash"] if key else None,
+            last_render_path=key["storage_path"] if key else None,
+            last_render_job_id=key["job_id"] if key else None,
+        )
+        insp = {"id": 7, "global_observations": "", "created_at": self.created_at, "is_second": False}
+        return {app_id: {"row": row, "insp": insp, "step_obs_rows": [], "photo_doc": None, "validity_rule": None}}
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = _FakeStore()
+
+    @asynccontextmanager
+    async def get_conn_ctx():
+        yield _FakeConn(store)
+
+    async def prefetch(app_ids):
+        return store.data(app_ids[0])
+
+    async def enqueue(kind, payload=None, attachment=None, conn=None, **kw):
+        jid = f"job-{len(store.jobs) + 1}"
+        store.jobs[jid] = {"status": "pending", "attachment": bytes(attachment)}
+        return jid
+
+    async def save_pending(conn, app_id, is_second, render_hash, storage_path, job_id):
+        store.keys[(app_id, is_second)] = {"render_hash": render_hash, "storage_path": storage_path, "job_id": job_id}
+
+    async def completed(*args, **kw):
+        pass
+
+    monkeypatch.setattr(ce, "get_conn_ctx", get_conn_ctx)
+    monkeypatch.setattr(ce, "_prefetch_certificate_data", prefetch)
+    monkeypatch.setattr(ce, "enqueue", enqueue)
+    monkeypatch.setattr(ce, "_save_pending_render_key", save_pending)
+    monkeypatch.setattr(ce, "_update_application_status_to_completed", completed)
+    ce._CERT_PDF_CACHE.clear()
+    return store
+
+
+def _engine(renders):
+    async def load_template(url):
+        return b"template"
+
+    async def load_photo(doc):
+        return None
+
+    async def render(template_bytes, mapping, qr_link, photo_png, usage_type, template_url):
+        renders.append(mapping)
+        return b"%PDF-" + str(len(renders)).encode(), {}
+
+    return ce.CertificateEngine(
+        load_template=load_template,
+        load_photo=load_photo,
+        render=render,
+        template_digest=lambda data: "digest",
+    )
+
+
+@pytest.mark.asyncio
+async def test_second_press_reuses_issuance(store):
+    renders = []
+    engine = _engine(renders)
+
+    first, _, meta1 = await engine.generate(1, {"condicion": "apto"})
+    # El post-proceso pisa inspections.created_at con NOW(): cambia la fecha de emisión
+    store.created_at = datetime(2026, 10, 2, 9, 30)
+    second, _, meta2 = await engine.generate(1, {"condicion": "apto"})
+
+    assert len(renders) == 1
+    assert len(store.jobs) == 1
+    assert meta2["reused"] and not meta1["reused"]
+    assert bytes(second) == bytes(first)
+
+
+@pytest.mark.asyncio
+async def test_second_press_on_other_worker_uses_pending_job(store):
+    renders = []
+    engine = _engine(renders)
+
+    first, _, _ = await engine.generate(1, {"condicion": "apto"})
+    # Otro worker: sin el PDF en su cache, lo toma del adjunto del job todavía pendiente
+    ce._CERT_PDF_CACHE.clear()
+    second, _, meta2 = await engine.generate(1, {"condicion": "apto"})
+
+    assert len(renders) == 1
+    assert len(store.jobs) == 1
+    assert meta2["reused"]
+    assert bytes(second) == bytes(first)
+
+
+@pytest.mark.asyncio
+async def test_failed_job_is_not_reused(store):
+    renders = []
+    engine = _engine(renders)
+
+    await engine.generate(1, {"condicion": "apto"})
+    ce._CERT_PDF_CACHE.clear()
+    store.jobs["job-1"]["status"] = "error"
+    _, _, meta2 = await engine.generate(1, {"condicion": "apto"})
+
+    assert len(renders) == 2
+    assert len(store.jobs) == 2
+    assert not meta2["reused"]